@@ -0,0 +1,226 @@
+"""Time the stages of the pipeline on a synthetic dataset.
+
+Every stage runs on the outputs of the previous ones, loaded before the
+timer starts, so that the times are those of the computations and not of
+reading the dataset.  The results are a JSON serializable dict with the
+parameters of the scene, the sizes of the main structures and the time
+of every stage, to compare runs of different versions of the code.
+"""
+
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+from opensfm.benchmark import synthetic
+
+
+logger = logging.getLogger(__name__)
+
+
+STAGES = [
+    'tag_matching',
+    'create_tracks',
+    'all_common_tracks',
+    'reconstruct',
+    'bundle',
+    'retriangulate',
+    'export',
+]
+
+
+class Context:
+    pass
+
+
+def _stage_tag_matching(ctx):
+    from opensfm.commands import match_features
+
+    images = ctx.data.images()
+    match_ctx = match_features.Context()
+    match_ctx.data = ctx.data
+    match_ctx.ignore_tag_list = []
+    candidates = {im: images[i + 1:] for i, im in enumerate(images)}
+    args = match_features.match_arguments(candidates, match_ctx)
+
+    start = time.time()
+    for arg in args:
+        match_features.match_tags(arg)
+    return time.time() - start
+
+
+def _stage_create_tracks(ctx):
+    from opensfm import matching
+    from opensfm.commands import create_tracks
+
+    images = ctx.data.images()
+    features, colors = create_tracks.load_features(ctx.data, images)
+    matches = create_tracks.load_matches(ctx.data, images)
+    tag_features, tag_colors, tag_idx, tag_ids = \
+        create_tracks.load_tag_features(ctx.data, images)
+    tag_matches = create_tracks.load_tag_matches(ctx.data, images)
+
+    start = time.time()
+    ctx.graph = matching.create_tracks_graph(
+        features, colors, matches, tag_features, tag_idx, tag_colors,
+        tag_matches, tag_ids, ctx.data.config)
+    duration = time.time() - start
+    ctx.data.save_tracks_graph(ctx.graph)
+    ctx.sizes['matches'] = sum(len(m) for m in matches.values())
+    ctx.sizes['tracks_graph_nodes'] = ctx.graph.number_of_nodes()
+    ctx.sizes['tracks_graph_edges'] = ctx.graph.number_of_edges()
+    return duration
+
+
+def _stage_all_common_tracks(ctx):
+    from opensfm import matching
+
+    tracks, images = matching.tracks_and_images(ctx.graph)
+    start = time.time()
+    ctx.common_tracks = matching.all_common_tracks(ctx.graph, tracks)
+    duration = time.time() - start
+    ctx.sizes['tracks'] = len(tracks)
+    ctx.sizes['common_tracks_pairs'] = len(ctx.common_tracks)
+    return duration
+
+
+def _stage_reconstruct(ctx):
+    from opensfm import reconstruction
+
+    config = ctx.data.config
+    if config.get('tag_tracks', False) or config.get('resection_with_tags', False):
+        incremental = reconstruction.incremental_reconstruction_with_tags
+    else:
+        incremental = reconstruction.incremental_reconstruction
+
+    start = time.time()
+    ctx.reconstructions = incremental(ctx.data, graph=ctx.graph,
+                                      common_tracks=ctx.common_tracks)
+    duration = time.time() - start
+    ctx.sizes['reconstructions'] = len(ctx.reconstructions)
+    ctx.sizes['reconstructed_shots'] = sum(len(r.shots) for r in ctx.reconstructions)
+    ctx.sizes['reconstructed_points'] = sum(len(r.points) for r in ctx.reconstructions)
+    return duration
+
+
+def _stage_bundle(ctx):
+    from opensfm import reconstruction
+
+    if not ctx.reconstructions:
+        return None
+    start = time.time()
+    reconstruction.bundle(ctx.graph, ctx.reconstructions[0], None, ctx.data.config)
+    return time.time() - start
+
+
+def _stage_retriangulate(ctx):
+    from opensfm import reconstruction
+
+    if not ctx.reconstructions:
+        return None
+    start = time.time()
+    reconstruction.retriangulate(ctx.graph, ctx.reconstructions[0], ctx.data.config)
+    return time.time() - start
+
+
+def _stage_export(ctx):
+    start = time.time()
+    ctx.data.save_reconstruction(ctx.reconstructions)
+    if ctx.reconstructions:
+        ctx.data.save_ply(ctx.reconstructions[0])
+    return time.time() - start
+
+
+_stage_functions = {
+    'tag_matching': _stage_tag_matching,
+    'create_tracks': _stage_create_tracks,
+    'all_common_tracks': _stage_all_common_tracks,
+    'reconstruct': _stage_reconstruct,
+    'bundle': _stage_bundle,
+    'retriangulate': _stage_retriangulate,
+    'export': _stage_export,
+}
+
+# stages whose inputs are computed by a previous stage
+_stage_requirements = {
+    'all_common_tracks': 'create_tracks',
+    'reconstruct': 'all_common_tracks',
+    'bundle': 'reconstruct',
+    'retriangulate': 'reconstruct',
+    'export': 'reconstruct',
+}
+
+
+def _required_stages(stages):
+    required = set()
+    for stage in stages:
+        while stage is not None and stage not in required:
+            required.add(stage)
+            stage = _stage_requirements.get(stage)
+    return [s for s in STAGES if s in required]
+
+
+def git_commit():
+    """Commit of the source tree, if it is a git checkout."""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=folder,
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(scene, path, stages=None, config_overrides=None):
+    """Write the scene to path and time the stages on it.
+
+    Stages needed by the given ones are run too.  Their times are
+    reported with the others.
+
+    Returns:
+        a dict with the scene parameters, the sizes of the structures and
+        the seconds of every stage, None for the stages that had nothing
+        to do.
+    """
+    stages = _required_stages(stages or STAGES)
+
+    start = time.time()
+    ctx = Context()
+    ctx.data = synthetic.write_dataset(scene, path,
+                                       config_overrides=config_overrides)
+    ctx.sizes = {
+        'images': scene.num_images,
+        'points': len(scene.points),
+        'tags': len(scene.tags),
+        'features': sum(len(f) for f in scene.features.values()),
+        'tag_detections': sum(len(t) for t in scene.tag_features.values()),
+    }
+    generation = time.time() - start
+
+    times = {}
+    for stage in stages:
+        logger.info('Running stage {}'.format(stage))
+        times[stage] = _stage_functions[stage](ctx)
+
+    return {
+        'commit': git_commit(),
+        'time': time.time(),
+        'python': sys.version.split()[0],
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'scene': {
+            'num_images': scene.num_images,
+            'num_points': len(scene.points),
+            'tags_per_image': scene.tags_per_image,
+            'noise': scene.noise,
+            'outlier_fraction': scene.outlier_fraction,
+            'seed': scene.seed,
+        },
+        'sizes': ctx.sizes,
+        'generation': generation,
+        'stages': times,
+    }
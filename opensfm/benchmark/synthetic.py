@@ -0,0 +1,297 @@
+"""Synthetic datasets of configurable size.
+
+The scene extends the CubeDataset of the tests, which uses the camera
+pose helpers of this module, to any size: cameras move along a row of
+cubes filled with points, looking at them, so that the number of images
+seeing a point does not grow with the number of images.
+Tags are squares on the front face of the cubes.
+
+The features, matches, tag detections and tag features of every image
+are computed from the ground truth, so the pipeline can run from
+create_tracks, or from tag matching, without any image.
+"""
+
+import itertools
+import os
+
+import cv2
+import numpy as np
+
+from opensfm import config
+from opensfm import dataset
+from opensfm import features
+from opensfm import io
+from opensfm import types
+
+
+CAMERA_ID = 'synthetic'
+
+
+def normalized(x):
+    return x / np.linalg.norm(x)
+
+
+def camera_pose(position, lookat, up):
+    """Pose from position and look at direction.
+
+    >>> position = [1.0, 2.0, 3.0]
+    >>> lookat = [0., 10.0, 2.0]
+    >>> up = [0.0, 0.0, 1.0]
+    >>> pose = camera_pose(position, lookat, up)
+    >>> np.allclose(pose.get_origin(), position)
+    True
+    >>> d = normalized(pose.transform(lookat))
+    >>> np.allclose(d, [0, 0, 1])
+    True
+    """
+    ez = normalized(np.array(lookat) - np.array(position))
+    ex = normalized(np.cross(ez, up))
+    ey = normalized(np.cross(ez, ex))
+    pose = types.Pose()
+    pose.set_rotation_matrix([ex, ey, ez])
+    pose.set_origin(position)
+    return pose
+
+
+class SyntheticScene(object):
+    """Cameras moving along a row of cubes of points and tags.
+
+    Attributes:
+        camera: the PerspectiveCamera shared by all the shots.
+        shots: dict of Shot with the ground truth poses.
+        points: (n, 3) array of the ground truth points.
+        point_descriptors: (n, 16) array of the descriptors of the points.
+        tags: dict from tag ids to (4, 3) arrays of their corners.
+        features: dict from images to (k, 2) arrays of the noisy
+            normalized coordinates of their visible points, followed by
+            outlier features at random positions.
+        feature_points: dict from images to the indices of the points
+            of their features, -1 for the outlier features.
+        tag_features: dict from images to lists of (tag id, (4, 2) array
+            of normalized corner coordinates).
+    """
+
+    def __init__(self, num_images=20, num_points=2000, tags_per_image=2,
+                 noise=0.001, outlier_fraction=0.1, spacing=0.25,
+                 distance=3.0, tag_size=0.1, seed=0):
+        self.num_images = num_images
+        self.tags_per_image = tags_per_image
+        self.seed = seed
+        self.noise = noise
+        self.outlier_fraction = outlier_fraction
+        self.random = np.random.RandomState(seed)
+
+        self.camera = types.PerspectiveCamera()
+        self.camera.id = CAMERA_ID
+        self.camera.width = 800
+        self.camera.height = 600
+        self.camera.focal = self.camera.focal_prior = 0.9
+        self.camera.k1 = self.camera.k1_prior = -0.1
+        self.camera.k2 = self.camera.k2_prior = 0.01
+
+        length = spacing * max(num_images - 1, 1)
+        self.shots = {}
+        for i in range(num_images):
+            x = spacing * i
+            shot = types.Shot()
+            shot.id = 'image{:05d}.jpg'.format(i)
+            shot.camera = self.camera
+            shot.pose = camera_pose([x, -distance, 0.5], [x, 0.5, 0.5],
+                                    [0.0, 0.0, 1.0])
+            shot.metadata = types.ShotMetadata()
+            self.shots[shot.id] = shot
+
+        margin = 1.0
+        self.points = self.random.rand(num_points, 3)
+        self.points[:, 0] = self.points[:, 0] * (length + 2 * margin) - margin
+        self.point_descriptors = self.random.rand(num_points, 16).astype(np.float32)
+
+        # tags evenly spaced on the front face, as many per image as asked
+        self.tags = {}
+        if tags_per_image > 0:
+            view_width = distance / self.camera.focal
+            num_tags = int(np.ceil(tags_per_image * (length + 2 * margin) / view_width))
+            square = np.array([[-1, 0, 1], [1, 0, 1], [1, 0, -1], [-1, 0, -1]]) * tag_size / 2
+            for i in range(num_tags):
+                center = [(i + 0.5) * (length + 2 * margin) / num_tags - margin,
+                          -0.001, self.random.uniform(0.3, 0.7)]
+                self.tags[i] = square + center
+
+        self.features = {}
+        self.feature_points = {}
+        self.tag_features = {}
+        for shot_id, shot in sorted(self.shots.items()):
+            projected, visible = self.project(shot, self.points)
+            indices = np.nonzero(visible)[0]
+            noisy = projected[indices] + self.random.normal(
+                0, noise, (len(indices), 2))
+            num_outliers = int(outlier_fraction * len(indices))
+            outliers = self.random.uniform(-0.5, 0.5, (num_outliers, 2))
+            outliers[:, 1] *= float(self.camera.height) / self.camera.width
+            self.features[shot_id] = np.concatenate((noisy, outliers))
+            self.feature_points[shot_id] = np.concatenate(
+                (indices, -np.ones(num_outliers, dtype=int)))
+
+            self.tag_features[shot_id] = []
+            for tag_id, corners in sorted(self.tags.items()):
+                projected, visible = self.project(shot, corners)
+                if visible.all():
+                    self.tag_features[shot_id].append((tag_id, projected))
+
+    def images(self):
+        return sorted(self.shots)
+
+    def descriptors(self, image):
+        """Descriptors of the features of an image.
+
+        They are the descriptors of their points with some noise, and
+        random for the outlier features.
+        """
+        indices = self.feature_points[image]
+        descriptors = self.point_descriptors[indices]
+        descriptors += self.random.normal(0, 0.01, descriptors.shape)
+        outliers = indices < 0
+        descriptors[outliers] = self.random.rand(np.sum(outliers), descriptors.shape[1])
+        return descriptors.astype(np.float32)
+
+    def project(self, shot, points):
+        """Normalized coordinates of points and whether they are visible."""
+        R = shot.pose.get_rotation_matrix()
+        camera_points = np.dot(points, R.T) + shot.pose.translation
+        depth = camera_points[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xn = camera_points[:, 0] / depth
+            yn = camera_points[:, 1] / depth
+        r2 = xn * xn + yn * yn
+        distortion = 1.0 + r2 * (self.camera.k1 + self.camera.k2 * r2)
+        projected = np.column_stack((self.camera.focal * distortion * xn,
+                                     self.camera.focal * distortion * yn))
+        aspect = float(self.camera.height) / self.camera.width
+        visible = ((depth > 0) &
+                   (np.abs(projected[:, 0]) < 0.5) &
+                   (np.abs(projected[:, 1]) < 0.5 * aspect))
+        return projected, visible
+
+    def matches(self, min_matches=20):
+        """Feature matches of the image pairs seeing common points.
+
+        The outlier features of the two images are matched at random, a
+        fraction outlier_fraction of the correct matches of the pair.
+        They make tracks that are geometrically inconsistent, without
+        merging the tracks of the points.
+
+        Returns:
+            a dict from image pairs to (n, 2) arrays of feature indices.
+        """
+        images = self.images()
+        positions = {}
+        for image in images:
+            positions[image] = {p: i for i, p in enumerate(self.feature_points[image])}
+
+        matches = {}
+        for im1, im2 in itertools.combinations(images, 2):
+            common = np.intersect1d(self.feature_points[im1],
+                                    self.feature_points[im2])
+            common = common[common >= 0]
+            if len(common) < min_matches:
+                continue
+            pair = np.array([[positions[im1][p], positions[im2][p]]
+                             for p in common], dtype=int)
+            outliers1 = np.nonzero(self.feature_points[im1] < 0)[0]
+            outliers2 = np.nonzero(self.feature_points[im2] < 0)[0]
+            num_outliers = min(int(self.outlier_fraction * len(pair)),
+                               len(outliers1), len(outliers2))
+            if num_outliers:
+                outliers = np.column_stack((
+                    self.random.choice(outliers1, num_outliers, replace=False),
+                    self.random.choice(outliers2, num_outliers, replace=False)))
+                pair = np.concatenate((pair, outliers))
+            matches[im1, im2] = pair
+        return matches
+
+    def tag_detection(self, image):
+        """TagDetections of an image, with corners in pixels."""
+        width, height = self.camera.width, self.camera.height
+        unit_square = np.array([[-1, 1], [1, 1], [1, -1], [-1, -1]], dtype=np.float32)
+        detections = []
+        for tag_id, corners in self.tag_features[image]:
+            pixels = features.denormalized_image_coordinates(corners, width, height)
+            detection = types.TagDetection()
+            detection.id = str(tag_id)
+            detection.hamming = 0
+            detection.goodness = 0.0
+            detection.margin = 100.0
+            detection.homography = cv2.getPerspectiveTransform(
+                unit_square, pixels.astype(np.float32))
+            detection.center = pixels.mean(axis=0)
+            detection.corners = pixels
+            detection.colors = np.zeros((4, 3))
+            detections.append(detection)
+        return detections
+
+
+def write_dataset(scene, path, matches=None, config_overrides=None):
+    """Write the inputs of the pipeline of a scene to a dataset folder.
+
+    The image list, exif, camera models, features, matches, tag detections
+    and tag features are written, without the images.
+
+    Returns:
+        the DataSet.
+    """
+    io.mkdir_p(path)
+    with open(os.path.join(path, 'image_list.txt'), 'w') as fout:
+        for image in scene.images():
+            fout.write(os.path.join('images', image) + '\n')
+    options = {
+        'use_apriltags': True,
+        'processes': 1,
+        'matcher_type': 'BRUTEFORCE',
+    }
+    options.update(config_overrides or {})
+    with open(os.path.join(path, 'config.yaml'), 'w') as fout:
+        fout.write(config.yaml.dump(options, default_flow_style=False))
+
+    data = dataset.DataSet(path)
+    data.save_camera_models({CAMERA_ID: scene.camera})
+    data.save_reference_lla({'latitude': 0.0, 'longitude': 0.0, 'altitude': 0.0})
+
+    tag_detections = {}
+    for image in scene.images():
+        data.save_exif(image, {
+            'camera': CAMERA_ID,
+            'width': scene.camera.width,
+            'height': scene.camera.height,
+            'projection_type': 'perspective',
+            'focal_ratio': scene.camera.focal,
+            'orientation': 1,
+            'capture_time': 0.0,
+        })
+
+        points = scene.features[image]
+        num_features = len(points)
+        data.save_features(
+            image,
+            np.column_stack((points, np.full(num_features, 0.01))).astype(np.float32),
+            scene.descriptors(image),
+            np.full((num_features, 3), 128, dtype=np.uint8))
+
+        tags = scene.tag_features[image]
+        tag_detections[image] = scene.tag_detection(image)
+        if tags:
+            data.save_tag_features(
+                image,
+                np.concatenate([corners for _, corners in tags]),
+                np.repeat([tag_id for tag_id, _ in tags], 4),
+                np.tile(np.arange(4), len(tags)),
+                np.zeros((4 * len(tags), 3)))
+    data.save_tag_detection(tag_detections)
+
+    if matches is None:
+        matches = scene.matches()
+    by_image = {image: {} for image in scene.images()}
+    for (im1, im2), pair in matches.items():
+        by_image[im1][im2] = pair
+    for image, image_matches in by_image.items():
+        data.save_matches(image, image_matches)
+    return data
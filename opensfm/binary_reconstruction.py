@@ -0,0 +1,274 @@
+"""Binary container for reconstructions.
+
+The file starts with a small JSON header holding the cameras and shots of
+every reconstruction, followed by the points of all the reconstructions
+as packed arrays (ids, coordinates, colors, reprojection errors and tag
+attributes).  The arrays are memory mapped when reading, and the point
+objects of a reconstruction are only built the first time its points are
+accessed, so commands that only need cameras and shots never pay for the
+points.
+
+Layout:
+    8 bytes       magic
+    8 bytes       header length (little endian uint64)
+    header        utf-8 JSON, padded to a multiple of 16 bytes
+    arrays        raw little endian arrays at the offsets given in the header
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+
+from opensfm import io
+from opensfm import types
+
+
+MAGIC = b'OSFMREC1'
+ALIGNMENT = 16
+POINT_ARRAYS = ['ids', 'coordinates', 'colors', 'reprojection_errors',
+                'on_tag', 'tag_ids', 'tag_corners']
+
+
+class LazyPoints(dict):
+    """Dict of points built from the packed arrays on first access."""
+
+    def __init__(self, arrays):
+        dict.__init__(self)
+        self._arrays = arrays
+
+    def loaded(self):
+        return self._arrays is None
+
+    def arrays(self):
+        """The packed point arrays, or None if the points were loaded."""
+        return self._arrays
+
+    def _load(self):
+        if self._arrays is not None:
+            arrays, self._arrays = self._arrays, None
+            dict.update(self, points_from_arrays(arrays))
+
+    def __len__(self):
+        if self._arrays is not None:
+            return len(self._arrays['ids'])
+        return dict.__len__(self)
+
+    def __reduce__(self):
+        self._load()
+        return (dict, (dict(self),))
+
+
+def _loading(name):
+    method = getattr(dict, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ['__getitem__', '__setitem__', '__delitem__', '__contains__',
+              '__iter__', '__eq__', '__ne__', '__repr__', 'clear', 'copy',
+              'get', 'has_key', 'items', 'iteritems', 'iterkeys',
+              'itervalues', 'keys', 'pop', 'popitem', 'setdefault',
+              'update', 'values']:
+    if hasattr(dict, _name):
+        setattr(LazyPoints, _name, _loading(_name))
+
+
+def points_to_arrays(points):
+    """Pack a dict of points into arrays."""
+    points = points.values()
+    n = len(points)
+    colors = np.full((n, 3), np.nan, dtype=np.float32)
+    for i, p in enumerate(points):
+        if p.color is not None:
+            colors[i] = p.color
+    return {
+        'ids': np.array([p.id for p in points]),
+        'coordinates': np.array([p.coordinates for p in points],
+                                dtype=np.float64).reshape(n, 3),
+        'colors': colors,
+        'reprojection_errors': np.array(
+            [np.nan if p.reprojection_error is None else p.reprojection_error
+             for p in points], dtype=np.float64),
+        'on_tag': np.array([bool(p.on_tag) for p in points], dtype=np.bool_),
+        'tag_ids': np.array([str(p.tag_id) for p in points]),
+        'tag_corners': np.array([p.tag_corner for p in points], dtype=np.int32),
+    }
+
+
+def points_from_arrays(arrays):
+    """Build a dict of points from packed arrays."""
+    points = {}
+    columns = zip(arrays['ids'].tolist(),
+                  arrays['coordinates'].tolist(),
+                  arrays['colors'].tolist(),
+                  arrays['reprojection_errors'].tolist(),
+                  arrays['on_tag'].tolist(),
+                  arrays['tag_ids'].tolist(),
+                  arrays['tag_corners'].tolist())
+    for id, coordinates, color, error, on_tag, tag_id, tag_corner in columns:
+        point = types.Point()
+        point.id = id
+        point.coordinates = coordinates
+        if not np.isnan(color[0]):
+            point.color = color
+        if not np.isnan(error):
+            point.reprojection_error = error
+        point.on_tag = on_tag
+        point.tag_id = tag_id if on_tag else _tag_id_from_string(tag_id)
+        point.tag_corner = tag_corner
+        points[id] = point
+    return points
+
+
+def _tag_id_from_string(tag_id):
+    try:
+        return int(tag_id)
+    except ValueError:
+        return tag_id
+
+
+def _point_arrays(reconstruction):
+    """Packed point arrays, without loading lazy points."""
+    points = reconstruction.points
+    if isinstance(points, LazyPoints) and not points.loaded():
+        return points.arrays()
+    return points_to_arrays(points)
+
+
+def _header_from_reconstruction(reconstruction):
+    obj = {
+        'cameras': io.cameras_to_json(reconstruction.cameras),
+        'shots': {},
+    }
+    for shot in reconstruction.shots.values():
+        obj['shots'][shot.id] = io.shot_to_json(shot)
+    if hasattr(reconstruction, 'pano_shots'):
+        obj['pano_shots'] = {}
+        for shot in reconstruction.pano_shots.values():
+            obj['pano_shots'][shot.id] = io.shot_to_json(shot)
+    if hasattr(reconstruction, 'main_shot'):
+        obj['main_shot'] = reconstruction.main_shot
+    if hasattr(reconstruction, 'unit_shot'):
+        obj['unit_shot'] = reconstruction.unit_shot
+    return obj
+
+
+def write_reconstructions(reconstructions, filename):
+    """Write reconstructions to a binary file.
+
+    The file is written next to the destination and renamed, so that the
+    points of a reconstruction lazily read from the same file can still
+    be copied.
+    """
+    headers = []
+    arrays = {name: [] for name in POINT_ARRAYS}
+    start = 0
+    for reconstruction in reconstructions:
+        header = _header_from_reconstruction(reconstruction)
+        point_arrays = _point_arrays(reconstruction)
+        count = len(point_arrays['ids'])
+        header['point_range'] = [start, start + count]
+        start += count
+        headers.append(header)
+        for name in POINT_ARRAYS:
+            arrays[name].append(np.asarray(point_arrays[name]))
+
+    packed = {}
+    for name in POINT_ARRAYS:
+        non_empty = [a for a in arrays[name] if len(a)]
+        if non_empty:
+            packed[name] = np.ascontiguousarray(np.concatenate(non_empty))
+        else:
+            packed[name] = points_to_arrays({})[name]
+
+    layout = {}
+    offset = 0
+    for name in POINT_ARRAYS:
+        array = packed[name].astype(packed[name].dtype.newbyteorder('<'))
+        packed[name] = array
+        layout[name] = {
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'offset': offset,
+        }
+        offset += _padded(array.nbytes)
+
+    header = json.dumps({'reconstructions': headers, 'arrays': layout})
+    header = header.encode('utf-8')
+    header += b' ' * (_padded(len(header)) - len(header))
+
+    temp_file = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_file, 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(struct.pack('<Q', len(header)))
+        fout.write(header)
+        for name in POINT_ARRAYS:
+            data = packed[name].tobytes()
+            fout.write(data)
+            fout.write(b'\0' * (_padded(len(data)) - len(data)))
+    os.rename(temp_file, filename)
+
+
+def read_reconstructions(filename):
+    """Read reconstructions from a binary file.
+
+    Cameras and shots are read right away.  The points are memory mapped
+    and only turned into Point objects when first accessed.
+    """
+    with open(filename, 'rb') as fin:
+        if fin.read(len(MAGIC)) != MAGIC:
+            raise IOError('{} is not a binary reconstruction file'.format(
+                filename))
+        header_size, = struct.unpack('<Q', fin.read(8))
+        header = json.loads(fin.read(header_size).decode('utf-8'))
+    data_start = len(MAGIC) + 8 + header_size
+
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(str(layout['dtype']))
+        shape = tuple(layout['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                     offset=data_start + layout['offset'],
+                                     shape=shape)
+
+    reconstructions = []
+    for obj in header['reconstructions']:
+        reconstruction = io.reconstruction_from_json(obj)
+        start, end = obj.pop('point_range')
+        reconstruction.points = LazyPoints(
+            {name: arrays[name][start:end] for name in POINT_ARRAYS})
+        reconstructions.append(reconstruction)
+    return reconstructions
+
+
+def is_binary_file(filename):
+    """Whether a file is a binary reconstruction file."""
+    with open(filename, 'rb') as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+def json_to_binary(json_file, binary_file):
+    """Convert a reconstruction.json file to the binary format."""
+    with open(json_file) as fin:
+        reconstructions = io.reconstructions_from_json(json.load(fin))
+    write_reconstructions(reconstructions, binary_file)
+
+
+def binary_to_json(binary_file, json_file, minify=False):
+    """Convert a binary reconstruction file to json (e.g. for the viewer)."""
+    reconstructions = read_reconstructions(binary_file)
+    with open(json_file, 'w') as fout:
+        io.json_dump(io.reconstructions_to_json(reconstructions), fout, minify)
+
+
+def _padded(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
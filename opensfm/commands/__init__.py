@@ -1,34 +1,49 @@
+"""Registry of the opensfm commands.
 
-import extract_metadata
-import detect_features
-import detect_tags
-import match_features
-import create_tracks
-import reconstruct
-import mesh
-import undistort
-import compute_depthmaps
-import export_ply
-import export_openmvs
-import export_visualsfm
-import create_submodels
-import align_submodels
-import results
+Command modules import heavy dependencies (OpenCV, networkx, scipy, the
+compiled extensions), so they are only imported when a command is
+selected.  The help of each command is repeated here to list the
+commands without importing them.
+"""
 
+import importlib
+
+
+# (name, help) of the commands, in the order they are listed.  The command
+# named foo is the Command class of the opensfm.commands.foo module.
 opensfm_commands = [
-    extract_metadata,
-    detect_features,
-    detect_tags,
-    match_features,
-    create_tracks,
-    reconstruct,
-    mesh,
-    undistort,
-    compute_depthmaps,
-    export_ply,
-    export_openmvs,
-    export_visualsfm,
-    create_submodels,
-    align_submodels,
-    results
+    ('extract_metadata', "Extract metadata from images' EXIF tag"),
+    ('detect_features', 'Compute features for all images'),
+    ('detect_tags', 'Detect tags for all images'),
+    ('match_features', 'Match features between image pairs'),
+    ('detect_and_match', 'Detect features and match image pairs as soon as both images are detected'),
+    ('create_tracks', 'Link matches pair-wise matches into tracks'),
+    ('reconstruct', 'Compute the reconstruction'),
+    ('extend', 'Add new images to the tracks and reconstructions'),
+    ('localize', 'Localize images against the reconstruction'),
+    ('mesh', 'Add delaunay meshes to the reconstruction'),
+    ('undistort', 'Save radially undistorted images'),
+    ('compute_depthmaps', 'Compute depthmap'),
+    ('export_ply', 'Export reconstruction to PLY format'),
+    ('export_openmvs', 'Export reconstruction to openMVS format'),
+    ('export_visualsfm', 'Export reconstruction to NVM_V3 format from VisualSfM'),
+    ('export_tag_map', 'Export the reconstructed tag corners to localize images with'),
+    ('create_submodels', 'Split the dataset into smaller submodels'),
+    ('align_submodels', 'Align submodel reconstructions'),
+    ('results', 'returns the results for a 3D reconstruction'),
+    ('convert_reconstruction', 'Convert the reconstruction between the json and binary formats'),
+    ('run_pipeline', 'Run the pipeline stages whose inputs or config changed'),
+    ('worker', 'Run tasks from the work queue of a dataset'),
 ]
+
+
+def command_names():
+    return [name for name, _ in opensfm_commands]
+
+
+def load_command(name):
+    """Import the module of a command and return its Command instance."""
+    if name not in command_names():
+        raise ValueError('Unknown command {}'.format(name))
+    module = importlib.import_module('opensfm.commands.' + name)
+    return module.Command()
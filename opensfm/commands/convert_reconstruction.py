@@ -0,0 +1,27 @@
+import logging
+
+from opensfm import dataset
+
+logger = logging.getLogger(__name__)
+
+
+class Command:
+    name = 'convert_reconstruction'
+    help = "Convert the reconstruction between the json and binary formats"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='dataset to process')
+        parser.add_argument('format', choices=['json', 'binary'],
+                            help='format to convert to')
+        parser.add_argument('--filename',
+                            help='reconstruction file (default: reconstruction.json)')
+        parser.add_argument('--minify', action='store_true',
+                            help='write minified json')
+
+    def run(self, args):
+        data = dataset.DataSet(args.dataset)
+        reconstructions = data.load_reconstruction(args.filename)
+        data.save_reconstruction(reconstructions, args.filename,
+                                 minify=args.minify, file_format=args.format)
+        logger.info('Converted {} reconstructions to {}'.format(
+            len(reconstructions), args.format))
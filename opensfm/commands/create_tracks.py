@@ -3,6 +3,7 @@ import time
 
 from opensfm import dataset
 from opensfm import matching
+from opensfm import profiling
 
 logger = logging.getLogger(__name__)
 
@@ -19,54 +20,76 @@ class Command:
         data = dataset.DataSet(args.dataset)
         images = data.images()
 
-        # Read local features
         logging.info('reading features')
-        features = {}
-        colors = {}
-        for im in images:
-            p, f, c = data.load_features(im)
-            features[im] = p[:, :2]
-            colors[im] = c
-
-        # Read matches
-        matches = {}
-        for im1 in images:
-            try:
-                im1_matches = data.load_matches(im1)
-            except IOError:
-                continue
-            for im2 in im1_matches:
-                matches[im1, im2] = im1_matches[im2]
-
-        # Read tag features
-        tag_features = {}
-        tag_colors = {}
-        tag_idx = {}
-        tag_ids = {}
-        for im in images:
-            try:
-                p, f, i, c = data.load_tag_features(im)
-                tag_features[im] = p
-                tag_colors[im] = c
-                tag_idx[im] = i
-                tag_ids[im] = f
-            except IOError:
-                continue
-
-        # Read tag pt matches
-        tag_matches = {}
-        for im1 in images:
-            try:
-                im1_tag_matches = data.load_tag_matches(im1)
-            except IOError:
-                continue
-            for im2 in im1_tag_matches:
-                tag_matches[im1, im2] = im1_tag_matches[im2]
+        features, colors = load_features(data, images)
+        matches = load_matches(data, images)
+        tag_features, tag_colors, tag_idx, tag_ids = load_tag_features(data, images)
+        tag_matches = load_tag_matches(data, images)
 
         # create tracks graph
         tracks_graph = matching.create_tracks_graph(features, colors, matches, tag_features, tag_idx, tag_colors, tag_matches, tag_ids, data.config)
+        if profiling.memory_enabled():
+            profiling.size('matches/pairs', len(matches))
+            profiling.size('matches/matches', sum(len(m) for m in matches.values()))
+            profiling.size('tracks_graph/nodes', tracks_graph.number_of_nodes())
+            profiling.size('tracks_graph/edges', tracks_graph.number_of_edges())
         data.save_tracks_graph(tracks_graph)
 
         end = time.time()
         with open(data.profile_log(), 'a') as fout:
             fout.write('create_tracks: {0}\n'.format(end - start))
+
+
+def load_features(data, images):
+    """Point coordinates and colors of the features of the images."""
+    features = {}
+    colors = {}
+    for im in images:
+        p, f, c = data.load_features(im)
+        features[im] = p[:, :2]
+        colors[im] = c
+    return features, colors
+
+
+def load_matches(data, images):
+    """Matches saved with the images, by image pair."""
+    matches = {}
+    for im1 in images:
+        try:
+            im1_matches = data.load_matches(im1)
+        except IOError:
+            continue
+        for im2 in im1_matches:
+            matches[im1, im2] = im1_matches[im2]
+    return matches
+
+
+def load_tag_features(data, images):
+    """Points, colors, corner indices and ids of the tag features."""
+    tag_features = {}
+    tag_colors = {}
+    tag_idx = {}
+    tag_ids = {}
+    for im in images:
+        try:
+            p, f, i, c = data.load_tag_features(im)
+            tag_features[im] = p
+            tag_colors[im] = c
+            tag_idx[im] = i
+            tag_ids[im] = f
+        except IOError:
+            continue
+    return tag_features, tag_colors, tag_idx, tag_ids
+
+
+def load_tag_matches(data, images):
+    """Tag matches saved with the images, by image pair."""
+    tag_matches = {}
+    for im1 in images:
+        try:
+            im1_tag_matches = data.load_tag_matches(im1)
+        except IOError:
+            continue
+        for im2 in im1_tag_matches:
+            tag_matches[im1, im2] = im1_tag_matches[im2]
+    return tag_matches
@@ -0,0 +1,157 @@
+import logging
+import Queue
+import time
+from collections import deque
+from multiprocessing import Pool
+
+from opensfm import dataset
+from opensfm import profiling
+from opensfm.commands import detect_features
+from opensfm.commands import match_features
+
+logger = logging.getLogger(__name__)
+
+# Context of the workers, shared with them when the pool is forked
+_context = {}
+
+
+class Command:
+    name = 'detect_and_match'
+    help = 'Detect features and match image pairs as soon as both images are detected'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='dataset to process')
+
+    def run(self, args):
+        data = dataset.DataSet(args.dataset)
+        images = data.images()
+        exifs = {im: data.load_exif(im) for im in images}
+        processes = data.config.get('processes', 1)
+        start = time.time()
+        try:
+            tags = data.load_tag_detection()
+        except:
+            tags = {}
+
+        # Tag features are needed to filter the candidate pairs with tags
+        # and are cheap to extract, so they are all extracted first
+        for image in images:
+            detect_features.extract_tag_features(image, data)
+        pairs = match_features.match_candidates(data, images, exifs, processes)
+
+        ctx = match_features.Context()
+        ctx.data = data
+        ctx.cameras = data.load_camera_models()
+        ctx.exifs = exifs
+        ctx.p_pre, ctx.f_pre = {}, {}
+        _context['ctx'] = ctx
+        _context['tags'] = tags
+
+        candidates = [(im1, im2) for im1 in sorted(pairs) for im2 in pairs[im1]]
+        matches = {im: {} for im in pairs}
+        remaining = {im: len(pairs[im]) for im in pairs}
+
+        def on_matched(pair, result):
+            im1, im2 = pair
+            if result is not None:
+                matches[im1][im2] = result
+            remaining[im1] -= 1
+            if remaining[im1] == 0:
+                data.save_matches(im1, matches.pop(im1))
+
+        for im1 in pairs:
+            if remaining[im1] == 0:
+                data.save_matches(im1, matches.pop(im1))
+        detect_and_match(images, candidates, _detect, _match, on_matched, processes)
+
+        end = time.time()
+        with open(data.profile_log(), 'a') as fout:
+            fout.write('detect_and_match: {0}\n'.format(end - start))
+
+
+def _detect(image):
+    data = _context['ctx'].data
+    detect_features.detect_image_features(
+        image, _context['tags'].get(image, []), data)
+
+
+def _match(pair):
+    im1, im2 = pair
+    logger.info('Matching {} - {}'.format(im1, im2))
+    with profiling.span('match_pair'):
+        return match_features.match_pair(im1, im2, _context['ctx'])
+
+
+def detect_and_match(images, pairs, detect, match, on_matched, processes):
+    """Detect the images and match the pairs as soon as both are detected.
+
+    Detection and matching share the same processes.  The matching of the
+    pairs whose images are detected runs before the detection of the next
+    images, and at most `processes` tasks are queued, so that matching
+    starts while detection is still running.
+
+    Args:
+        images: images to detect, in detection order.
+        pairs: list of image pairs to match.
+        detect: function(image) detecting an image.
+        match: function(pair) matching a pair.
+        on_matched: function(pair, result) called in this process with
+            the result of match, or None if it failed.
+        processes: number of processes.
+    """
+    pairs_by_image = {}
+    for pair in pairs:
+        for image in pair:
+            pairs_by_image.setdefault(image, []).append(pair)
+
+    to_detect = deque(images)
+    detected = set()
+    ready = deque()
+
+    def on_detected(image):
+        detected.add(image)
+        for pair in pairs_by_image.get(image, []):
+            other = pair[1] if pair[0] == image else pair[0]
+            if other in detected:
+                ready.append(pair)
+
+    if processes == 1:
+        while to_detect or ready:
+            if ready:
+                pair = ready.popleft()
+                on_matched(pair, _run_task(('match', match, pair))[2])
+            else:
+                image = to_detect.popleft()
+                _run_task(('detect', detect, image))
+                on_detected(image)
+        return
+
+    done = Queue.Queue()
+    pool = Pool(processes)
+    queued = 0
+    while to_detect or ready or queued:
+        while queued < processes and (ready or to_detect):
+            if ready:
+                task = ('match', match, ready.popleft())
+            else:
+                task = ('detect', detect, to_detect.popleft())
+            pool.apply_async(_run_task, (task,), callback=done.put)
+            queued += 1
+        kind, key, result = done.get()
+        queued -= 1
+        if kind == 'detect':
+            on_detected(key)
+        else:
+            on_matched(key, result)
+    pool.close()
+    pool.join()
+
+
+def _run_task(arguments):
+    kind, function, key = arguments
+    try:
+        return kind, key, function(key)
+    except Exception as e:
+        logger.error('Exception on {} {}'.format(kind, key))
+        logger.exception(e)
+        return kind, key, None
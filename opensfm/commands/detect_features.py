@@ -8,6 +8,7 @@ import numpy as np
 import cv2
 from opensfm import dataset
 from opensfm import features
+from opensfm import profiling
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +44,16 @@ class Command:
 
 def detect(args):
     image, tags, data = args
+    with profiling.span('detect_image'):
+        if detect_image_features(image, tags, data):
+            extract_tag_features(image, data)
+
+
+def detect_image_features(image, tags, data):
+    """Detect and save the features of an image.
+
+    Returns False if no features were found.
+    """
     logger.info('Extracting {} features for image {}'.format(data.feature_type().upper(), image))
     DEBUG = 0
     
@@ -55,7 +66,7 @@ def detect(args):
         preemptive_max = data.config.get('preemptive_max', 200)
         p_unsorted, f_unsorted, c_unsorted = features.extract_features(data.image_as_array(image), data.config, mask)
         if len(p_unsorted) == 0:
-            return
+            return False
 
         #===== prune features in tags =====#
         if data.config.get('prune_features_on_tags',False):
@@ -127,6 +138,9 @@ def detect(args):
         p_pre = p_sorted[-preemptive_max:]
         f_pre = f_sorted[-preemptive_max:]
 
+        profiling.count('detect/images')
+        profiling.count('detect/features', len(p_sorted))
+
         # save
         data.save_features(image, p_sorted, f_sorted, c_sorted)
         data.save_preemptive_features(image, p_pre, f_pre)
@@ -134,8 +148,11 @@ def detect(args):
         if data.config.get('matcher_type', 'FLANN') == 'FLANN':
             index = features.build_flann_index(f_sorted, data.config)
             data.save_feature_index(image, index)
+    return True
 
 
+def extract_tag_features(image, data):
+    """Save the corners of the tags detected in an image as tag features."""
     #===== tag features =====#
     if data.config.get('use_apriltags',False) or data.config.get('use_arucotags',False) or data.config.get('use_chromatags',False):
 
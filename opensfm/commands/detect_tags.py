@@ -59,21 +59,25 @@ class Command:
             print 'Use ChromaTags = True but not implemented yet.'
 
         # merge all tag detections into one json
-        logger.info('Merging tag detection files into one json.')
-        images_with_tag_detections = {}
-        for image in images:
-            try:
-                tag_det = data.load_tag_detection(os.path.join('tag_detections',image+'.json'))
-                images_with_tag_detections[image] = tag_det[image]
-            except:
-                pass
-        data.save_tag_detection(images_with_tag_detections)
+        merge_tag_detections(data, images)
 
         # shutdown
         end = time.time()
         with open(data.profile_log(), 'a') as fout:
             fout.write('detect_tags: {0}\n'.format(end - start))
 
+def merge_tag_detections(data, images):
+    """Merge the tag detection files of the images into one json."""
+    logger.info('Merging tag detection files into one json.')
+    images_with_tag_detections = {}
+    for image in images:
+        try:
+            tag_det = data.load_tag_detection(os.path.join('tag_detections',image+'.json'))
+            images_with_tag_detections[image] = tag_det[image]
+        except:
+            pass
+    data.save_tag_detection(images_with_tag_detections)
+
 def apriltag_detect(args):
 
     # split args
@@ -88,12 +92,21 @@ def apriltag_detect(args):
     if os.path.isfile(jsonpath):
         return
 
-    # set apriltag tag algorithm
-    command = './/detect_apriltag -i ' + imagepath
-    #command += ' -r 960'
-    command += ' -t 1'
-    command += ' -J ' + jsonpath
+    run_apriltag_detector(imagepath, jsonpath)
+
+def run_apriltag_detector(imagepath, jsonpath):
+    """Run the AprilTag detector on an image, writing the detections to jsonpath."""
+
+    # set apriltag tag algorithm, the paths are passed as is without a shell
+    command = ['./detect_apriltag', '-i', imagepath]
+    #command += ['-r', '960']
+    command += ['-t', '1']
+    command += ['-J', jsonpath]
     
     # run process
-    pProc = subprocess.Popen(command, shell=True, cwd=os.path.dirname(os.path.realpath(__file__)) )
-    pProc.wait()
\ No newline at end of file
+    try:
+        pProc = subprocess.Popen(command, cwd=os.path.dirname(os.path.realpath(__file__)) )
+    except OSError as e:
+        logger.error('Could not run the AprilTag detector on {0}: {1}'.format(imagepath, e))
+        return
+    pProc.wait()
@@ -11,10 +11,15 @@ class Command:
 
     def add_arguments(self, parser):
         parser.add_argument('dataset', help='dataset to process')
+        parser.add_argument('--format', choices=['ascii', 'binary'],
+                            help='PLY format (default: ply_format config value)')
 
     def run(self, args):
         data = dataset.DataSet(args.dataset)
         reconstructions = data.load_reconstruction()
 
         if reconstructions:
-            data.save_ply(reconstructions[0])
+            binary = None
+            if args.format:
+                binary = args.format == 'binary'
+            data.save_ply(reconstructions[0], binary=binary)
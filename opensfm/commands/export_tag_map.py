@@ -0,0 +1,26 @@
+import logging
+
+from opensfm import dataset
+from opensfm import localization
+
+logger = logging.getLogger(__name__)
+
+
+class Command:
+    name = 'export_tag_map'
+    help = "Export the reconstructed tag corners to localize images with"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='dataset to process')
+        parser.add_argument('--reconstruction', type=int, default=0,
+                            help='index of the reconstruction to export')
+
+    def run(self, args):
+        data = dataset.DataSet(args.dataset)
+        reconstructions = data.load_reconstruction()
+
+        if reconstructions:
+            reconstruction = reconstructions[args.reconstruction]
+            tag_map = localization.tag_map(reconstruction)
+            data.save_tag_map(args.reconstruction, tag_map, reconstruction.cameras)
+            logger.info('Exported {} tags'.format(len(tag_map)))
@@ -0,0 +1,110 @@
+import logging
+from multiprocessing import Pool
+import os
+import time
+
+from opensfm import dataset
+from opensfm import io
+from opensfm import matching
+from opensfm import reconstruction
+from opensfm.commands import create_tracks
+from opensfm.commands import detect_features
+from opensfm.commands import detect_tags
+from opensfm.commands import extract_metadata
+from opensfm.commands import match_features
+
+logger = logging.getLogger(__name__)
+
+
+class Command:
+    name = 'extend'
+    help = 'Add new images to the tracks and reconstructions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='dataset to process')
+        parser.add_argument('--images', nargs='+', metavar='IMAGE',
+                            help='images to add (default: the images '
+                            'that are not in the tracks)')
+        parser.add_argument('--global-bundle', action='store_true',
+                            help='bundle adjust the whole reconstructions '
+                            'after adding the images')
+
+    def run(self, args):
+        start = time.time()
+        data = dataset.DataSet(args.dataset)
+        graph = data.load_tracks_graph()
+
+        if args.images:
+            new_images = args.images
+        else:
+            _, images = matching.tracks_and_images(graph)
+            images = set(images)
+            new_images = [im for im in data.images() if im not in images]
+        if not new_images:
+            logger.info('No new images to add')
+            return
+
+        logger.info('Adding {} new images'.format(len(new_images)))
+        extend_dataset(data, graph, new_images, args.global_bundle)
+
+        end = time.time()
+        with open(data.profile_log(), 'a') as fout:
+            fout.write('extend: {0}\n'.format(end - start))
+
+
+def extend_dataset(data, graph, new_images, global_bundle=False):
+    """Add new images to the tracks and reconstructions of a dataset.
+
+    The metadata, tags and features of the new images are computed, the
+    pairs with a new image are matched and their matches added to the
+    tracks graph.  The new images are then resected into the saved
+    reconstructions.
+
+    Returns:
+        the set of images that could not be added to a reconstruction.
+    """
+    processes = data.config.get('processes', 1)
+
+    extract_metadata.extract_metadata(data, new_images,
+                                      data.load_camera_models())
+
+    if data.config.get('use_apriltags', False):
+        io.mkdir_p(os.path.join(data.data_path, 'tag_detections'))
+        for image in new_images:
+            detect_tags.apriltag_detect((image, data.data_path))
+        detect_tags.merge_tag_detections(data, data.images())
+
+    tags = {}
+    if data.tag_detection_exists():
+        tags = data.load_tag_detection()
+    arguments = [(image, tags.get(image, []), data) for image in new_images]
+    if processes == 1:
+        for arg in arguments:
+            detect_features.detect(arg)
+    else:
+        p = Pool(processes)
+        p.map(detect_features.detect, arguments)
+
+    match_features.match_images(data, new_images)
+
+    # the new matches are saved with the new images
+    matches = create_tracks.load_matches(data, new_images)
+    tag_matches = create_tracks.load_tag_matches(data, new_images)
+    images = set(im for pair in matches.keys() + tag_matches.keys()
+                 for im in pair)
+    features, colors = create_tracks.load_features(data, images)
+    tag_features, tag_colors, tag_idx, tag_ids = \
+        create_tracks.load_tag_features(data, images)
+    matching.extend_tracks_graph(graph, features, colors, matches,
+                                 tag_features, tag_idx, tag_colors,
+                                 tag_matches, tag_ids, data.config)
+    data.save_tracks_graph(graph)
+
+    if not data.reconstruction_exists():
+        logger.info('No reconstruction to add the images to')
+        return set(new_images)
+    reconstructions = data.load_reconstruction()
+    remaining = reconstruction.extend_reconstructions(
+        data, graph, reconstructions, new_images, global_bundle)
+    data.save_reconstruction(reconstructions)
+    return remaining
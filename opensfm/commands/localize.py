@@ -0,0 +1,56 @@
+import json
+import logging
+import sys
+
+from opensfm import dataset
+from opensfm import localization
+
+logger = logging.getLogger(__name__)
+
+
+class Command:
+    name = 'localize'
+    help = 'Localize images against the reconstruction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='dataset to process')
+        parser.add_argument('images', nargs='*', metavar='IMAGE',
+                            help='image files to localize')
+        parser.add_argument('--reconstruction', type=int, default=0,
+                            help='index of the reconstruction to localize in')
+        parser.add_argument('--tags', action='store_true',
+                            help='localize from the tags of the tag map only')
+        parser.add_argument('--refine', action='store_true',
+                            help='with --tags, refine the pose with the '
+                            'reconstructed points')
+        parser.add_argument('--serve', action='store_true',
+                            help='after the given images, localize the image '
+                            'files read from the standard input, one per line')
+
+    def run(self, args):
+        data = dataset.DataSet(args.dataset)
+        if args.tags:
+            localizer = localization.TagLocalizer(data, args.reconstruction,
+                                                  args.refine)
+        else:
+            localizer = localization.Localizer(data, args.reconstruction)
+
+        for image in args.images:
+            self.localize(localizer, image)
+
+        if args.serve:
+            # the index stays in memory between the queries
+            for line in iter(sys.stdin.readline, ''):
+                image = line.strip()
+                if image:
+                    self.localize(localizer, image)
+
+    def localize(self, localizer, image):
+        try:
+            result = localizer.localize(image)
+            obj = localization.result_to_json(image, result)
+        except Exception as e:
+            logger.exception('Could not localize {}'.format(image))
+            obj = {'image': image, 'localized': False, 'error': str(e)}
+        sys.stdout.write(json.dumps(obj) + '\n')
+        sys.stdout.flush()
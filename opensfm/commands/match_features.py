@@ -10,6 +10,7 @@ import scipy.spatial as spatial
 from opensfm import dataset
 from opensfm import geo
 from opensfm import matching
+from opensfm import profiling
 
 logger = logging.getLogger(__name__)
 
@@ -22,110 +23,124 @@ class Command:
         parser.add_argument('dataset', help='dataset to process')
 
     def run(self, args):
-
-        # setup
         data = dataset.DataSet(args.dataset)
-        images = data.images()
-        exifs = {im: data.load_exif(im) for im in images}
-        processes = data.config.get('processes', 1)
         start = time.time()
+        match_images(data)
+        end = time.time()
+        with open(data.profile_log(), 'a') as fout:
+            fout.write('match_features: {0}\n'.format(end - start))
 
-        #===== tag matching =====#
-        
-        # if a tag detection algorithm was used
-        if data.config.get('use_apriltags',False) or data.config.get('use_arucotags',False) or data.config.get('use_chromatags',False):
-
-            # all possible pairs
-            pairs = match_candidates_all(images)
-
-            all_pairs = {im: [] for im in images}
-            for im1, im2 in pairs:
-                all_pairs[im1].append(im2)
-            logger.info('Matching tags in {} image pairs'.format(len(pairs)))
-
-            # limit used detections
-            ignore_tag_list = create_ignore_tag_list(data)
-            print 'Ignore Tag List: '
-            print ignore_tag_list
-
-            # context
-            ctx = Context()
-            ctx.data = data
-            ctx.ignore_tag_list = ignore_tag_list
-            args = match_arguments(all_pairs, ctx)
-
-            # run match
-            if processes == 1:
-                for arg in args:
-                    match_tags(arg)
-            else:
-                p = Pool(processes)
-                p.map(match_tags, args)
-            
-        #=== end tag matching ===#
-
-        #===== feature matching =====#
-
-        # setup pairs for matching
-        pairs = match_candidates_all(images)
-        logger.info('{} Initial matching image pairs'.format(len(pairs)))
-        tag_pairs = set()
-        meta_pairs = set()
-        tag_prune_mode = data.config.get('prune_with_tags','none')
-
-        # tag pairs
-        if tag_prune_mode == 'strict' or tag_prune_mode == 'medium' or tag_prune_mode == 'loose':
-            tag_pairs = match_candidates_from_tags(images, data)
-            logger.info('{} Tag matching image pairs'.format(len(tag_pairs)))
-        # no tag pairs, but still make tag graph for resectioning
-        else:
-            # build tag matches dictionary
-            tag_matches = {}
-            for im1 in images:
-                try:
-                    im1_tag_matches = data.load_tag_matches(im1)
-                except IOError:
-                    continue
-                for im2 in im1_tag_matches:
-                    tag_matches[im1, im2] = im1_tag_matches[im2]
-            tags_graph = matching.create_tags_graph(tag_matches, data.config)
-            data.save_tags_graph(tags_graph)
-
-        # prune with metadata
-        if data.config.get('prune_with_metadata',True):
-            meta_pairs = match_candidates_from_metadata(images, exifs, data)
-            logger.info('{} Meta matching image pairs'.format(len(meta_pairs)))
-        if tag_pairs:
-            pairs = pairs.intersection(tag_pairs)
-        if meta_pairs:
-            pairs = pairs.intersection(meta_pairs)
-        logger.info('{} Final matching image pairs'.format(len(pairs)))
-
-        # build pairs into dictionary
-        final_pairs = {im: [] for im in images}
-        for im1, im2 in pairs:
-            final_pairs[im1].append(im2)
+
+def match_images(data, new_images=None):
+    """Match the tags and features of the image pairs of the dataset.
+
+    If new_images is given, only the pairs with at least one new image
+    are matched and the matches are saved with the new image, so that the
+    matches of the other images are left as they are.
+    """
+    # setup
+    images = data.images()
+    exifs = {im: data.load_exif(im) for im in images}
+    processes = data.config.get('processes', 1)
+
+    final_pairs = match_candidates(data, images, exifs, processes, new_images)
+
+    #===== feature matching =====#
+
+    # context
+    ctx = Context()
+    ctx.data = data
+    ctx.cameras = ctx.data.load_camera_models()
+    ctx.exifs = exifs
+    ctx.p_pre, ctx.f_pre = load_preemptive_features(data)
+    args = match_arguments(final_pairs, ctx)
+
+    # match
+    if processes == 1:
+        for arg in args:
+            match(arg)
+    else:
+        p = Pool(processes)
+        p.map(match, args)
+    #=== end feature matching ===#
+
+
+def match_candidates(data, images, exifs, processes, new_images=None):
+    """Match the tags and compute the candidate pairs of feature matching.
+
+    If new_images is given, only the pairs with a new image are candidates
+    and the new image comes first in the pairs.
+
+    Returns a dict from images to the list of images to match them with.
+    """
+    #===== tag matching =====#
+    
+    # if a tag detection algorithm was used
+    if data.config.get('use_apriltags',False) or data.config.get('use_arucotags',False) or data.config.get('use_chromatags',False):
+
+        # all possible pairs
+        pairs = match_candidates_all(images, new_images)
+        all_pairs = pairs_by_image(pairs, images, new_images)
+        logger.info('Matching tags in {} image pairs'.format(len(pairs)))
+
+        # limit used detections
+        ignore_tag_list = create_ignore_tag_list(data)
+        print 'Ignore Tag List: '
+        print ignore_tag_list
 
         # context
         ctx = Context()
         ctx.data = data
-        ctx.cameras = ctx.data.load_camera_models()
-        ctx.exifs = exifs
-        ctx.p_pre, ctx.f_pre = load_preemptive_features(data)
-        args = match_arguments(final_pairs, ctx)
+        ctx.ignore_tag_list = ignore_tag_list
+        args = match_arguments(all_pairs, ctx)
 
-        # match
+        # run match
         if processes == 1:
             for arg in args:
-                match(arg)
+                match_tags(arg)
         else:
             p = Pool(processes)
-            p.map(match, args)
-        #=== end feature matching ===#
+            p.map(match_tags, args)
         
-        end = time.time()
-        with open(ctx.data.profile_log(), 'a') as fout:
-            fout.write('match_features: {0}\n'.format(end - start))
+    #=== end tag matching ===#
+
+    # setup pairs for matching
+    pairs = match_candidates_all(images, new_images)
+    logger.info('{} Initial matching image pairs'.format(len(pairs)))
+    tag_pairs = set()
+    meta_pairs = set()
+    tag_prune_mode = data.config.get('prune_with_tags','none')
+
+    # tag pairs
+    if tag_prune_mode == 'strict' or tag_prune_mode == 'medium' or tag_prune_mode == 'loose':
+        tag_pairs = match_candidates_from_tags(images, data)
+        logger.info('{} Tag matching image pairs'.format(len(tag_pairs)))
+    # no tag pairs, but still make tag graph for resectioning
+    else:
+        # build tag matches dictionary
+        tag_matches = {}
+        for im1 in images:
+            try:
+                im1_tag_matches = data.load_tag_matches(im1)
+            except IOError:
+                continue
+            for im2 in im1_tag_matches:
+                tag_matches[im1, im2] = im1_tag_matches[im2]
+        tags_graph = matching.create_tags_graph(tag_matches, data.config)
+        data.save_tags_graph(tags_graph)
+
+    # prune with metadata
+    if data.config.get('prune_with_metadata',True):
+        meta_pairs = match_candidates_from_metadata(images, exifs, data)
+        logger.info('{} Meta matching image pairs'.format(len(meta_pairs)))
+    if tag_pairs:
+        pairs = pairs.intersection(tag_pairs)
+    if meta_pairs:
+        pairs = pairs.intersection(meta_pairs)
+    logger.info('{} Final matching image pairs'.format(len(pairs)))
+
+    # build pairs into dictionary
+    return pairs_by_image(pairs, images, new_images)
 
 
 class Context:
@@ -399,13 +414,23 @@ def match_candidates_from_tags(images,data):
     # return pairs
     return pairs
 
-def match_candidates_all(images):
-    """All pairwise images are candidate matches"""
+def match_candidates_all(images, new_images=None):
+    """All pairwise images are candidate matches
+
+    If new_images is given, only the pairs with at least one new image.
+    """
     
     # empty set
     pairs = set()
     
     # enumerate all possible pairs
+    if new_images is not None:
+        for new_image in new_images:
+            for image in images:
+                if image != new_image:
+                    pairs.add( tuple( sorted( (new_image, image) )))
+        return pairs
+
     for i, image in enumerate(images):
         for j in range(i+1,len(images)):
             pairs.add( tuple( sorted( (images[i], images[j]) )))
@@ -419,6 +444,27 @@ def match_candidates_all(images):
     return pairs
 
 
+def pairs_by_image(pairs, images, new_images=None):
+    """Dict from images to the images they are paired with.
+
+    If new_images is given, pairs are listed under their new image only,
+    so that matching them does not overwrite the matches of the others.
+    """
+    if new_images is None:
+        res = {im: [] for im in images}
+        for im1, im2 in pairs:
+            res[im1].append(im2)
+        return res
+
+    new_images = set(new_images)
+    res = {im: [] for im in new_images}
+    for im1, im2 in pairs:
+        if im1 not in new_images:
+            im1, im2 = im2, im1
+        res[im1].append(im2)
+    return res
+
+
 def match_arguments(pairs, ctx):
     for i, (im, candidates) in enumerate(pairs.items()):
         yield im, candidates, i, len(pairs), ctx
@@ -485,53 +531,86 @@ def match(args):
     im1, candidates, i, n, ctx = args
     logger.info('Matching {}  -  {} / {}'.format(im1, i + 1, n))
 
+    im1_matches = {}
+    for im2 in candidates:
+        with profiling.span('match_pair'):
+            matches = match_pair(im1, im2, ctx)
+        if matches is not None:
+            im1_matches[im2] = matches
+    ctx.data.save_matches(im1, im1_matches)
+
+
+def match_pair(im1, im2, ctx):
+    """Compute the robust matches of an image pair.
+
+    Returns None if the pair was discarded by preemptive matching.
+    """
     config = ctx.data.config
     robust_matching_min_match = config['robust_matching_min_match']
     preemptive_threshold = config['preemptive_threshold']
     lowes_ratio = config['lowes_ratio']
     preemptive_lowes_ratio = config['preemptive_lowes_ratio']
+    profiling.count('match/pairs')
 
-    im1_matches = {}
+    # preemptive matching
+    if preemptive_threshold > 0:
+        t = time.time()
+        config['lowes_ratio'] = preemptive_lowes_ratio
+        with profiling.span('preemptive'):
+            matches_pre = matching.match_lowe_bf(preemptive_features(ctx, im1),
+                                                 preemptive_features(ctx, im2), config)
+        config['lowes_ratio'] = lowes_ratio
+        logger.debug("Preemptive matching {0}, time: {1}s".format(len(matches_pre), time.time() - t))
+        if len(matches_pre) < preemptive_threshold:
+            logger.debug("Discarding based of preemptive matches {0} < {1}".format(len(matches_pre), preemptive_threshold))
+            profiling.count('match/preemptive_discarded')
+            return None
+
+    # symmetric matching
+    t = time.time()
+    p1, f1, c1 = ctx.data.load_features(im1)
+    i1 = ctx.data.load_feature_index(im1, f1)
+
+    p2, f2, c2 = ctx.data.load_features(im2)
+    i2 = ctx.data.load_feature_index(im2, f2)
+
+    with profiling.span('symmetric'):
+        matches = matching.match_symmetric(f1, i1, f2, i2, config)
+    profiling.count('match/symmetric_matches', len(matches))
+    logger.debug('{} - {} has {} candidate matches'.format(im1, im2, len(matches)))
+    if len(matches) < robust_matching_min_match:
+        return []
 
-    for im2 in candidates:
-        # preemptive matching
-        if preemptive_threshold > 0:
-            t = time.time()
-            config['lowes_ratio'] = preemptive_lowes_ratio
-            matches_pre = matching.match_lowe_bf(ctx.f_pre[im1], ctx.f_pre[im2], config)
-            config['lowes_ratio'] = lowes_ratio
-            logger.debug("Preemptive matching {0}, time: {1}s".format(len(matches_pre), time.time() - t))
-            if len(matches_pre) < preemptive_threshold:
-                logger.debug("Discarding based of preemptive matches {0} < {1}".format(len(matches_pre), preemptive_threshold))
-                continue
+    # robust matching
+    t_robust_matching = time.time()
+    camera1 = ctx.cameras[ctx.exifs[im1]['camera']]
+    camera2 = ctx.cameras[ctx.exifs[im2]['camera']]
 
-        # symmetric matching
-        t = time.time()
-        p1, f1, c1 = ctx.data.load_features(im1)
-        i1 = ctx.data.load_feature_index(im1, f1)
+    with profiling.span('robust'):
+        rmatches = matching.robust_match(p1, p2, camera1, camera2, matches, config)
+    profiling.count('match/robust_matches', len(rmatches))
 
-        p2, f2, c2 = ctx.data.load_features(im2)
-        i2 = ctx.data.load_feature_index(im2, f2)
+    if len(rmatches) < robust_matching_min_match:
+        return []
 
-        matches = matching.match_symmetric(f1, i1, f2, i2, config)
-        logger.debug('{} - {} has {} candidate matches'.format(im1, im2, len(matches)))
-        if len(matches) < robust_matching_min_match:
-            im1_matches[im2] = []
-            continue
+    logger.debug('Robust matching time : {0}s'.format( time.time() - t_robust_matching))
 
-        # robust matching
-        t_robust_matching = time.time()
-        camera1 = ctx.cameras[ctx.exifs[im1]['camera']]
-        camera2 = ctx.cameras[ctx.exifs[im2]['camera']]
+    logger.debug("Full matching {0} / {1}, time: {2}s".format( len(rmatches), len(matches), time.time() - t))
+    return rmatches
 
-        rmatches = matching.robust_match(p1, p2, camera1, camera2, matches, config)
 
-        if len(rmatches) < robust_matching_min_match:
-            im1_matches[im2] = []
-            continue
-        im1_matches[im2] = rmatches
-        
-        logger.debug('Robust matching time : {0}s'.format( time.time() - t_robust_matching))
+def preemptive_features(ctx, image):
+    """Preemptive feature descriptors of an image.
 
-        logger.debug("Full matching {0} / {1}, time: {2}s".format( len(rmatches), len(matches), time.time() - t))
-    ctx.data.save_matches(im1, im1_matches)
\ No newline at end of file
+    They are taken from ctx.f_pre, or loaded when they are not there
+    (e.g. when matching while features are being detected).
+    """
+    if image not in ctx.f_pre:
+        data = ctx.data
+        try:
+            p, f = data.load_preemtive_features(image)
+        except IOError:
+            p, f, c = data.load_features(image)
+        preemptive_max = min(data.config.get('preemptive_max', p.shape[0]), p.shape[0])
+        return f[:preemptive_max, :]
+    return ctx.f_pre[image]
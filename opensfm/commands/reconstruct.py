@@ -3,13 +3,24 @@ import time
 import glob
 import os
 import yaml
+import multiprocessing
+import Queue
+
+import numpy as np
 
 from opensfm import dataset
+from opensfm import matching
+from opensfm import precompute_cache
 from opensfm import reconstruction
 
 logger = logging.getLogger(__name__)
 
 
+# data loaded once by the parent process and shared with the experiment
+# processes through fork
+_shared = {}
+
+
 class Command:
     name = 'reconstruct'
     help = "Compute the reconstruction"
@@ -17,6 +28,8 @@ class Command:
     def add_arguments(self, parser):
         parser.add_argument('dataset', help='dataset to process')
         parser.add_argument('--experiments', help='tree of folders with config.yaml files for generating experiments')
+        parser.add_argument('--resume', action='store_true', help='continue an interrupted run from the reconstruction journal')
+        parser.add_argument('--experiment-processes', type=int, help='number of experiments to run at the same time (default: cpu count / processes)')
 
     def override_config(self,data,filepath):
         
@@ -49,41 +62,183 @@ class Command:
                 return
 
             # find yaml files in experiments directory
-            yamls = glob.glob( os.path.join(args.experiments,'*.yaml'))
+            yamls = sorted(glob.glob( os.path.join(args.experiments,'*.yaml')))
             if not yamls:
                 print 'No yaml files found in ', args.experiments
                 return
-            for yaml in yamls:
-
-                # setup
-                data = dataset.DataSet(args.dataset)
-                config_path = os.path.join(args.experiments,yaml)
-                self.override_config(data,config_path)
-                data.config['experiments_path'] = args.experiments
-                start = time.time()
-
-                # run recon
-                if data.config.get('tag_tracks',False) or data.config.get('resection_with_tags',False):
-                    reconstruction.incremental_reconstruction_with_tags(data)
-                else:
-                    reconstruction.incremental_reconstruction(data)
-
-                # shutdown
-                end = time.time()
-                reconstruction_name = data.reconstruction_name_from_settings()
-                log_path = os.path.join(args.experiments,reconstruction_name+'.log')
-                with open(log_path,'w') as fout:
-                    fout.write('reconstruct: {0}\n'.format(end-start))
+            self.run_experiments(args, data, yamls)
 
         # normal run
         else:
             # reconstruction type
             if data.config.get('tag_tracks',False) or data.config.get('resection_with_tags',False):
-                reconstruction.incremental_reconstruction_with_tags(data)
+                reconstruction.incremental_reconstruction_with_tags(data, args.resume)
             else:
-                reconstruction.incremental_reconstruction(data)
+                reconstruction.incremental_reconstruction(data, args.resume)
         
             # profile
             end = time.time()
             with open(data.profile_log(), 'a') as fout:
                 fout.write('reconstruct: {0}\n'.format(end - start))
+
+    def run_experiments(self, args, data, yamls):
+
+        # load tracks and common tracks once for all experiments
+        start = time.time()
+        graph = data.load_tracks_graph()
+        tracks, images = matching.tracks_and_images(graph)
+        if data.config.get('precompute_cache', False):
+            cache = precompute_cache.PrecomputeCache(data)
+            common_tracks = cache.common_tracks(graph, tracks)
+            pair_scores = cache.pair_scores()
+            reconstruction.compute_image_pairs(common_tracks, data.config, pair_scores)
+            cache.save_pair_scores(pair_scores)
+        else:
+            common_tracks = matching.all_common_tracks(graph, tracks)
+            pair_scores = {}
+            reconstruction.compute_image_pairs(common_tracks, data.config, pair_scores)
+        _shared['graph'] = graph
+        _shared['common_tracks'] = common_tracks
+        _shared['pair_scores'] = pair_scores
+        _shared['homography_threshold'] = data.config.get('homography_threshold', 0.004)
+        logger.info('Loaded tracks for {0} experiments in {1:.2f}s'.format(len(yamls), time.time() - start))
+
+        # number of experiments at the same time
+        processes = args.experiment_processes
+        if not processes:
+            processes = multiprocessing.cpu_count() // max(1, data.config.get('processes', 1))
+        processes = max(1, min(processes, len(yamls)))
+
+        # experiments with the same settings would write the same files
+        names = {}
+        for config_path in yamls:
+            experiment = dataset.DataSet(args.dataset)
+            self.override_config(experiment, config_path)
+            names.setdefault(experiment.reconstruction_name_from_settings(), []).append(config_path)
+        for name, paths in names.items():
+            if len(paths) > 1:
+                logger.warning('Experiments {0} have the same settings and write to {1}, running them one at a time'.format(
+                    ', '.join(paths), name))
+                processes = 1
+
+        # run experiments
+        results = []
+        if processes == 1:
+            for config_path in yamls:
+                results.append(self.run_experiment(args, config_path))
+        else:
+            results = self.run_experiment_processes(args, yamls, processes)
+        _shared.clear()
+
+        # summary
+        results = sorted(results, key=lambda x: x['name'])
+        lines = ['{0:<48} {1:>10} {2:>8} {3:>8} {4:>12} {5:>12}'.format(
+            'experiment', 'runtime', 'recons', 'shots', 'mean error', 'median error')]
+        for r in results:
+            lines.append('{0:<48} {1:>10.1f} {2:>8} {3:>8} {4:>12.4f} {5:>12.4f}'.format(
+                r['name'], r['runtime'], r['reconstructions'], r['shots'],
+                r['mean_error'], r['median_error']))
+        summary = '\n'.join(lines)
+        print summary
+        with open(os.path.join(args.experiments, 'summary.txt'), 'w') as fout:
+            fout.write(summary + '\n')
+
+    def run_experiment_processes(self, args, yamls, processes):
+        """Run the experiments in at most processes processes.
+
+        Experiments whose process dies without posting a result, e.g.
+        killed for running out of memory, are reported as failed.
+        """
+        queue = multiprocessing.Queue()
+        pending = list(yamls)
+        running = {}
+        results = {}
+        while pending or running:
+            while pending and len(running) < processes:
+                config_path = pending.pop(0)
+                p = multiprocessing.Process(target=_experiment_process, args=(self, args, config_path, queue))
+                p.start()
+                running[config_path] = p
+
+            try:
+                config_path, result = queue.get(timeout=1.0)
+                results[config_path] = result
+            except Queue.Empty:
+                pass
+
+            for config_path, p in running.items():
+                if p.is_alive():
+                    continue
+                p.join()
+                del running[config_path]
+                if config_path in results:
+                    continue
+                # a process that exited normally has posted its result
+                if p.exitcode == 0:
+                    try:
+                        while config_path not in results:
+                            path, result = queue.get(timeout=10.0)
+                            results[path] = result
+                        continue
+                    except Queue.Empty:
+                        pass
+                logger.error('Experiment {0} died with exit code {1}'.format(config_path, p.exitcode))
+                results[config_path] = _failed_result(config_path)
+        return [results[config_path] for config_path in yamls]
+
+    def run_experiment(self, args, config_path):
+
+        # setup
+        data = dataset.DataSet(args.dataset)
+        self.override_config(data,config_path)
+        data.config['experiments_path'] = os.path.abspath(args.experiments)
+        start = time.time()
+
+        # pair scores only hold for the same homography threshold
+        pair_scores = None
+        if data.config.get('homography_threshold', 0.004) == _shared['homography_threshold']:
+            pair_scores = dict(_shared['pair_scores'])
+
+        # run recon
+        if data.config.get('tag_tracks',False) or data.config.get('resection_with_tags',False):
+            reconstructions = reconstruction.incremental_reconstruction_with_tags(data, graph=_shared['graph'], common_tracks=_shared['common_tracks'], pair_scores=pair_scores)
+        else:
+            reconstructions = reconstruction.incremental_reconstruction(data, graph=_shared['graph'], common_tracks=_shared['common_tracks'], pair_scores=pair_scores)
+
+        # shutdown
+        end = time.time()
+        reconstruction_name = data.reconstruction_name_from_settings()
+        log_path = os.path.join(args.experiments,reconstruction_name+'.log')
+        with open(log_path,'w') as fout:
+            fout.write('reconstruct: {0}\n'.format(end-start))
+
+        # stats
+        errors = [p.reprojection_error for r in reconstructions for p in r.points.values() if p.reprojection_error is not None]
+        return {
+            'name': reconstruction_name,
+            'runtime': end - start,
+            'reconstructions': len(reconstructions),
+            'shots': sum(len(r.shots) for r in reconstructions),
+            'mean_error': np.mean(errors) if errors else float('nan'),
+            'median_error': np.median(errors) if errors else float('nan'),
+        }
+
+
+def _failed_result(config_path):
+    return {
+        'name': os.path.basename(config_path) + ' (failed)',
+        'runtime': float('nan'),
+        'reconstructions': 0,
+        'shots': 0,
+        'mean_error': float('nan'),
+        'median_error': float('nan'),
+    }
+
+
+def _experiment_process(command, args, config_path, queue):
+    try:
+        result = command.run_experiment(args, config_path)
+    except Exception:
+        logger.exception('Experiment {0} failed'.format(config_path))
+        result = _failed_result(config_path)
+    queue.put((config_path, result))
@@ -1,14 +1,8 @@
 import logging
 import time
-import networkx as nx
-from networkx.algorithms import bipartite
 import numpy as np
-try:
-    import matplotlib.pyplot as plt
-except:
-    pass
 from opensfm import dataset
-from opensfm import matching
+from opensfm import profiling
 
 logger = logging.getLogger(__name__)
 
@@ -35,8 +29,37 @@ class Command:
         # return
         return time
 
+    def print_profile(self, data):
+
+        # spans, counters and sizes of the last run of each command
+        events = profiling.load_events(data.profile_events_file())
+        if not events:
+            return
+        spans, counters, sizes = profiling.summarize(profiling.last_runs(events))
+
+        print '    Profile (seconds, peak memory in MB, last run of each command):'
+        print '      {:<48} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'span', 'count', 'total', 'p50', 'p90', 'p99', 'max', 'peak')
+        for name in sorted(spans):
+            s = spans[name]
+            peak = '{:.1f}'.format(s['rss_peak'] / 1e6) if 'rss_peak' in s else '-'
+            print '      {:<48} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9}'.format(
+                name, s['count'], s['total'], s['p50'], s['p90'], s['p99'], s['max'], peak)
+        print '      {:<48} {:>7}'.format('counter', 'value')
+        for name in sorted(counters):
+            print '      {:<48} {:>7}'.format(name, counters[name])
+        if sizes:
+            print '      {:<48} {:>7}'.format('size', 'max')
+            for name in sorted(sizes):
+                print '      {:<48} {:>7}'.format(name, sizes[name])
+
     def draw_tag_graph(self,tags_graph):
 
+        # plotting modules are slow to import and only needed here
+        import networkx as nx
+        from networkx.algorithms import bipartite
+        import matplotlib.pyplot as plt
+
         X, Y = bipartite.sets(tags_graph)
         pos = dict()
         pos.update( (n, (3*i, 1)) for i, n in enumerate(X) ) # put nodes from X at x=1
@@ -85,6 +108,9 @@ class Command:
             except:
                 pass
 
+        # Profile
+        self.print_profile(data)
+
         # Reconstruction Results
         try:
             reconstructions = data.load_reconstruction()
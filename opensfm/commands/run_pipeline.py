@@ -0,0 +1,35 @@
+import logging
+import sys
+
+from opensfm import dataset
+from opensfm import pipeline
+
+logger = logging.getLogger(__name__)
+
+
+class Command:
+    name = 'run_pipeline'
+    help = "Run the pipeline stages whose inputs or config changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='dataset to process')
+        parser.add_argument('--stages', nargs='+', metavar='STAGE',
+                            choices=[s.name for s in pipeline.STAGES],
+                            help='stages to run (default: {})'.format(
+                                ' '.join(pipeline.DEFAULT_STAGES)))
+        parser.add_argument('--force', nargs='+', default=[], metavar='STAGE',
+                            choices=[s.name for s in pipeline.STAGES],
+                            help='stages to run even if they are up to date')
+        parser.add_argument('--jobs', type=int, default=2,
+                            help='number of stages to run at the same time')
+
+    def run(self, args):
+        data = dataset.DataSet(args.dataset)
+        runner = pipeline.PipelineRunner(data, args.stages, args.jobs)
+        try:
+            finished = runner.run(args.force)
+        except RuntimeError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        logger.info('Ran {} stages: {}'.format(
+            len(finished), ' '.join(finished) or 'none'))
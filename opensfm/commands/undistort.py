@@ -1,4 +1,8 @@
+import collections
 import logging
+import Queue
+import threading
+import time
 from multiprocessing import Pool
 
 import cv2
@@ -30,66 +34,228 @@ class Command:
         data.save_undistorted_tracks_graph(graph)
 
     def undistort_images(self, graph, reconstruction, data):
-        urec = types.Reconstruction()
-        urec.points = reconstruction.points
-
-        logger.debug('Undistorting the reconstruction')
-        undistorted_shots = {}
-        for shot in reconstruction.shots.values():
-            if shot.camera.projection_type == 'perspective':
-                urec.add_camera(shot.camera)
-                urec.add_shot(shot)
-                undistorted_shots[shot.id] = [shot]
-            elif shot.camera.projection_type == 'fisheye':
-                shot.camera = perspective_camera_from_fisheye(shot.camera)
-                urec.add_camera(shot.camera)
-                urec.add_shot(shot)
-                undistorted_shots[shot.id] = [shot]
-            elif shot.camera.projection_type in ['equirectangular', 'spherical']:
-                subshot_width = int(data.config['depthmap_resolution'])
-                subshots = perspective_views_of_a_panorama(shot, subshot_width)
-                for subshot in subshots:
-                    urec.add_camera(subshot.camera)
-                    urec.add_shot(subshot)
-                    add_subshot_tracks(graph, shot, subshot)
-                undistorted_shots[shot.id] = subshots
-        data.save_undistorted_reconstruction([urec])
+        undistorted_shots = undistort_reconstruction(graph, reconstruction, data)
 
         arguments = []
         for shot in reconstruction.shots.values():
-            arguments.append((shot, undistorted_shots[shot.id], data))
+            arguments.append((shot, undistorted_shots[shot.id]))
 
-        processes = data.config['processes']
-        if processes == 1:
-            for arg in arguments:
-                undistort_image(arg)
-        else:
-            p = Pool(processes)
-            p.map(undistort_image, arguments)
+        undistort_images_pipeline(data, arguments)
 
 
-def undistort_image(arguments):
-    shot, undistorted_shots, data = arguments
-    logger.debug('Undistorting image {}'.format(shot.id))
+def undistort_reconstruction(graph, reconstruction, data):
+    """Save the undistorted reconstruction and add the subshot tracks.
 
+    Returns a dict from shot ids to their undistorted shots.
+    """
+    urec = types.Reconstruction()
+    urec.points = reconstruction.points
+
+    logger.debug('Undistorting the reconstruction')
+    undistorted_shots = {}
+    for shot in reconstruction.shots.values():
+        subshots = undistort_shot(shot, data)
+        for subshot in subshots:
+            urec.add_camera(subshot.camera)
+            urec.add_shot(subshot)
+            if subshot is not shot:
+                add_subshot_tracks(graph, shot, subshot)
+        undistorted_shots[shot.id] = subshots
+    data.save_undistorted_reconstruction([urec])
+    return undistorted_shots
+
+
+def undistort_shot(shot, data):
+    """Undistorted shots of a shot.
+
+    Fisheye shots get a perspective camera and panoramas are split into
+    perspective views.
+    """
     if shot.camera.projection_type == 'perspective':
-        image = data.image_as_array(shot.id)
-        undistorted = undistort_perspective_image(image, shot.camera)
-        data.save_undistorted_image(shot.id, undistorted)
+        return [shot]
     elif shot.camera.projection_type == 'fisheye':
-        image = data.image_as_array(shot.id)
-        undistorted = undistort_fisheye_image(image, shot.camera)
-        data.save_undistorted_image(shot.id, undistorted)
+        shot.camera = perspective_camera_from_fisheye(shot.camera)
+        return [shot]
     elif shot.camera.projection_type in ['equirectangular', 'spherical']:
-        original = data.image_as_array(shot.id)
         subshot_width = int(data.config['depthmap_resolution'])
+        return perspective_views_of_a_panorama(shot, subshot_width)
+    return []
+
+
+class _StageStats:
+    """Number of images through a pipeline stage and its time span."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.start = None
+        self.end = None
+        self.lock = threading.Lock()
+
+    def begin(self):
+        with self.lock:
+            if self.start is None:
+                self.start = time.time()
+
+    def done(self, count=1):
+        with self.lock:
+            self.count += count
+            self.end = time.time()
+
+    def report(self):
+        if self.start is None or self.end is None:
+            return
+        duration = max(self.end - self.start, 1e-6)
+        logger.info('undistort {}: {} images in {:.2f}s ({:.2f} images/s)'.format(
+            self.name, self.count, duration, self.count / duration))
+
+
+def undistort_images_pipeline(data, arguments):
+    """Read, undistort and write images with the three stages overlapped.
+
+    Reader threads decode the images, a process pool remaps them and
+    writer threads encode and save the results.  The stages are connected
+    by bounded queues, so at most a few undistort_queue_size images are in
+    memory whatever the speed of each stage.
+
+    Args:
+        data: the dataset
+        arguments: list of (shot, undistorted shots) tuples
+    """
+    processes = data.config['processes']
+    readers = data.config.get('undistort_read_threads', 4)
+    writers = data.config.get('undistort_write_threads', 4)
+    queue_size = max(1, data.config.get('undistort_queue_size', 16))
+    subshot_width = int(data.config['depthmap_resolution'])
+
+    read_stats = _StageStats('read')
+    remap_stats = _StageStats('remap')
+    write_stats = _StageStats('write')
+    errors = []
+
+    to_read = Queue.Queue()
+    for argument in arguments:
+        to_read.put(argument)
+    decoded = Queue.Queue(queue_size)
+    to_write = Queue.Queue(queue_size)
+
+    def read():
+        while True:
+            try:
+                shot, undistorted_shots = to_read.get_nowait()
+            except Queue.Empty:
+                break
+            read_stats.begin()
+            try:
+                image = read_image(data, shot, subshot_width)
+            except Exception as e:
+                errors.append(e)
+                image = None
+            read_stats.done()
+            decoded.put((shot, undistorted_shots, image))
+
+    def write():
+        while True:
+            item = to_write.get()
+            if item is None:
+                break
+            write_stats.begin()
+            try:
+                data.save_undistorted_image(*item)
+            except Exception as e:
+                errors.append(e)
+            write_stats.done()
+
+    # fork the remap processes before starting any thread
+    pool = Pool(processes) if processes > 1 else None
+
+    reader_threads = [threading.Thread(target=read) for i in range(readers)]
+    writer_threads = [threading.Thread(target=write) for i in range(writers)]
+    for thread in reader_threads + writer_threads:
+        thread.daemon = True
+        thread.start()
+
+    def output(undistorted):
+        for item in undistorted:
+            to_write.put(item)
+        remap_stats.done()
+
+    try:
+        pending = collections.deque()
+        for i in range(len(arguments)):
+            shot, undistorted_shots, image = decoded.get()
+            if image is None:
+                continue
+            remap_stats.begin()
+            if pool is None:
+                output(undistort_image_array(shot, undistorted_shots, image))
+            else:
+                if len(pending) >= queue_size:
+                    output(pending.popleft().get())
+                pending.append(pool.apply_async(
+                    undistort_image_array, (shot, undistorted_shots, image)))
+        while pending:
+            output(pending.popleft().get())
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for thread in writer_threads:
+            to_write.put(None)
+        for thread in writer_threads:
+            thread.join()
+
+    for stats in [read_stats, remap_stats, write_stats]:
+        stats.report()
+    if errors:
+        raise errors[0]
+
+
+def read_image(data, shot, subshot_width):
+    """Read the image of a shot, resized for panoramas."""
+    logger.debug('Reading image {}'.format(shot.id))
+    image = data.image_as_array(shot.id)
+    if shot.camera.projection_type in ['equirectangular', 'spherical']:
         width = 4 * subshot_width
         height = width / 2
-        image = cv2.resize(original, (width, height), interpolation=cv2.INTER_AREA)
-        for subshot in undistorted_shots:
-            undistorted = render_perspective_view_of_a_panorama(
-                image, shot, subshot)
-            data.save_undistorted_image(subshot.id, undistorted)
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    return image
+
+
+def undistort_image_array(shot, undistorted_shots, image):
+    """Undistort the image of a shot.
+
+    Returns a list of (undistorted shot id, undistorted image) tuples.
+    """
+    logger.debug('Undistorting image {}'.format(shot.id))
+
+    if shot.camera.projection_type == 'perspective':
+        undistorted = undistort_perspective_image(image, shot.camera)
+        return [(shot.id, undistorted)]
+    elif shot.camera.projection_type == 'fisheye':
+        undistorted = undistort_fisheye_image(image, shot.camera)
+        return [(shot.id, undistorted)]
+    elif shot.camera.projection_type in ['equirectangular', 'spherical']:
+        return [(subshot.id, render_perspective_view_of_a_panorama(image, shot, subshot))
+                for subshot in undistorted_shots]
+    return []
+
+
+def undistort_image(arguments):
+    shot, undistorted_shots, data = arguments
+    image = read_image(data, shot, int(data.config['depthmap_resolution']))
+    for shot_id, undistorted in undistort_image_array(shot, undistorted_shots, image):
+        data.save_undistorted_image(shot_id, undistorted)
+
+
+# Remap tables already computed by this process, by camera and image size
+_remap_cache = {}
+
+
+def _cached_maps(key, compute):
+    """Return the remap tables for key, computing them on first use."""
+    if key not in _remap_cache:
+        _remap_cache[key] = compute()
+    return _remap_cache[key]
 
 
 def undistort_perspective_image(image, camera):
@@ -97,7 +263,11 @@ def undistort_perspective_image(image, camera):
     height, width = image.shape[:2]
     K = camera.get_K_in_pixel_coordinates(width, height)
     distortion = np.array([camera.k1, camera.k2, 0, 0])
-    return cv2.undistort(image, K, distortion)
+    key = ('perspective', camera.id, camera.focal, camera.k1, camera.k2,
+           width, height)
+    map1, map2 = _cached_maps(key, lambda: cv2.initUndistortRectifyMap(
+        K, distortion, None, K, (width, height), cv2.CV_16SC2))
+    return cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
 
 
 def undistort_fisheye_image(image, camera):
@@ -105,7 +275,13 @@ def undistort_fisheye_image(image, camera):
     height, width = image.shape[:2]
     K = camera.get_K_in_pixel_coordinates(width, height)
     distortion = np.array([camera.k1, camera.k2, 0, 0])
-    return cv2.fisheye.undistortImage(image, K, distortion, K)
+    key = ('fisheye', camera.id, camera.focal, camera.k1, camera.k2,
+           width, height)
+    # Same maps as cv2.fisheye.undistortImage(image, K, distortion, K), where
+    # the last K is taken as the output image so no new camera matrix is used
+    map1, map2 = _cached_maps(key, lambda: cv2.fisheye.initUndistortRectifyMap(
+        K, distortion, np.eye(3), None, (width, height), cv2.CV_16SC2))
+    return cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
 
 
 def perspective_camera_from_fisheye(fisheye):
@@ -155,40 +331,60 @@ def perspective_views_of_a_panorama(spherical_shot, width):
 
 def render_perspective_view_of_a_panorama(image, panoshot, perspectiveshot):
     """Render a perspective view of a panorama."""
+    # The rotation between the panorama and its views is the same for all
+    # panoramas, so are the lookup maps for a given image size.  Rounding
+    # (and adding 0.0 to drop negative zeros) gives the same key to all.
+    rotation = np.dot(panoshot.pose.get_rotation_matrix(),
+                      perspectiveshot.pose.get_rotation_matrix().T)
+    camera = perspectiveshot.camera
+    key = ('panorama', panoshot.camera.projection_type,
+           image.shape[1], image.shape[0],
+           camera.width, camera.height, camera.focal,
+           (np.round(rotation, 9) + 0.0).tobytes())
+    src_x, src_y = _cached_maps(key, lambda: panorama_view_maps(
+        image.shape[1], image.shape[0], panoshot.camera, camera, rotation))
+
+    # Sample color
+    return cv2.remap(image, src_x, src_y, cv2.INTER_LINEAR)
+
+
+def panorama_view_maps(width, height, panocamera, perspectivecamera, rotation):
+    """Panorama pixel coordinates of the pixels of a perspective view.
+
+    Args:
+        width, height: size of the panorama image
+        panocamera: the panorama camera
+        perspectivecamera: the camera of the perspective view
+        rotation: rotation from the view to the panorama reference frame
+    """
     # Get destination pixel coordinates
-    dst_shape = (perspectiveshot.camera.height, perspectiveshot.camera.width)
+    dst_shape = (perspectivecamera.height, perspectivecamera.width)
     dst_y, dst_x = np.indices(dst_shape).astype(np.float32)
     dst_pixels_denormalized = np.column_stack([dst_x.ravel(), dst_y.ravel()])
 
     dst_pixels = features.normalized_image_coordinates(
         dst_pixels_denormalized,
-        perspectiveshot.camera.width,
-        perspectiveshot.camera.height)
+        perspectivecamera.width,
+        perspectivecamera.height)
 
     # Convert to bearing
-    dst_bearings = perspectiveshot.camera.pixel_bearings(dst_pixels)
+    dst_bearings = perspectivecamera.pixel_bearings(dst_pixels)
 
     # Rotate to panorama reference frame
-    rotation = np.dot(panoshot.pose.get_rotation_matrix(),
-                      perspectiveshot.pose.get_rotation_matrix().T)
     rotated_bearings = np.dot(dst_bearings, rotation.T)
 
     # Project to panorama pixels
-    src_x, src_y = panoshot.camera.project((rotated_bearings[:, 0],
-                                            rotated_bearings[:, 1],
-                                            rotated_bearings[:, 2]))
+    src_x, src_y = panocamera.project((rotated_bearings[:, 0],
+                                       rotated_bearings[:, 1],
+                                       rotated_bearings[:, 2]))
     src_pixels = np.column_stack([src_x.ravel(), src_y.ravel()])
 
     src_pixels_denormalized = features.denormalized_image_coordinates(
-        src_pixels, image.shape[1], image.shape[0])
+        src_pixels, width, height)
 
-    # Sample color
-    colors = cv2.remap(image,
-                       src_pixels_denormalized[:, 0].astype(np.float32),
-                       src_pixels_denormalized[:, 1].astype(np.float32),
-                       cv2.INTER_LINEAR)
-    colors.shape = dst_shape + (-1,)
-    return colors
+    map_x = src_pixels_denormalized[:, 0].astype(np.float32).reshape(dst_shape)
+    map_y = src_pixels_denormalized[:, 1].astype(np.float32).reshape(dst_shape)
+    return map_x, map_y
 
 
 def add_subshot_tracks(graph, panoshot, perspectiveshot):
@@ -0,0 +1,287 @@
+import collections
+import copy
+import logging
+import os
+import time
+from multiprocessing import Process
+
+import numpy as np
+
+from opensfm import dataset
+from opensfm import dense
+from opensfm import profiling
+from opensfm import work_queue
+from opensfm.commands import detect_features
+from opensfm.commands import detect_tags
+from opensfm.commands import match_features
+from opensfm.commands import undistort
+
+logger = logging.getLogger(__name__)
+
+# Stages that can be submitted and the planning tasks they add
+SUBMIT_STAGES = ['detect_tags', 'detect_features', 'match_features',
+                 'undistort', 'compute_depthmaps']
+
+# Stages whose tasks wait for all the tasks of other stages
+STAGE_DEPENDENCIES = {
+    'detect_tags_merge': ['detect_tags'],
+    'detect_features': ['detect_tags_merge'],
+    'match_candidates': ['detect_features'],
+    'match_features': ['match_candidates'],
+    'undistort_image': ['undistort'],
+    'compute_depthmaps': ['undistort', 'undistort_image'],
+    'compute_depthmap': ['compute_depthmaps'],
+    'clean_depthmap': ['compute_depthmap'],
+    'merge_depthmaps': ['clean_depthmap'],
+}
+
+
+class Command:
+    name = 'worker'
+    help = 'Run tasks from the work queue of a dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='dataset to process')
+        parser.add_argument('--submit', nargs='+', default=[], metavar='STAGE',
+                            choices=SUBMIT_STAGES,
+                            help='stages to add to the queue before working '
+                            '(choices: {})'.format(' '.join(SUBMIT_STAGES)))
+        parser.add_argument('--processes', type=int, default=1,
+                            help='number of local worker processes')
+        parser.add_argument('--reset', action='store_true',
+                            help='remove all the tasks of the queue first')
+
+    def run(self, args):
+        data = dataset.DataSet(args.dataset)
+        queue = open_work_queue(data)
+        if args.reset:
+            queue.reset()
+        submit(data, queue, args.submit)
+
+        start = time.time()
+        run_workers(args.dataset, args.processes)
+        end = time.time()
+
+        for stage, counts in sorted(queue.counts().items()):
+            logger.info('{}: {}'.format(stage, ', '.join(
+                '{} {}'.format(n, state) for state, n in sorted(counts.items()))))
+        for stage, key, error in queue.failed_tasks():
+            logger.error('Failed {} {}: {}'.format(stage, key, error))
+        queue.close()
+
+        with open(data.profile_log(), 'a') as fout:
+            fout.write('worker: {0}\n'.format(end - start))
+
+
+def open_work_queue(data):
+    """Open the work queue of a dataset and declare the stage dependencies."""
+    queue = work_queue.WorkQueue(
+        data.work_queue_file(),
+        data.config.get('work_queue_lease_time', 60),
+        data.config.get('work_queue_max_attempts', 3))
+    for stage, dependencies in STAGE_DEPENDENCIES.items():
+        queue.add_stage_dependencies(stage, dependencies)
+    return queue
+
+
+def submit(data, queue, stages):
+    """Add the tasks of the given stages to the queue.
+
+    Per image stages get a task per image.  The other stages get a single
+    planning task that adds the tasks of the stage once its inputs exist.
+    """
+    images = data.images()
+    if 'detect_tags' in stages:
+        queue.add_many('detect_tags', [(image, None) for image in images])
+        queue.add('detect_tags_merge', 'all')
+    if 'detect_features' in stages:
+        queue.add_many('detect_features', [(image, None) for image in images])
+    if 'match_features' in stages:
+        queue.add('match_candidates', 'all')
+    if 'undistort' in stages:
+        queue.add('undistort', 'all')
+    if 'compute_depthmaps' in stages:
+        queue.add('compute_depthmaps', 'all')
+
+
+def run_workers(data_path, processes):
+    """Run local workers until the queue of the dataset is empty."""
+    if processes <= 1:
+        _worker_process(data_path)
+        return
+    workers = [Process(target=_worker_process, args=(data_path,))
+               for i in range(processes)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+
+def _worker_process(data_path):
+    data = dataset.DataSet(data_path)
+    queue = open_work_queue(data)
+    work_queue.run_worker(queue, TaskHandlers(data).handlers())
+    queue.close()
+
+
+class TaskHandlers(object):
+    """Functions running the tasks of each stage on a dataset.
+
+    The inputs shared by the tasks of a stage are loaded on first use and
+    kept for the next tasks run by the same worker.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._cache = {}
+
+    def handlers(self):
+        return {
+            'detect_tags': self.detect_tags,
+            'detect_tags_merge': self.detect_tags_merge,
+            'detect_features': self.detect_features,
+            'match_candidates': self.match_candidates,
+            'match_features': self.match_features,
+            'undistort': self.undistort,
+            'undistort_image': self.undistort_image,
+            'compute_depthmaps': self.compute_depthmaps,
+            'compute_depthmap': self.compute_depthmap,
+            'clean_depthmap': self.clean_depthmap,
+            'merge_depthmaps': self.merge_depthmaps,
+        }
+
+    def _cached(self, name, load):
+        if name not in self._cache:
+            self._cache[name] = load()
+        return self._cache[name]
+
+    def detect_tags(self, queue, task):
+        if self.data.config.get('use_apriltags', False):
+            tag_detections_dir = os.path.join(self.data.data_path, 'tag_detections')
+            if not os.path.exists(tag_detections_dir):
+                try:
+                    os.makedirs(tag_detections_dir)
+                except OSError:
+                    pass  # created by another worker
+            detect_tags.apriltag_detect((task.key, self.data.data_path))
+
+    def detect_tags_merge(self, queue, task):
+        detect_tags.merge_tag_detections(self.data, self.data.images())
+        self._cache.pop('tag_detections', None)
+
+    def detect_features(self, queue, task):
+        def tag_detections():
+            try:
+                return self.data.load_tag_detection()
+            except:
+                return {}
+        tags = self._cached('tag_detections', tag_detections)
+        detect_features.detect((task.key, tags.get(task.key, []), self.data))
+
+    def match_candidates(self, queue, task):
+        images = self.data.images()
+        exifs = {im: self.data.load_exif(im) for im in images}
+        pairs = match_features.match_candidates(self.data, images, exifs, 1)
+        queue.add_many('match_features', [
+            (im, {'candidates': pairs[im], 'index': i, 'count': len(pairs)})
+            for i, im in enumerate(sorted(pairs))])
+
+    def match_features(self, queue, task):
+        def context():
+            ctx = match_features.Context()
+            ctx.data = self.data
+            ctx.cameras = self.data.load_camera_models()
+            ctx.exifs = {}
+            ctx.p_pre, ctx.f_pre = {}, {}
+            return ctx
+        ctx = self._cached('match_context', context)
+        candidates = task.payload['candidates']
+        for im in [task.key] + candidates:
+            if im not in ctx.exifs:
+                ctx.exifs[im] = self.data.load_exif(im)
+        match_features.match((task.key, candidates, task.payload['index'],
+                              task.payload['count'], ctx))
+
+    def undistort(self, queue, task):
+        reconstructions = self.data.load_reconstruction()
+        graph = self.data.load_tracks_graph()
+        if reconstructions:
+            undistort.undistort_reconstruction(graph, reconstructions[0], self.data)
+            queue.add_many('undistort_image', [
+                (shot_id, None) for shot_id in sorted(reconstructions[0].shots)])
+        self.data.save_undistorted_tracks_graph(graph)
+
+    def undistort_image(self, queue, task):
+        reconstruction = self._cached(
+            'reconstruction', lambda: self.data.load_reconstruction()[0])
+        shot = reconstruction.shots[task.key]
+        # undistort_shot replaces the camera of fisheye shots
+        undistorted_shots = undistort.undistort_shot(copy.copy(shot), self.data)
+        undistort.undistort_image((shot, undistorted_shots, self.data))
+
+    def _undistorted_reconstruction(self):
+        return self._cached(
+            'undistorted_reconstruction',
+            lambda: self.data.load_undistorted_reconstruction()[0])
+
+    def _undistorted_graph(self):
+        return self._cached(
+            'undistorted_graph', self.data.load_undistorted_tracks_graph)
+
+    def compute_depthmaps(self, queue, task):
+        data = self.data
+        reconstruction = self._undistorted_reconstruction()
+        graph = self._undistorted_graph()
+        neighbors = dense.compute_depthmap_neighbors(data, graph, reconstruction)
+
+        compute_tasks = []
+        clean_tasks = []
+        for shot in reconstruction.shots.values():
+            if len(neighbors[shot.id]) <= 1:
+                continue
+            min_depth, max_depth, tag_planes = dense.compute_depthmap_priors(
+                data, graph, reconstruction, shot)
+            neighbor_ids = [n.id for n in neighbors[shot.id]]
+            compute_tasks.append((shot.id, {
+                'neighbors': neighbor_ids,
+                'min_depth': float(min_depth),
+                'max_depth': float(max_depth),
+                'tag_planes': [[plane.tolist(), corners.tolist()]
+                               for plane, corners in tag_planes],
+            }))
+            clean_tasks.append((shot.id, {'neighbors': neighbor_ids}))
+        queue.add_many('compute_depthmap', sorted(compute_tasks))
+        queue.add_many('clean_depthmap', sorted(clean_tasks))
+        # the merger prunes the views in the order they are added, so
+        # the shots are kept in the order used by dense.compute_depthmaps
+        queue.add('merge_depthmaps', 'all', {
+            'shots': list(neighbors),
+            'neighbors': {shot_id: [n.id for n in shots]
+                          for shot_id, shots in neighbors.items()}})
+
+    def _shots(self, shot_ids):
+        reconstruction = self._undistorted_reconstruction()
+        return [reconstruction.shots[shot_id] for shot_id in shot_ids]
+
+    def compute_depthmap(self, queue, task):
+        payload = task.payload
+        shot, = self._shots([task.key])
+        tag_planes = [(np.array(plane), np.array(corners))
+                      for plane, corners in payload['tag_planes']]
+        dense.compute_depthmap((self.data, self._shots(payload['neighbors']),
+                                payload['min_depth'], payload['max_depth'],
+                                shot, tag_planes))
+
+    def clean_depthmap(self, queue, task):
+        shot, = self._shots([task.key])
+        dense.clean_depthmap((self.data, self._shots(task.payload['neighbors']),
+                              shot))
+
+    def merge_depthmaps(self, queue, task):
+        payload = task.payload
+        neighbors = collections.OrderedDict(
+            (shot_id, self._shots(payload['neighbors'][shot_id]))
+            for shot_id in payload['shots'])
+        with profiling.span('merge_depthmaps'):
+            dense.merge_depthmaps(self.data, self._undistorted_graph(),
+                                  self._undistorted_reconstruction(), neighbors)
@@ -62,6 +62,10 @@ triangulation_threshold: 0.006        # Outlier threshold (in pixels) for accept
 triangulation_min_ray_angle: 1.0
 resection_threshold: 0.004            # Outlier threshold (in pixels) for camera resection.
 resection_min_inliers: 10             # Minimum number of resection inliers to accept it.
+lazy_pair_scoring: no                 # Score bootstrap pair candidates in batches, only until a bootstrap succeeds.
+lazy_pair_batch_size: 16              # Number of pair candidates scored at once in lazy mode.
+precompute_cache: no                  # Cache common tracks, pair scores and tag components between runs.
+precompute_cache_size: 512            # Maximum size of the precompute cache in MB.
 retriangulation: no
 retriangulation_ratio: 1.25
 
@@ -80,8 +84,12 @@ bundle_interval: 0              # Bundle after adding 'bundle_interval' cameras
 bundle_new_points_ratio: 1.2    # Bundle when (new points) / (bundled points) > bundle_outlier_threshold
 optimize_camera_parameters: yes # Optimize internal camera parameters during bundle
 local_bundle_radius: 0          # Max image graph distance for images to be included in local bundle adjustment
+extension_bundle_radius: 1      # Max image graph distance for images to be included in the local bundle adjustment of the images added by extend
 
+reconstruction_format: json      # json, binary (packed points, loaded lazily) or both. The newest file is loaded.
 save_partial_reconstructions: no
+partial_reconstructions_format: journal  # journal (append-only changes, resumable with reconstruct --resume) or json (timestamped full copies)
+journal_snapshot_interval: 100           # Number of journal records between compacted snapshots
 
 # Params for GPS aligment
 use_altitude_tag: no                  # Use or ignore EXIF altitude tag
@@ -113,9 +121,21 @@ depthmap_min_correlation_score: 0.7   # Minimum correlation score to accept a de
 depthmap_same_depth_threshold: 0.005  # Threshold to measure depth closeness
 depthmap_min_consistent_views: 3      # Min number of views that should reconstruct a point for it to be valid
 depthmap_save_debug_files: no         # Save debug files with partial reconstruction results
+depthmap_view_cache: yes              # Save gray and color images at depthmap resolution once per shot before computing depthmaps
+depthmap_tag_priors: no               # Use the planes of the tags seen by a shot to tighten its depth range and seed PatchMatch
+depthmap_tag_depth_margin: 0.05       # Relative margin around the depths of the sparse points and tag corners
+depthmap_tag_prior_iterations: 2      # Number of PatchMatch iterations to run on shots seeded with tag planes
+depthmap_tag_prior_min_coverage: 0.5  # Fraction of the image the tag planes must cover to run depthmap_tag_prior_iterations
+depthmap_merge_chunk_size: 0          # Side of the voxels grouping shots by camera center to merge depthmaps by chunks (0 merges all depthmaps at once)
+depthmap_storage: npz                 # Depthmap files format: npz (compressed) or npy (uncompressed and memory mapped)
+depthmap_precision: float32           # Precision of the stored depthmaps: float32 or float16 (float16 depth and score, int8 quantized normals)
 
 # Other params
 processes: 40                  # Number of threads to use
+undistort_read_threads: 4      # Number of threads reading images in undistort
+undistort_write_threads: 4     # Number of threads writing undistorted images
+undistort_queue_size: 16       # Maximum number of images waiting between two undistort stages
+ply_format: ascii              # Format of the exported PLY files: ascii or binary (little endian)
 
 # Params for submodel split and merge
 submodels_relpath: "submodels"                                      # Relative path to the submodels directory
@@ -130,6 +150,7 @@ use_chromatag: no                  # ChromaTags will be detected and used for re
 tag_tracks: no                     # creates tag tracks from 3D features. This is the first steps of tag sfm and must be on for anything else to work
 optimize_with_tag_tracks: no       # if off, tag tracks are triangulated, but not used for anything else
 resection_with_tags: no            # if on, resectioning uses the tag graph
+resection_tag_pnp: no              # if on, resection first tries a PnP pose from reconstructed tag corners before RANSAC
 tag_size: 0.1                      # size of the tags in the data in meters (e.g. 0.1 meters)
 ba_constraint_size: no             # Bundle Adjustment constraint for tag size
 ba_constraint_ortho: no            # Bundle Adjustment constraint for tag orthogonality
@@ -140,6 +161,16 @@ tag_reprojection_error_sd: 0.004   # The standard deviation of the tag reproject
 tag_loss_function: SoftLOneLoss     # Loss function for the ceres problem (see: http://ceres-solver.org/modeling.html#lossfunction)
 tag_loss_function_threshold: 1      # Threshold on the squared residuals.  Usually cost is quadratic for smaller residuals and sub-quadratic above.
 ratio_tags_to_keep: 1.0         # 1.0 means all tags are kept, 0.0 means all tags are ignored. This is used for experimentation on density of tags
+
+# Params for profiling
+profiling: no                      # Write timing spans and counters of the commands to profile.jsonl
+memory_profiling: no               # Also record the peak memory of the spans and the size of the main structures
+memory_profiling_interval: 0.1     # Seconds between two samples of the memory of a process
+memory_profiling_tracemalloc: no   # Trace allocations with tracemalloc, if available, for the snapshots written on SIGUSR1
+
+# Params for the workers
+work_queue_lease_time: 60          # Seconds a worker holds a task without heartbeat before it is given to another worker
+work_queue_max_attempts: 3         # Number of times a task is tried before it is marked as failed
 '''
 
 
@@ -5,13 +5,15 @@ import json
 import errno
 import pickle
 import gzip
+import hashlib
 import numpy as np
-import networkx as nx
 import cv2
 
 from opensfm import io
+from opensfm import binary_reconstruction
 from opensfm import config
 from opensfm import context
+from opensfm import profiling
 
 
 class DataSet:
@@ -72,6 +74,15 @@ class DataSet:
         """Return image pixels as 3-dimensional numpy array (R G B order)"""
         return io.imread(self.__image_file(image))
 
+    def image_stat(self, image):
+        """Return the size and modification time of an image file"""
+        stat = os.stat(self.__image_file(image))
+        return stat.st_size, stat.st_mtime
+
+    def image_digest(self, image):
+        """Return sha1 hex digest of an image file"""
+        return file_digest(self.__image_file(image))
+
     def _undistorted_image_path(self):
         return os.path.join(self.data_path, 'undistorted')
 
@@ -111,29 +122,57 @@ class DataSet:
         return os.path.join(self._depthmap_path(), image + '.' + suffix)
 
     def raw_depthmap_exists(self, image):
-        return os.path.isfile(self._depthmap_file(image, 'raw.npz'))
+        return io.depthmap_channels_exist(self._depthmap_file(image, 'raw'))
 
     def save_raw_depthmap(self, image, depth, plane, score, nghbr, nghbrs):
-        io.mkdir_p(self._depthmap_path())
-        filepath = self._depthmap_file(image, 'raw.npz')
-        np.savez_compressed(filepath, depth=depth, plane=plane, score=score, nghbr=nghbr, nghbrs=nghbrs)
+        self.__save_depthmap(image, 'raw', depth=depth, plane=plane, score=score,
+                             nghbr=nghbr, nghbrs=nghbrs)
 
     def load_raw_depthmap(self, image):
-        o = np.load(self._depthmap_file(image, 'raw.npz'))
+        o = io.DepthmapChannels(self._depthmap_file(image, 'raw'))
         return o['depth'], o['plane'], o['score'], o['nghbr'], o['nghbrs']
 
+    def load_raw_depth(self, image):
+        """Load only the depth channel of a raw depthmap."""
+        return io.DepthmapChannels(self._depthmap_file(image, 'raw'))['depth']
+
     def clean_depthmap_exists(self, image):
-        return os.path.isfile(self._depthmap_file(image, 'clean.npz'))
+        return io.depthmap_channels_exist(self._depthmap_file(image, 'clean'))
 
     def save_clean_depthmap(self, image, depth, plane, score):
-        io.mkdir_p(self._depthmap_path())
-        filepath = self._depthmap_file(image, 'clean.npz')
-        np.savez_compressed(filepath, depth=depth, plane=plane, score=score)
+        self.__save_depthmap(image, 'clean', depth=depth, plane=plane, score=score)
 
     def load_clean_depthmap(self, image):
-        o = np.load(self._depthmap_file(image, 'clean.npz'))
+        o = io.DepthmapChannels(self._depthmap_file(image, 'clean'))
         return o['depth'], o['plane'], o['score']
 
+    def __save_depthmap(self, image, kind, **channels):
+        """Save depthmap channels with the configured storage and precision."""
+        io.mkdir_p(self._depthmap_path())
+        io.save_depthmap_channels(
+            self._depthmap_file(image, kind), channels,
+            self.config.get('depthmap_storage', 'npz'),
+            self.config.get('depthmap_precision', 'float32'))
+
+    def __depthmap_view_file(self, image, resolution, kind):
+        return self._depthmap_file(image, 'view{}.{}.npy'.format(resolution, kind))
+
+    def depthmap_view_exists(self, image, resolution):
+        return (os.path.isfile(self.__depthmap_view_file(image, resolution, 'gray')) and
+                os.path.isfile(self.__depthmap_view_file(image, resolution, 'color')))
+
+    def save_depthmap_view(self, image, resolution, gray, color):
+        """Save the gray and color images of a shot at depthmap resolution."""
+        io.mkdir_p(self._depthmap_path())
+        np.save(self.__depthmap_view_file(image, resolution, 'gray'), gray)
+        np.save(self.__depthmap_view_file(image, resolution, 'color'), color)
+
+    def load_depthmap_view(self, image, resolution):
+        """Memory map the gray and color images of a shot at depthmap resolution."""
+        gray = np.load(self.__depthmap_view_file(image, resolution, 'gray'), mmap_mode='r')
+        color = np.load(self.__depthmap_view_file(image, resolution, 'color'), mmap_mode='r')
+        return gray, color
+
     @staticmethod
     def __is_image_file(filename):
         return filename.split('.')[-1].lower() in {'jpg', 'jpeg', 'png', 'tif', 'tiff', 'pgm', 'pnm', 'gif'}
@@ -280,6 +319,15 @@ class DataSet:
     def save_tag_features(self, image, points, ids, idx, colors):
         self.__save_tag_features(self.__tag_feature_file(image), image, points, ids, idx, colors)
 
+    def remove_features(self, image):
+        """Remove the features, preemptive features, index and tag features of an image"""
+        for filename in [self.__feature_file(image),
+                         self.__preemptive_features_file(image),
+                         self.__feature_index_file(image),
+                         self.__tag_feature_file(image)]:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
     def feature_index_exists(self, image):
         return os.path.isfile(self.__feature_index_file(image))
 
@@ -396,6 +444,14 @@ class DataSet:
         with open(self.__tags_graph_file(filename), 'w') as fout:
             save_tags_graph(fout, graph)
 
+    def tracks_graph_digest(self, filename=None):
+        """Return sha1 hex digest of the tracks file"""
+        return file_digest(self.__tracks_graph_file(filename))
+
+    def tags_graph_digest(self, filename=None):
+        """Return sha1 hex digest of the tag graph file"""
+        return file_digest(self.__tags_graph_file(filename))
+
     def load_undistorted_tracks_graph(self):
         return self.load_tracks_graph('undistorted_tracks.csv')
 
@@ -418,6 +474,15 @@ class DataSet:
         with open(self.__tag_detection_file(filename), 'w') as fout:
             io.json_dump(io.images_with_tag_detections_to_json(images_with_tag_detections), fout)
 
+    def remove_tag_detection(self, image=None):
+        """Remove the tag detections of an image, or the merged tag detections"""
+        if image is None:
+            filename = self.__tag_detection_file(None)
+        else:
+            filename = self.__tag_detection_file(os.path.join('tag_detections', image + '.json'))
+        if os.path.isfile(filename):
+            os.remove(filename)
+
     def __reconstruction_file(self, filename):
         """Return path of reconstruction file"""
         return os.path.join(self.data_path, filename or 'reconstruction.json')
@@ -454,17 +519,107 @@ class DataSet:
         # return
         return name 
 
+    def __reconstruction_binary_file(self, filename):
+        """Return path of the binary version of a reconstruction file"""
+        path = self.__reconstruction_file(filename)
+        if path.endswith('.gz'):
+            path = path[:-3]
+        return os.path.splitext(path)[0] + '.bin'
+
     def reconstruction_exists(self, filename=None):
-        return os.path.isfile(self.__reconstruction_file(filename))
+        return (os.path.isfile(self.__reconstruction_file(filename)) or
+                os.path.isfile(self.__reconstruction_binary_file(filename)))
 
     def load_reconstruction(self, filename=None):
-        with open(self.__reconstruction_file(filename)) as fin:
+        """Return the reconstructions from the newest of the json or binary file.
+
+        Points of a binary file are only loaded when first accessed.
+        """
+        json_file = self.__reconstruction_file(filename)
+        binary_file = self.__reconstruction_binary_file(filename)
+        if os.path.isfile(binary_file) and (
+                not os.path.isfile(json_file) or
+                os.path.getmtime(binary_file) >= os.path.getmtime(json_file)):
+            return binary_reconstruction.read_reconstructions(binary_file)
+        with _open_json(json_file, 'r') as fin:
             reconstructions = io.reconstructions_from_json(json.load(fin))
         return reconstructions
 
-    def save_reconstruction(self, reconstruction, filename=None, minify=False):
-        with open(self.__reconstruction_file(filename), 'w') as fout:
-            io.json_dump(io.reconstructions_to_json(reconstruction), fout, minify)
+    def save_reconstruction(self, reconstruction, filename=None, minify=False, file_format=None):
+        """Save reconstructions as json, binary or both.
+
+        The format defaults to the reconstruction_format config value.
+        The json is streamed to the file, gzipped if filename ends in .gz.
+        """
+        file_format = file_format or self.config.get('reconstruction_format', 'json')
+        if file_format in ('binary', 'both'):
+            binary_reconstruction.write_reconstructions(
+                reconstruction, self.__reconstruction_binary_file(filename))
+        if file_format in ('json', 'both'):
+            with _open_json(self.__reconstruction_file(filename), 'w') as fout:
+                io.json_dump_reconstructions(reconstruction, fout, minify)
+
+    def __reconstruction_journal_prefix(self):
+        """Return path prefix of the journal files, per experiment if running one"""
+        if self.config.get('experiments_path'):
+            name = os.path.splitext(self.reconstruction_name_from_settings())[0]
+            return os.path.join(self.config['experiments_path'], name)
+        return os.path.join(self.data_path, 'reconstruction')
+
+    def reconstruction_journal_file(self):
+        """Path of the journal of the reconstruction being grown."""
+        return self.__reconstruction_journal_prefix() + '.journal'
+
+    def reconstruction_snapshot_file(self):
+        """Path of the last snapshot of the reconstruction being grown."""
+        return self.__reconstruction_journal_prefix() + '.snapshot.json'
+
+    def __localization_index_file(self):
+        """Return path of the descriptor index of the reconstructed points"""
+        return os.path.join(self.data_path, 'localization_index.npz')
+
+    def __newer_than_reconstruction(self, path):
+        """Whether a file exists and is newer than the reconstruction"""
+        if not os.path.isfile(path):
+            return False
+        for filename in [self.__reconstruction_file(None),
+                         self.__reconstruction_binary_file(None)]:
+            if (os.path.isfile(filename) and
+                    os.path.getmtime(filename) > os.path.getmtime(path)):
+                return False
+        return True
+
+    def localization_index_exists(self):
+        """Whether the localization index exists and is newer than the reconstruction"""
+        return self.__newer_than_reconstruction(self.__localization_index_file())
+
+    def load_localization_index(self):
+        s = np.load(self.__localization_index_file())
+        return s['reconstruction'], s['tracks'], s['points'], s['descriptors']
+
+    def save_localization_index(self, reconstruction_index, tracks, points, descriptors):
+        np.savez(self.__localization_index_file(),
+                 reconstruction=reconstruction_index,
+                 tracks=tracks,
+                 points=points,
+                 descriptors=descriptors)
+
+    def __tag_map_file(self):
+        """Return path of the map of the reconstructed tag corners"""
+        return os.path.join(self.data_path, 'tag_map.json')
+
+    def tag_map_exists(self):
+        """Whether the tag map exists and is newer than the reconstruction"""
+        return self.__newer_than_reconstruction(self.__tag_map_file())
+
+    def load_tag_map(self):
+        """Return the index of the reconstruction of the tag map, the tag map, from tag ids to 4x3 corners, and its cameras"""
+        with open(self.__tag_map_file()) as fin:
+            return io.tag_map_from_json(json.load(fin))
+
+    def save_tag_map(self, reconstruction_index, tag_map, cameras):
+        with open(self.__tag_map_file(), 'w') as fout:
+            io.json_dump(io.tag_map_to_json(reconstruction_index, tag_map, cameras), fout)
 
     def load_undistorted_reconstruction(self):
         return self.load_reconstruction(
@@ -543,6 +698,22 @@ class DataSet:
         "Filename where to write timings."
         return os.path.join(self.data_path, 'profile.log')
 
+    def profile_events_file(self):
+        "File where the timing spans and counters are written, see profiling."
+        return os.path.join(self.data_path, profiling.PROFILE_FILE)
+
+    def precompute_cache_path(self):
+        "Folder where reconstruction precomputations are cached."
+        return os.path.join(self.data_path, 'cache')
+
+    def pipeline_state_file(self):
+        "File where the pipeline runner records the stage fingerprints."
+        return os.path.join(self.data_path, 'pipeline_state.json')
+
+    def work_queue_file(self):
+        "SQLite database holding the tasks of the workers."
+        return os.path.join(self.data_path, 'work_queue.db')
+
     def __navigation_graph_file(self):
         "Return the path of the navigation graph."
         return os.path.join(self.data_path, 'navigation_graph.json')
@@ -554,11 +725,21 @@ class DataSet:
     def __ply_file(self, filename):
         return os.path.join(self.data_path, filename or 'reconstruction.ply')
 
-    def save_ply(self, reconstruction, filename=None):
-        """Save a reconstruction in PLY format"""
-        ply = io.reconstruction_to_ply(reconstruction)
-        with open(self.__ply_file(filename), 'w') as fout:
-            fout.write(ply)
+    def save_ply(self, reconstruction, filename=None, binary=None):
+        """Save a reconstruction in PLY format
+
+        Binary or ascii depending on binary, or the ply_format config value.
+        """
+        if binary is None:
+            binary = self.config.get('ply_format', 'ascii') == 'binary'
+        if binary:
+            points, colors = io.reconstruction_to_ply_arrays(reconstruction)
+            with open(self.__ply_file(filename), 'wb') as fout:
+                io.write_binary_ply(fout, points, colors)
+        else:
+            ply = io.reconstruction_to_ply(reconstruction)
+            with open(self.__ply_file(filename), 'w') as fout:
+                fout.write(ply)
 
     def __ground_control_points_file(self):
         return os.path.join(self.data_path, 'gcp_list.txt')
@@ -579,7 +760,24 @@ class DataSet:
                 fin, self.load_reference_lla(), exif)
 
 
+def _open_json(filename, mode):
+    """Open a json file for streaming, gzipped if its name ends in .gz."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 'b')
+    return open(filename, mode, 1 << 20)
+
+
+def file_digest(filename):
+    """Return the sha1 hex digest of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def load_tracks_graph(fileobj):
+    import networkx as nx  # slow to import, only loaded when needed
     g = nx.Graph()
     for line in fileobj:
         image, track, observation, x, y, R, G, B, on_tag, tagid, cid = line.split('\t')
@@ -596,6 +794,7 @@ def load_tracks_graph(fileobj):
     return g
 
 def load_tags_graph(fileobj):
+    import networkx as nx  # slow to import, only loaded when needed
     g = nx.Graph()
     for line in fileobj:
         image, tagid = line.split('\t')
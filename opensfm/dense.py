@@ -1,12 +1,16 @@
 
+import heapq
 import logging
+import Queue
 from multiprocessing import Pool
 
 import cv2
 import numpy as np
 
 from opensfm import csfm
+from opensfm import io
 from opensfm import matching
+from opensfm import profiling
 
 
 logger = logging.getLogger(__name__)
@@ -14,8 +18,56 @@ logger = logging.getLogger(__name__)
 
 def compute_depthmaps(data, graph, reconstruction):
     """Compute and refine depthmaps for all shots."""
-    logger.info('Computing neighbors')
     processes = data.config.get('processes', 1)
+    neighbors = compute_depthmap_neighbors(data, graph, reconstruction)
+
+    if data.config.get('depthmap_view_cache', True):
+        logger.info('Preparing depthmap views')
+        arguments = [(data, shot) for shot in reconstruction.shots.values()]
+        parallel_run(prepare_depthmap_view, arguments, processes)
+
+    # Clean a depthmap as soon as the raw depthmaps of its neighbors are
+    # computed, and load it for merging as soon as it is cleaned
+    tasks = {}
+    for shot in reconstruction.shots.values():
+        if len(neighbors[shot.id]) <= 1:
+            continue
+        min_depth, max_depth, tag_planes = compute_depthmap_priors(
+            data, graph, reconstruction, shot)
+        tasks['compute', shot.id] = (
+            compute_depthmap_catched,
+            (data, neighbors[shot.id], min_depth, max_depth, shot, tag_planes),
+            [], 1)
+    for shot in reconstruction.shots.values():
+        if len(neighbors[shot.id]) <= 1:
+            continue
+        dependencies = [('compute', n.id) for n in neighbors[shot.id]
+                        if ('compute', n.id) in tasks]
+        tasks['clean', shot.id] = (
+            clean_depthmap_catched,
+            (data, neighbors[shot.id], shot),
+            dependencies, 0)
+
+    # Chunked merges load the views of each chunk when merging it
+    chunked = data.config.get('depthmap_merge_chunk_size', 0) > 0
+    merge_views = {}
+
+    def on_done(task):
+        kind, shot_id = task
+        if (kind == 'clean' and not chunked and
+                data.clean_depthmap_exists(shot_id)):
+            merge_views[shot_id] = load_merge_view(
+                data, reconstruction.shots[shot_id])
+
+    run_task_graph(tasks, processes, on_done)
+
+    with profiling.span('merge_depthmaps'):
+        merge_depthmaps(data, graph, reconstruction, neighbors, merge_views)
+
+
+def compute_depthmap_neighbors(data, graph, reconstruction):
+    """Find the neighbors of all shots used to compute their depthmaps."""
+    logger.info('Computing neighbors')
     num_neighbors = data.config['depthmap_num_neighbors']
     tracks, _ = matching.tracks_and_images(graph)
     common_tracks = matching.all_common_tracks(graph, tracks, include_features=False)
@@ -24,23 +76,20 @@ def compute_depthmaps(data, graph, reconstruction):
     for shot in reconstruction.shots.values():
         neighbors[shot.id] = find_neighboring_images(
             shot, common_tracks, reconstruction, num_neighbors)
+    return neighbors
 
-    arguments = []
-    for shot in reconstruction.shots.values():
-        if len(neighbors[shot.id]) <= 1:
-            continue
-        min_depth, max_depth = compute_depth_range(graph, reconstruction, shot)
-        arguments.append((data, neighbors[shot.id], min_depth, max_depth, shot))
-    parallel_run(compute_depthmap_catched, arguments, processes)
-
-    arguments = []
-    for shot in reconstruction.shots.values():
-        if len(neighbors[shot.id]) <= 1:
-            continue
-        arguments.append((data, neighbors[shot.id], shot))
-    parallel_run(clean_depthmap_catched, arguments, processes)
 
-    merge_depthmaps(data, graph, reconstruction, neighbors)
+def compute_depthmap_priors(data, graph, reconstruction, shot):
+    """Depth range and tag planes used to compute the depthmap of a shot."""
+    if data.config.get('depthmap_tag_priors', False):
+        tag_planes = compute_tag_planes(graph, reconstruction, shot)
+        min_depth, max_depth = compute_depth_range_with_tags(
+            graph, reconstruction, shot, tag_planes,
+            data.config.get('depthmap_tag_depth_margin', 0.05))
+    else:
+        tag_planes = []
+        min_depth, max_depth = compute_depth_range(graph, reconstruction, shot)
+    return min_depth, max_depth, tag_planes
 
 
 def compute_depthmap_catched(arguments):
@@ -72,11 +121,80 @@ def parallel_run(function, arguments, num_processes):
         return ret
 
 
+def run_task_graph(tasks, num_processes, on_done=None):
+    """Run tasks as soon as the tasks they depend on are done.
+
+    Args:
+        tasks: dict mapping task names to (function, argument, dependencies,
+            priority) tuples.  Ready tasks with lower priority values run
+            first.
+        num_processes: number of processes
+        on_done: function called in this process with the name of each
+            task once it is done
+    """
+    waiting = {name: set(task[2]) for name, task in tasks.items()}
+    dependents = {name: [] for name in tasks}
+    for name, task in tasks.items():
+        for dependency in task[2]:
+            dependents[dependency].append(name)
+
+    ready = []
+    order = {name: i for i, name in enumerate(sorted(tasks))}
+
+    def make_ready(name):
+        heapq.heappush(ready, (tasks[name][3], order[name], name))
+
+    for name in tasks:
+        if not waiting[name]:
+            make_ready(name)
+
+    done = Queue.Queue()
+    pool = Pool(num_processes) if num_processes > 1 else None
+    try:
+        running = 0
+        finished = 0
+        while finished < len(tasks):
+            while ready and (pool is None and running == 0 or
+                             pool is not None and running < num_processes):
+                _, _, name = heapq.heappop(ready)
+                function, argument = tasks[name][:2]
+                if pool is None:
+                    done.put(_run_task((name, function, argument)))
+                else:
+                    pool.apply_async(_run_task, ((name, function, argument),),
+                                     callback=done.put)
+                running += 1
+
+            name = done.get()
+            running -= 1
+            finished += 1
+            if on_done is not None:
+                on_done(name)
+            for dependent in dependents[name]:
+                waiting[dependent].discard(name)
+                if not waiting[dependent]:
+                    make_ready(dependent)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.terminate()
+
+
+def _run_task(arguments):
+    name, function, argument = arguments
+    try:
+        function(argument)
+    except Exception as e:
+        logger.error('Exception on task {}'.format(name))
+        logger.exception(e)
+    return name
+
+
 def compute_depthmap(arguments):
     """Compute depthmap for a single shot."""
-    data, neighbors, min_depth, max_depth, shot = arguments
+    data, neighbors, min_depth, max_depth, shot, tag_planes = arguments
     method = data.config['depthmap_method']
-    
+
     if data.raw_depthmap_exists(shot.id):
         logger.info("Using precomputed raw depthmap {}".format(shot.id))
         return
@@ -88,6 +206,20 @@ def compute_depthmap(arguments):
     de.set_min_patch_sd(data.config['depthmap_min_patch_sd'])
     add_views_to_depth_estimator(data, neighbors, de)
 
+    if tag_planes:
+        # Tag planes are good initial hypotheses, so PatchMatch
+        # converges in fewer iterations around them.  The iterations are
+        # only reduced if the tags cover enough of the image.
+        gray_image, _ = load_depthmap_view(data, shot)
+        height, width = np.asarray(gray_image).shape
+        planes = tag_plane_image(shot, tag_planes, width, height)
+        de.set_initial_planes(planes)
+        coverage = tag_plane_coverage(planes)
+        if coverage >= data.config.get('depthmap_tag_prior_min_coverage', 0.5):
+            de.set_patchmatch_iterations(
+                data.config.get('depthmap_tag_prior_iterations',
+                                data.config['depthmap_patchmatch_iterations']))
+
     if (method == 'BRUTE_FORCE'):
         depth, plane, score, nghbr = de.compute_brute_force()
     elif (method == 'PATCH_MATCH'):
@@ -106,11 +238,9 @@ def compute_depthmap(arguments):
     data.save_raw_depthmap(shot.id, depth, plane, score, nghbr, neighbor_ids)
 
     if data.config['depthmap_save_debug_files']:
-        image = data.undistorted_image_as_array(shot.id)
+        _, image = load_depthmap_view(data, shot)
         image = scale_down_image(image, depth.shape[1], depth.shape[0])
-        ply = depthmap_to_ply(shot, depth, image)
-        with open(data._depthmap_file(shot.id, 'raw.npz.ply'), 'w') as fout:
-            fout.write(ply)
+        save_depthmap_ply(data, data._depthmap_file(shot.id, 'raw.npz.ply'), shot, depth, image)
 
     if data.config.get('interactive'):
         import matplotlib.pyplot as plt
@@ -152,11 +282,9 @@ def clean_depthmap(arguments):
     data.save_clean_depthmap(shot.id, depth, raw_plane, raw_score)
 
     if data.config['depthmap_save_debug_files']:
-        image = data.undistorted_image_as_array(shot.id)
+        _, image = load_depthmap_view(data, shot)
         image = scale_down_image(image, depth.shape[1], depth.shape[0])
-        ply = depthmap_to_ply(shot, depth, image)
-        with open(data._depthmap_file(shot.id, 'clean.npz.ply'), 'w') as fout:
-            fout.write(ply)
+        save_depthmap_ply(data, data._depthmap_file(shot.id, 'clean.npz.ply'), shot, depth, image)
 
     if data.config.get('interactive'):
         import matplotlib.pyplot as plt
@@ -171,8 +299,18 @@ def clean_depthmap(arguments):
         plt.show()
 
 
-def merge_depthmaps(data, graph, reconstruction, neighbors):
-    """Merge depthmaps into a single point cloud."""
+def merge_depthmaps(data, graph, reconstruction, neighbors, merge_views=None):
+    """Merge depthmaps into a single point cloud.
+
+    merge_views optionally holds the views already loaded by load_merge_view.
+    When depthmap_merge_chunk_size is set, the shots are merged by spatial
+    chunks instead, see merge_depthmaps_chunked.
+    """
+    chunk_size = data.config.get('depthmap_merge_chunk_size', 0)
+    if chunk_size > 0:
+        merge_depthmaps_chunked(data, reconstruction, neighbors, chunk_size)
+        return
+
     logger.info("Merging depthmaps")
 
     # Set up merger.
@@ -180,23 +318,100 @@ def merge_depthmaps(data, graph, reconstruction, neighbors):
     dm.set_same_depth_threshold(data.config['depthmap_same_depth_threshold'])
     shot_ids = [s for s in neighbors if data.clean_depthmap_exists(s)]
     indices = {s: i for i, s in enumerate(shot_ids)}
+    view_bytes = 0
     for shot_id in shot_ids:
-        depth, plane, _ = data.load_clean_depthmap(shot_id)
         shot = reconstruction.shots[shot_id]
         neighbors_indices = [indices[n.id] for n in neighbors[shot.id] if n.id in indices]
-        color_image = data.undistorted_image_as_array(shot.id)
-        height, width = depth.shape
-        image = scale_down_image(color_image, width, height)
-        K = shot.camera.get_K_in_pixel_coordinates(width, height)
-        R = shot.pose.get_rotation_matrix()
-        t = shot.pose.translation
+        if merge_views and shot_id in merge_views:
+            K, R, t, depth, plane, image = merge_views.pop(shot_id)
+        else:
+            K, R, t, depth, plane, image = load_merge_view(data, shot)
         dm.add_view(K, R, t, depth, plane, image, neighbors_indices)
+        view_bytes += depth.nbytes + plane.nbytes + image.nbytes
+    profiling.size('merge/views', len(shot_ids))
+    profiling.size('merge/view_bytes', view_bytes)
 
     # Merge.
-    points, normals, colors = dm.merge()
-    ply = point_cloud_to_ply(points, normals, colors)
-    with open(data._depthmap_path() + '/merged.ply', 'w') as fout:
-        fout.write(ply)
+    with profiling.span('merge'):
+        points, normals, colors = dm.merge()
+    profiling.size('merge/points', len(points))
+    save_point_cloud_ply(data, data._depthmap_path() + '/merged.ply', points, normals, colors)
+
+
+def merge_depthmaps_chunked(data, reconstruction, neighbors, chunk_size):
+    """Merge depthmaps by spatial chunks with bounded memory.
+
+    The shots are grouped by the cell of a voxel grid of side chunk_size
+    containing their camera center.  Each chunk is merged with only its
+    shots and the shots pruning them loaded, and the points are streamed
+    to the output PLY file.
+
+    The merger prunes the neighbors of the views in the order they are
+    added, so the views of a chunk are added in the order of the global
+    merge and only the points of the shots of the chunk are output.  The
+    chunks then give the points of the global merge, except where a
+    pruning shot was itself pruned by a shot outside of the chunk.
+    """
+    shot_ids = [s for s in neighbors if data.clean_depthmap_exists(s)]
+    order = {s: i for i, s in enumerate(shot_ids)}
+    pruners = {s: set() for s in shot_ids}
+    for shot_id in shot_ids:
+        for n in neighbors[shot_id][1:]:
+            if n.id in pruners:
+                pruners[n.id].add(shot_id)
+
+    chunks = merge_chunks(reconstruction, shot_ids, chunk_size)
+    logger.info("Merging depthmaps in {} chunks".format(len(chunks)))
+
+    filename = data._depthmap_path() + '/merged.ply'
+    with io.PlyStreamWriter(filename, True, _binary_ply(data)) as writer:
+        for chunk in chunks:
+            owned = set(chunk)
+            context = set(p for s in chunk for p in pruners[s]) - owned
+            views = sorted(owned | context, key=order.get)
+            indices = {s: i for i, s in enumerate(views)}
+
+            dm = csfm.DepthmapMerger()
+            dm.set_same_depth_threshold(data.config['depthmap_same_depth_threshold'])
+            dm.set_output_views([indices[s] for s in chunk])
+            view_bytes = 0
+            for shot_id in views:
+                shot = reconstruction.shots[shot_id]
+                neighbors_indices = [indices[n.id] for n in neighbors[shot_id]
+                                     if n.id in indices]
+                K, R, t, depth, plane, image = load_merge_view(data, shot)
+                dm.add_view(K, R, t, depth, plane, image, neighbors_indices)
+                view_bytes += depth.nbytes + plane.nbytes + image.nbytes
+            profiling.size('merge/views', len(views))
+            profiling.size('merge/view_bytes', view_bytes)
+            with profiling.span('merge_chunk'):
+                points, normals, colors = dm.merge()
+            profiling.size('merge/points', len(points))
+            writer.write(points, colors, normals)
+            logger.debug("Merged chunk with {} shots and {} neighbors: "
+                         "{} points".format(len(chunk), len(context), len(points)))
+
+
+def merge_chunks(reconstruction, shot_ids, chunk_size):
+    """Group shots by the voxel containing their camera center."""
+    chunks = {}
+    for shot_id in shot_ids:
+        origin = reconstruction.shots[shot_id].pose.get_origin()
+        cell = tuple(np.floor(origin / chunk_size).astype(int))
+        chunks.setdefault(cell, []).append(shot_id)
+    return [sorted(chunks[cell]) for cell in sorted(chunks)]
+
+
+def load_merge_view(data, shot):
+    """Load the clean depthmap of a shot and its inputs for the merger."""
+    depth, plane, _ = data.load_clean_depthmap(shot.id)
+    _, color_image = load_depthmap_view(data, shot)
+    height, width = depth.shape
+    image = scale_down_image(np.asarray(color_image), width, height)
+    K = shot.camera.get_K_in_pixel_coordinates(width, height)
+    R = shot.pose.get_rotation_matrix()
+    t = shot.pose.translation
+    return K, R, t, depth, plane, image
 
 
 def add_views_to_depth_estimator(data, neighbors, de):
@@ -204,23 +419,58 @@ def add_views_to_depth_estimator(data, neighbors, de):
     num_neighbors = data.config['depthmap_num_matching_views']
     for shot in neighbors[:num_neighbors + 1]:
         assert shot.camera.projection_type == 'perspective'
-        color_image = data.undistorted_image_as_array(shot.id)
-        gray_image = cv2.cvtColor(color_image, cv2.COLOR_RGB2GRAY)
-        original_height, original_width = gray_image.shape
+        gray_image, _ = load_depthmap_view(data, shot)
+        image = np.asarray(gray_image)
+        # the view keeps the aspect ratio of the original image
+        view_height, view_width = image.shape
         width = int(data.config['depthmap_resolution'])
-        height = width * original_height / original_width
-        image = scale_down_image(gray_image, width, height)
+        height = width * view_height / view_width
         K = shot.camera.get_K_in_pixel_coordinates(width, height)
         R = shot.pose.get_rotation_matrix()
         t = shot.pose.translation
         de.add_view(K, R, t, image)
 
 
+def prepare_depthmap_view(arguments):
+    """Save the depthmap resolution gray and color images of a shot."""
+    data, shot = arguments
+    resolution = int(data.config['depthmap_resolution'])
+    if data.depthmap_view_exists(shot.id, resolution):
+        return
+    logger.debug("Preparing depthmap view {}".format(shot.id))
+    color_image = data.undistorted_image_as_array(shot.id)
+    gray, color = depthmap_view_images(color_image, resolution)
+    data.save_depthmap_view(shot.id, resolution, gray, color)
+
+
+def load_depthmap_view(data, shot):
+    """Gray and color images of a shot at depthmap resolution.
+
+    They are memory mapped from the files written by prepare_depthmap_view
+    when they exist, and computed from the undistorted image otherwise.
+    """
+    resolution = int(data.config['depthmap_resolution'])
+    if data.depthmap_view_exists(shot.id, resolution):
+        return data.load_depthmap_view(shot.id, resolution)
+    color_image = data.undistorted_image_as_array(shot.id)
+    return depthmap_view_images(color_image, resolution)
+
+
+def depthmap_view_images(color_image, width):
+    """Scale down an image and its gray version to the given width."""
+    gray_image = cv2.cvtColor(color_image, cv2.COLOR_RGB2GRAY)
+    original_height, original_width = gray_image.shape
+    height = width * original_height / original_width
+    gray = scale_down_image(gray_image, width, height)
+    color = scale_down_image(color_image, width, height)
+    return gray, color
+
+
 def add_views_to_depth_cleaner(data, neighbors, dc):
     for shot in neighbors:
         if not data.raw_depthmap_exists(shot.id):
             continue
-        depth, plane, score, nghbr, nghbrs = data.load_raw_depthmap(shot.id)
+        depth = data.load_raw_depth(shot.id)
         height, width = depth.shape
         K = shot.camera.get_K_in_pixel_coordinates(width, height)
         R = shot.pose.get_rotation_matrix()
@@ -241,6 +491,78 @@ def compute_depth_range(graph, reconstruction, shot):
     return min_depth * 0.9, max_depth * 1.1
 
 
+def compute_tag_planes(graph, reconstruction, shot):
+    """Planes of the reconstructed tags observed by a shot.
+
+    Returns a list of (plane, corners) tuples, where corners are the
+    reconstructed tag corners in the shot camera coordinates and plane is
+    the vector p such that p.dot(x) = -1 for the points x of the tag plane,
+    which is the plane parametrization used by the DepthmapEstimator.
+    """
+    tags = {}
+    for track in graph[shot.id]:
+        point = reconstruction.points.get(track)
+        if point is not None and point.on_tag:
+            tags.setdefault(point.tag_id, []).append(point.coordinates)
+
+    tag_planes = []
+    for tag_id in sorted(tags):
+        if len(tags[tag_id]) < 3:
+            continue
+        corners = np.array([shot.pose.transform(p) for p in tags[tag_id]])
+        if np.any(corners[:, 2] <= 0):
+            continue
+        plane, _, rank, _ = np.linalg.lstsq(
+            corners, -np.ones(len(corners)), rcond=-1)
+        if rank < 3:
+            continue
+        tag_planes.append((plane, corners))
+    return tag_planes
+
+
+def compute_depth_range_with_tags(graph, reconstruction, shot, tag_planes,
+                                  margin=0.05):
+    """Compute min and max depth based on reconstruction points and tags.
+
+    Tag corners are accurately reconstructed, so the range is only
+    extended by a small margin around the range of the sparse points and
+    the tag corners instead of the 10% of compute_depth_range.
+    """
+    depths = []
+    for track in graph[shot.id]:
+        if track in reconstruction.points:
+            p = reconstruction.points[track].coordinates
+            depths.append(shot.pose.transform(p)[2])
+    tag_depths = [z for _, corners in tag_planes for z in corners[:, 2]]
+    if not tag_depths:
+        return compute_depth_range(graph, reconstruction, shot)
+    min_depth = min(np.percentile(depths, 10), min(tag_depths))
+    max_depth = max(np.percentile(depths, 90), max(tag_depths))
+    return min_depth * (1 - margin), max_depth * (1 + margin)
+
+
+def tag_plane_image(shot, tag_planes, width, height):
+    """Image of the initial plane hypotheses of a depthmap.
+
+    Pixels inside the projection of a tag hold its plane, and the other
+    pixels are zero (no hypothesis).
+    """
+    K = shot.camera.get_K_in_pixel_coordinates(width, height)
+    planes = np.zeros((height, width, 3), dtype=np.float32)
+    for plane, corners in tag_planes:
+        projected = np.dot(corners, K.T)
+        pixels = projected[:, :2] / projected[:, 2:3]
+        hull = cv2.convexHull(np.round(pixels).astype(np.int32))
+        cv2.fillConvexPoly(planes, hull, [float(v) for v in plane])
+    return planes
+
+
+def tag_plane_coverage(planes):
+    """Fraction of the pixels of a tag plane image holding a plane."""
+    seeded = np.any(planes != 0, axis=2)
+    return np.count_nonzero(seeded) / float(seeded.size)
+
+
 def find_neighboring_images(shot, common_tracks, reconstruction, num_neighbors=5):
     """Find neighboring images based on common tracks."""
     theta_min = np.pi / 60
@@ -292,8 +614,33 @@ def scale_down_image(image, width, height):
     return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
 
 
-def depthmap_to_ply(shot, depth, image):
-    """Export depthmap points as a PLY string"""
+def _binary_ply(data):
+    return data.config.get('ply_format', 'ascii') == 'binary'
+
+
+def save_depthmap_ply(data, filename, shot, depth, image):
+    """Save depthmap points as an ascii or binary PLY file."""
+    if _binary_ply(data):
+        points = depthmap_to_points(shot, depth)
+        with open(filename, 'wb') as fout:
+            io.write_binary_ply(fout, points, image.reshape(-1, 3))
+    else:
+        with open(filename, 'w') as fout:
+            fout.write(depthmap_to_ply(shot, depth, image))
+
+
+def save_point_cloud_ply(data, filename, points, normals, colors):
+    """Save a point cloud as an ascii or binary PLY file."""
+    if _binary_ply(data):
+        with open(filename, 'wb') as fout:
+            io.write_binary_ply(fout, points, colors, normals)
+    else:
+        with open(filename, 'w') as fout:
+            fout.write(point_cloud_to_ply(points, normals, colors))
+
+
+def depthmap_to_points(shot, depth):
+    """World coordinates of the pixels of a depthmap as a (n, 3) array."""
     height, width = depth.shape
     K = shot.camera.get_K_in_pixel_coordinates(width, height)
     R = shot.pose.get_rotation_matrix()
@@ -302,9 +649,15 @@ def depthmap_to_ply(shot, depth, image):
     v = np.vstack((x.ravel(), y.ravel(), np.ones(width * height)))
     camera_coords = depth.reshape((1, -1)) * np.linalg.inv(K).dot(v)
     points = R.T.dot(camera_coords - t.reshape(3, 1))
+    return points.T
+
+
+def depthmap_to_ply(shot, depth, image):
+    """Export depthmap points as a PLY string"""
+    points = depthmap_to_points(shot, depth)
 
     vertices = []
-    for p, c in zip(points.T, image.reshape(-1, 3)):
+    for p, c in zip(points, image.reshape(-1, 3)):
         s = "{} {} {} {} {} {}".format(p[0], p[1], p[2], c[0], c[1], c[2])
         vertices.append(s)
 
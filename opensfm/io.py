@@ -2,6 +2,7 @@ import errno
 import json
 import logging
 import os
+import shutil
 import sys
 
 import cv2
@@ -195,6 +196,27 @@ def tag_detection_to_json(tag_detection):
         'colors': tag_detection.colors.tolist()
     }
 
+def tag_map_to_json(reconstruction_index, tag_map, cameras):
+    """
+    Write a tag map, the index of its reconstruction and the cameras to localize with it to a json object
+    """
+    return {
+        'reconstruction': reconstruction_index,
+        'tags': {str(tag_id): {'corners': corners.tolist()}
+                 for tag_id, corners in tag_map.iteritems()},
+        'cameras': cameras_to_json(cameras),
+    }
+
+def tag_map_from_json(obj):
+    """
+    Read a tag map, the index of its reconstruction and its cameras from a json object
+
+    The index is None for tag maps that do not record it.
+    """
+    tag_map = {tag_id: np.array(value['corners'], dtype=float)
+               for tag_id, value in obj['tags'].iteritems()}
+    return obj.get('reconstruction'), tag_map, cameras_from_json(obj['cameras'])
+
 def reconstruction_from_json(obj):
     """
     Read a reconstruction from a json object
@@ -382,6 +404,115 @@ def reconstructions_to_json(reconstructions):
     return [reconstruction_to_json(i) for i in reconstructions]
 
 
+def json_dump_reconstructions(reconstructions, fout, minify=False, codec='utf-8'):
+    """
+    Write reconstructions as json, one camera, shot and point at a time
+
+    The output is identical to
+    json_dump(reconstructions_to_json(reconstructions), fout, minify) but the
+    json tree of all the points is never built.
+    """
+    writer = _JsonStreamWriter(fout, minify, codec)
+    writer.begin('[')
+    for reconstruction in reconstructions:
+        writer.item(0)
+        _json_dump_reconstruction(writer, reconstruction, 1)
+    writer.end(']', 0, bool(reconstructions))
+
+
+def _json_dump_reconstruction(writer, reconstruction, level):
+    # Keys are created in the same order as in reconstruction_to_json so
+    # that the dicts iterate in the same order
+    obj = {
+        "cameras": None,
+        "shots": None,
+        "points": None
+    }
+    if hasattr(reconstruction, 'pano_shots'):
+        obj['pano_shots'] = None
+    if hasattr(reconstruction, 'main_shot'):
+        obj['main_shot'] = reconstruction.main_shot
+    if hasattr(reconstruction, 'unit_shot'):
+        obj['unit_shot'] = reconstruction.unit_shot
+
+    writer.begin('{')
+    for key in obj:
+        writer.item(level)
+        writer.key(key)
+        if key == 'cameras':
+            cameras = reconstruction.cameras.values()
+            writer.dict(((c.id, c) for c in cameras), camera_to_json, level)
+        elif key == 'shots':
+            shots = reconstruction.shots.values()
+            writer.dict(((s.id, s) for s in shots), shot_to_json, level)
+        elif key == 'points':
+            points = reconstruction.points.values()
+            writer.dict(((p.id, p) for p in points), point_to_json, level)
+        elif key == 'pano_shots':
+            shots = reconstruction.pano_shots.values()
+            writer.dict(((s.id, s) for s in shots), shot_to_json, level)
+        else:
+            writer.value(obj[key], level)
+    writer.end('}', level, True)
+
+
+class _JsonStreamWriter(object):
+    """Write json incrementally with the same formatting as json_dump."""
+
+    def __init__(self, fout, minify, codec):
+        kwargs = json_dump_kwargs(minify, codec)
+        self.encoder = json.JSONEncoder(**kwargs)
+        self.indent = kwargs['indent']
+        self.fout = fout
+        self.first = True
+
+    def begin(self, bracket):
+        self.fout.write(bracket)
+        self.first = True
+
+    def end(self, bracket, level, non_empty):
+        if non_empty:
+            self._newline(level)
+        self.fout.write(bracket)
+        self.first = False
+
+    def item(self, level):
+        if not self.first:
+            self.fout.write(self.encoder.item_separator)
+        self.first = False
+        self._newline(level + 1)
+
+    def key(self, key):
+        if not isinstance(key, basestring):
+            key = str(key)
+        self.fout.write(self.encoder.encode(key))
+        self.fout.write(self.encoder.key_separator)
+
+    def value(self, value, level):
+        text = self.encoder.encode(value)
+        if self.indent is not None:
+            text = text.replace('\n', '\n' + ' ' * (self.indent * (level + 1)))
+        self.fout.write(text)
+
+    def dict(self, items, to_json, level):
+        """Write a dict given as (key, object) items, in json dict order."""
+        objects = {}
+        order = {}
+        for key, value in items:
+            objects[key] = value
+            order[key] = None
+        self.begin('{')
+        for key in order:
+            self.item(level + 1)
+            self.key(key)
+            self.value(to_json(objects[key]), level + 1)
+        self.end('}', level + 1, bool(order))
+
+    def _newline(self, level):
+        if self.indent is not None:
+            self.fout.write('\n' + ' ' * (self.indent * level))
+
+
 def cameras_to_json(cameras):
     """
     Write cameras to a json object
@@ -473,6 +604,96 @@ def mkdir_p(path):
             raise
 
 
+def encode_depthmap_channels(channels, precision='float32'):
+    """Convert depthmap channels to the storage precision.
+
+    With float16 precision, depth and score are stored as float16, plane
+    as int8 quantized unit normals and nghbr as int8.  Only the direction
+    of the planes is kept, which is all the cleaner and merger use.
+    Depths that do not fit in a float16 are marked as invalid (zero).
+    """
+    encoded = {}
+    for name, value in channels.items():
+        value = np.asarray(value)
+        if precision == 'float16':
+            if name in ('depth', 'score'):
+                value = np.where(np.abs(value) < np.finfo(np.float16).max,
+                                 value, 0).astype(np.float16)
+            elif name == 'plane':
+                norm = np.linalg.norm(value, axis=-1)[..., np.newaxis]
+                normal = value / np.maximum(norm, 1e-12)
+                value = np.round(normal * 127).astype(np.int8)
+            elif name == 'nghbr' and value.size and value.max() < 128:
+                value = value.astype(np.int8)
+        encoded[name] = value
+    return encoded
+
+
+def decode_depthmap_channel(name, value):
+    """Convert a stored depthmap channel back to its computing type."""
+    if value.dtype == np.float16:
+        return value.astype(np.float32)
+    if name == 'plane' and value.dtype == np.int8:
+        return value.astype(np.float32) / 127
+    if name == 'nghbr' and value.dtype == np.int8:
+        return value.astype(np.int32)
+    return value
+
+
+class DepthmapChannels(object):
+    """Lazily loaded channels of a depthmap file.
+
+    Channels are only read when accessed.  Uncompressed channels are
+    memory mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.isdir(path):
+            self.npz = None
+        else:
+            self.npz = np.load(path + '.npz')
+
+    def __getitem__(self, name):
+        if self.npz is not None:
+            value = self.npz[name]
+        else:
+            value = np.load(os.path.join(self.path, name + '.npy'),
+                            mmap_mode='r')
+        return decode_depthmap_channel(name, value)
+
+
+def depthmap_channels_exist(path):
+    """Whether a depthmap was saved in path in any of the formats."""
+    return os.path.isdir(path) or os.path.isfile(path + '.npz')
+
+
+def save_depthmap_channels(path, channels, storage='npz', precision='float32'):
+    """Save depthmap channels.
+
+    With npz storage, the channels are compressed into path.npz.  With npy
+    storage, every channel is an uncompressed .npy file in the path
+    folder, so that channels can be memory mapped and read separately.
+    """
+    channels = encode_depthmap_channels(channels, precision)
+    if storage == 'npy':
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        mkdir_p(temp_path)
+        for name, value in channels.items():
+            np.save(os.path.join(temp_path, name + '.npy'), value)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(temp_path, path)
+        if os.path.isfile(path + '.npz'):
+            os.remove(path + '.npz')
+    elif storage == 'npz':
+        np.savez_compressed(path + '.npz', **channels)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    else:
+        raise ValueError('Unknown depthmap storage {}'.format(storage))
+
+
 def json_dump_kwargs(minify=False, codec='utf-8'):
     if minify:
         indent, separators = None, (',', ':')
@@ -830,3 +1051,161 @@ def reconstruction_to_ply(reconstruction):
     ]
 
     return '\n'.join(header + vertices + [''])
+
+
+def reconstruction_to_ply_arrays(reconstruction):
+    """
+    Reconstruction points and camera axes as PLY vertex arrays
+
+    Returns a tuple with the coordinates and colors.  Points lazily read from
+    a binary reconstruction are taken from their packed arrays.
+    """
+    arrays = getattr(reconstruction.points, 'arrays', None)
+    arrays = arrays() if arrays is not None else None
+    if arrays is not None:
+        points = np.asarray(arrays['coordinates'], dtype=np.float64)
+        colors = np.nan_to_num(np.asarray(arrays['colors']))
+    else:
+        points = reconstruction.points.values()
+        points, colors = (
+            np.array([p.coordinates for p in points], dtype=np.float64).reshape(-1, 3),
+            np.array([p.color for p in points], dtype=np.float64).reshape(-1, 3))
+
+    axes = np.linspace(0, 1, 10)
+    shot_points, shot_colors = [], []
+    for shot in reconstruction.shots.values():
+        o = shot.pose.get_origin()
+        R = shot.pose.get_rotation_matrix()
+        for axis in range(3):
+            shot_points.append(o + axes[:, np.newaxis] * R[axis])
+            shot_colors.append(np.tile(255 * np.eye(3)[axis], (len(axes), 1)))
+
+    if shot_points:
+        points = np.vstack([points] + shot_points)
+        colors = np.vstack([colors] + shot_colors)
+    return points, colors
+
+
+def ply_header(count, normals=False, binary=False):
+    """
+    PLY header lines for count vertices with optional normals
+    """
+    header = [
+        "ply",
+        "format binary_little_endian 1.0" if binary else "format ascii 1.0",
+        "element vertex {}".format(count),
+        "property float x",
+        "property float y",
+        "property float z",
+    ]
+    if normals:
+        header += [
+            "property float nx",
+            "property float ny",
+            "property float nz",
+        ]
+    header += [
+        "property uchar diffuse_red",
+        "property uchar diffuse_green",
+        "property uchar diffuse_blue",
+        "end_header",
+    ]
+    return header
+
+
+def write_binary_ply(fout, points, colors, normals=None):
+    """
+    Write points as a binary little endian PLY file
+
+    The vertices are packed in a numpy structured array and written with
+    a single buffer write.  fout must be opened in binary mode.
+    """
+    vertices = _ply_vertices(points, colors, normals)
+    header = ply_header(len(vertices), normals is not None, binary=True)
+    fout.write('\n'.join(header + ['']))
+    fout.write(vertices.tobytes())
+
+
+def _ply_vertices(points, colors, normals=None):
+    """Pack points, optional normals and colors in a structured array."""
+    points = np.asarray(points).reshape(-1, 3)
+    colors = np.asarray(colors).reshape(-1, 3)
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if normals is not None:
+        normals = np.asarray(normals).reshape(-1, 3)
+        fields += [('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4')]
+    fields += [('diffuse_red', 'u1'), ('diffuse_green', 'u1'),
+               ('diffuse_blue', 'u1')]
+
+    vertices = np.empty(len(points), dtype=fields)
+    vertices['x'], vertices['y'], vertices['z'] = points.T
+    if normals is not None:
+        vertices['nx'], vertices['ny'], vertices['nz'] = normals.T
+    colors = np.clip(colors, 0, 255).astype(np.uint8)
+    vertices['diffuse_red'], vertices['diffuse_green'], vertices['diffuse_blue'] = colors.T
+    return vertices
+
+
+class PlyStreamWriter(object):
+    """
+    Write a PLY file from batches of points
+
+    The vertices are appended to a temporary body file as they come, and
+    the header, which needs the total number of vertices, is written when
+    closing, so only one batch is in memory at a time.
+    """
+
+    def __init__(self, filename, normals=False, binary=False):
+        self.filename = filename
+        self.normals = normals
+        self.binary = binary
+        self.count = 0
+        self.body_file = '{}.{}.body'.format(filename, os.getpid())
+        self.body = open(self.body_file, 'wb' if binary else 'w')
+
+    def write(self, points, colors, normals=None):
+        """Append a batch of points"""
+        if self.normals and normals is None:
+            raise ValueError('Normals are required by this PLY file')
+        if not self.normals:
+            normals = None
+        if self.binary:
+            vertices = _ply_vertices(points, colors, normals)
+            self.body.write(vertices.tobytes())
+            self.count += len(vertices)
+            return
+        for i, (p, c) in enumerate(zip(points, colors)):
+            if normals is not None:
+                n = normals[i]
+                self.body.write("{:.4f} {:.4f} {:.4f} {:.3f} {:.3f} {:.3f} {} {} {}\n".format(
+                    p[0], p[1], p[2], n[0], n[1], n[2], int(c[0]), int(c[1]), int(c[2])))
+            else:
+                self.body.write("{:.4f} {:.4f} {:.4f} {} {} {}\n".format(
+                    p[0], p[1], p[2], int(c[0]), int(c[1]), int(c[2])))
+            self.count += 1
+
+    def close(self):
+        """Write the header and the vertices to the PLY file"""
+        self.body.close()
+        header = ply_header(self.count, self.normals, self.binary)
+        temp_file = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(temp_file, 'wb' if self.binary else 'w') as fout:
+            fout.write('\n'.join(header + ['']))
+            with open(self.body_file, 'rb' if self.binary else 'r') as fin:
+                while True:
+                    block = fin.read(1 << 20)
+                    if not block:
+                        break
+                    fout.write(block)
+        os.remove(self.body_file)
+        os.rename(temp_file, self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.body.close()
+            os.remove(self.body_file)
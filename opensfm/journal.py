@@ -0,0 +1,256 @@
+"""Append-only journal of a growing reconstruction.
+
+The journal is made of two files in the dataset folder:
+
+ - a snapshot with the full state of the reconstruction being grown at
+   some point, plus the number of reconstructions already finished and
+   saved with DataSet.save_reconstruction.
+ - a journal with one JSON record per line holding the changes made to
+   the reconstruction since the previous record: new or moved shots,
+   cameras updated by bundle adjustment, added or moved points and
+   removed points.
+
+The shots and points changed since the last record are marked with
+touch_shots and touch_points where they change (resection,
+triangulation, local bundle adjustment), so that a record only costs the
+size of the change.  Changes to the whole reconstruction (global bundle
+adjustment, alignment, retriangulation) are marked with touch_all and
+write a snapshot instead.
+
+The journal is also compacted into a new snapshot every
+`journal_snapshot_interval` records or when a record would be about as
+large as a snapshot.
+"""
+
+import json
+import logging
+import os
+
+from opensfm import io
+from opensfm import types
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReconstructionJournal:
+    """Journal the changes of a reconstruction while it is grown."""
+
+    def __init__(self, data):
+        self.journal_file = data.reconstruction_journal_file()
+        self.snapshot_file = data.reconstruction_snapshot_file()
+        self.snapshot_interval = data.config.get(
+            'journal_snapshot_interval', 100)
+        self.sequence = 0
+        self.num_finished = 0
+        self._reset_state(None)
+
+    def start(self, reconstruction, num_finished):
+        """Start journaling a new reconstruction."""
+        self.num_finished = num_finished
+        self.snapshot(reconstruction)
+
+    def touch_shots(self, shot_ids):
+        """Mark shots as added or moved since the last record."""
+        self.touched_shots.update(shot_ids)
+
+    def touch_points(self, point_ids):
+        """Mark points as added, moved or removed since the last record."""
+        self.touched_points.update(point_ids)
+
+    def touch_all(self):
+        """Mark the whole reconstruction as changed."""
+        self.touched_all = True
+
+    def record(self, reconstruction):
+        """Append the changes since the last record or snapshot."""
+        if self.touched_all:
+            self.snapshot(reconstruction)
+            return
+
+        delta = self._delta(reconstruction)
+        if not delta:
+            return
+
+        changed = len(delta.get('points', {})) + len(delta.get('shots', {}))
+        total = len(reconstruction.points) + len(reconstruction.shots)
+        if (self.records >= self.snapshot_interval or 2 * changed > total):
+            self.snapshot(reconstruction)
+            return
+
+        self.sequence += 1
+        delta['sequence'] = self.sequence
+        with open(self.journal_file, 'a') as fout:
+            fout.write(json.dumps(delta) + '\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+        self.records += 1
+        self._reset_touched(reconstruction)
+
+    def snapshot(self, reconstruction):
+        """Write the full reconstruction and truncate the journal."""
+        self.sequence += 1
+        obj = {
+            'sequence': self.sequence,
+            'num_finished': self.num_finished,
+            'reconstruction': None,
+        }
+        if reconstruction is not None:
+            obj['reconstruction'] = _reconstruction_to_json(reconstruction)
+
+        temp_file = self.snapshot_file + '.tmp'
+        with open(temp_file, 'w') as fout:
+            io.json_dump(obj, fout, minify=True)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(temp_file, self.snapshot_file)
+        open(self.journal_file, 'w').close()
+        self.records = 0
+        self._reset_state(reconstruction)
+
+    def finish(self, num_finished):
+        """Mark the current reconstruction as finished and saved."""
+        self.num_finished = num_finished
+        self.snapshot(None)
+
+    def close(self):
+        """Remove the journal files once the whole run is done."""
+        for filename in [self.journal_file, self.snapshot_file]:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def load(self):
+        """Replay the snapshot and the journal.
+
+        Returns:
+            a tuple with the number of finished reconstructions and the
+            reconstruction being grown (None if there was none), or None
+            if there is no journal.
+        """
+        if not os.path.isfile(self.snapshot_file):
+            return None
+
+        with open(self.snapshot_file) as fin:
+            obj = json.load(fin)
+        self.sequence = obj['sequence']
+        self.num_finished = obj['num_finished']
+        if obj['reconstruction'] is None:
+            self.snapshot(None)
+            return self.num_finished, None
+
+        reconstruction = io.reconstruction_from_json(obj['reconstruction'])
+        replayed = 0
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file) as fin:
+                for line in fin:
+                    try:
+                        delta = json.loads(line)
+                    except ValueError:
+                        logger.warning('Ignoring truncated journal record')
+                        break
+                    if delta['sequence'] <= self.sequence:
+                        continue
+                    _apply_delta(reconstruction, delta)
+                    self.sequence = delta['sequence']
+                    replayed += 1
+        logger.info('Replayed {} journal records: {} shots, {} points'.format(
+            replayed, len(reconstruction.shots), len(reconstruction.points)))
+
+        self.snapshot(reconstruction)
+        return self.num_finished, reconstruction
+
+    def _reset_state(self, reconstruction):
+        self.records = 0
+        self._reset_touched(reconstruction)
+
+    def _reset_touched(self, reconstruction):
+        self.touched_all = False
+        self.touched_shots = set()
+        self.touched_points = set()
+        self.cameras = {}
+        if reconstruction is not None:
+            self.cameras = {k: _camera_state(c)
+                            for k, c in reconstruction.cameras.iteritems()}
+
+    def _delta(self, reconstruction):
+        delta = {}
+
+        cameras = {}
+        for key, camera in reconstruction.cameras.iteritems():
+            if self.cameras.get(key) != _camera_state(camera):
+                cameras[key] = io.camera_to_json(camera)
+        if cameras:
+            delta['cameras'] = cameras
+
+        shots = {}
+        for key in self.touched_shots:
+            if key in reconstruction.shots:
+                shots[key] = io.shot_to_json(reconstruction.shots[key])
+        if shots:
+            delta['shots'] = shots
+
+        points = {}
+        removed = []
+        for key in self.touched_points:
+            if key in reconstruction.points:
+                points[key] = _point_to_json(reconstruction.points[key])
+            else:
+                removed.append(key)
+        if points:
+            delta['points'] = points
+        if removed:
+            delta['removed_points'] = removed
+
+        return delta
+
+
+def _camera_state(camera):
+    return tuple(sorted(io.camera_to_json(camera).items()))
+
+
+def _point_to_json(point):
+    """Write a point to a json object, even if it is not painted yet."""
+    return io.point_to_json(_painted(point))
+
+
+def _painted(point):
+    if point.color is not None:
+        return point
+    painted = types.Point()
+    painted.__dict__.update(point.__dict__)
+    painted.color = [0, 0, 0]
+    return painted
+
+
+def _reconstruction_to_json(reconstruction):
+    obj = {
+        'cameras': io.cameras_to_json(reconstruction.cameras),
+        'shots': {},
+        'points': {},
+    }
+    for shot in reconstruction.shots.values():
+        obj['shots'][shot.id] = io.shot_to_json(shot)
+    for point in reconstruction.points.values():
+        obj['points'][point.id] = _point_to_json(point)
+    return obj
+
+
+def _apply_delta(reconstruction, delta):
+    """Apply a journal record to a reconstruction."""
+    for key, value in delta.get('cameras', {}).iteritems():
+        camera = io.camera_from_json(key, value)
+        reconstruction.add_camera(camera)
+        for shot in reconstruction.shots.values():
+            if shot.camera.id == key:
+                shot.camera = camera
+
+    for key, value in delta.get('shots', {}).iteritems():
+        shot = io.shot_from_json(key, value, reconstruction.cameras)
+        reconstruction.add_shot(shot)
+
+    for key, value in delta.get('points', {}).iteritems():
+        point = io.point_from_json(key, value)
+        reconstruction.add_point(point)
+
+    for key in delta.get('removed_points', []):
+        reconstruction.points.pop(key, None)
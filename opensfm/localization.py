@@ -0,0 +1,385 @@
+"""Localization of query images against a reconstruction.
+
+The descriptor of a reconstructed point is the mean of the descriptors of
+its observations, or their bitwise majority for binary descriptors.  The
+descriptors of the points of a reconstruction are saved as an index in
+the dataset, so that it is only computed again when the reconstruction
+changes.
+
+A Localizer keeps the index and its FLANN search structure in memory.
+Localizing an image then only extracts its features, matches them with
+the points and computes the pose with the absolute pose RANSAC used to
+resect shots during the reconstruction.
+
+In spaces equipped with tags, a TagLocalizer only needs the tag map, the
+reconstructed corners of the tags.  It runs the AprilTag detector on the
+query image and computes the pose from the detected corners with PnP.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pyopengv
+
+from opensfm import exif
+from opensfm import features
+from opensfm import io
+from opensfm import matching
+from opensfm import reconstruction as recon
+from opensfm.commands import detect_tags
+
+logger = logging.getLogger(__name__)
+
+
+def point_descriptors(data, graph, reconstruction):
+    """Descriptors of the reconstructed points.
+
+    Returns:
+        the ids of the tracks of the points seen by a feature, their
+        coordinates and their descriptors.
+    """
+    sums = None
+    counts = None
+    position = {}
+    for image in sorted(reconstruction.shots):
+        if image not in graph:
+            continue
+        rows, feature_ids = [], []
+        for track, edge in graph[image].iteritems():
+            if track in reconstruction.points and not edge.get('tag_feature', 0):
+                if track not in position:
+                    position[track] = len(position)
+                rows.append(position[track])
+                feature_ids.append(edge['feature_id'])
+        if not rows:
+            continue
+
+        _, descriptors, _ = data.load_features(image)
+        binary = descriptors.dtype == np.uint8
+        descriptors = descriptors[feature_ids]
+        if binary:
+            descriptors = np.unpackbits(descriptors, axis=1)
+        if sums is None:
+            sums = np.zeros((len(reconstruction.points), descriptors.shape[1]))
+            counts = np.zeros(len(reconstruction.points))
+        np.add.at(sums, rows, descriptors)
+        np.add.at(counts, rows, 1)
+
+    tracks = sorted(position, key=position.get)
+    if not tracks:
+        return np.array([], dtype=str), np.zeros((0, 3)), np.zeros((0, 0), dtype=np.float32)
+
+    means = sums[:len(tracks)] / counts[:len(tracks), np.newaxis]
+    if binary:
+        descriptors = np.packbits(means > 0.5, axis=1)
+    else:
+        descriptors = means.astype(np.float32)
+    points = np.array([reconstruction.points[t].coordinates for t in tracks])
+    return np.array(tracks), points, descriptors
+
+
+class Localizer(object):
+    """Localize query images against a reconstruction of a dataset.
+
+    The index of the point descriptors is loaded, or computed and saved
+    if it does not exist or is older than the reconstruction.
+    """
+
+    def __init__(self, data, reconstruction_index=0):
+        self.data = data
+        self.config = data.config
+        self.reconstruction = data.load_reconstruction()[reconstruction_index]
+
+        index = None
+        if data.localization_index_exists():
+            index = data.load_localization_index()
+            if int(index[0]) != reconstruction_index:
+                index = None
+        if index is None:
+            start = time.time()
+            graph = data.load_tracks_graph()
+            tracks, points, descriptors = point_descriptors(
+                data, graph, self.reconstruction)
+            data.save_localization_index(reconstruction_index, tracks,
+                                         points, descriptors)
+            logger.info('Built the descriptor index of {} points in {:.2f}s'.format(
+                len(tracks), time.time() - start))
+        else:
+            _, tracks, points, descriptors = index
+
+        self.tracks = tracks
+        self.points = points
+        self.descriptors = descriptors
+        self.index = features.build_flann_index(descriptors, self.config)
+
+    def camera(self, metadata):
+        """Camera of an image given its EXIF metadata.
+
+        The camera of the reconstruction is used if it has the same id,
+        since its parameters are optimized.
+        """
+        camera = self.reconstruction.cameras.get(metadata['camera'])
+        if camera is None:
+            camera = exif.camera_from_exif_metadata(metadata, self.data)
+        return camera
+
+    def match(self, descriptors):
+        """Matches between query descriptors and the points.
+
+        Returns:
+            an array of (query feature index, point index) pairs.
+        """
+        descriptors = descriptors.astype(self.descriptors.dtype)
+        matches = matching.match_lowe(self.index, descriptors, self.config)
+        if len(matches) == 0:
+            return np.zeros((0, 2), dtype=int)
+        return matches[:, [1, 0]]
+
+    def localize_features(self, points, descriptors, camera):
+        """Pose of a camera from its features.
+
+        Args:
+            points: normalized coordinates of the features.
+            descriptors: their descriptors.
+            camera: the camera model of the image.
+
+        Returns:
+            a dict with the pose, None if the image could not be
+            localized, and the number of matches and inliers.
+        """
+        result = {'pose': None, 'num_matches': 0, 'num_inliers': 0}
+        matches = self.match(descriptors)
+        result['num_matches'] = len(matches)
+        if len(matches) < 5:
+            return result
+
+        bs = camera.pixel_bearings(points[matches[:, 0], :2])
+        Xs = self.points[matches[:, 1]]
+        threshold = self.config.get('resection_threshold', 0.004)
+        T = recon.absolute_pose_ransac(bs, Xs, threshold)
+        inliers = recon.resection_inliers(bs, Xs, T, threshold)
+        result['num_inliers'] = int(np.sum(inliers))
+        if result['num_inliers'] >= self.config.get('resection_min_inliers', 15):
+            result['pose'] = recon.pose_from_resection(T)
+        return result
+
+    def localize(self, filename, camera=None):
+        """Localize an image file.
+
+        The camera model is computed from the EXIF metadata of the image
+        if not given.
+
+        Returns:
+            the result of localize_features, with the camera and the time
+            it took.
+        """
+        start = time.time()
+        image = io.imread(filename)
+        if camera is None:
+            with open(filename, 'rb') as fin:
+                metadata = exif.extract_exif_from_file(fin)
+            if metadata['width'] <= 0 or not self.config['use_exif_size']:
+                metadata['height'], metadata['width'] = image.shape[:2]
+            camera = self.camera(metadata)
+        points, descriptors, _ = features.extract_features(image, self.config)
+        result = self.localize_features(points, descriptors, camera)
+        result['camera'] = camera
+        result['time'] = time.time() - start
+        return result
+
+
+def tag_map(reconstruction):
+    """Reconstructed corners of the tags of a reconstruction.
+
+    Corners reconstructed as several points are averaged.  Only the tags
+    whose four corners are reconstructed are kept.
+
+    Returns:
+        a dict from tag ids to 4x3 arrays of their corners, ordered by
+        corner id.
+    """
+    corners = {}
+    for point in reconstruction.points.itervalues():
+        if point.on_tag:
+            tag_corners = corners.setdefault(str(point.tag_id), {})
+            tag_corners.setdefault(int(point.tag_corner), []).append(
+                point.coordinates)
+    return {tag_id: np.array([np.mean(tag_corners[c], axis=0) for c in range(4)])
+            for tag_id, tag_corners in corners.iteritems()
+            if all(c in tag_corners for c in range(4))}
+
+
+class TagLocalizer(object):
+    """Localize query images from the tags of the tag map they see.
+
+    The tag map is loaded, or computed from the reconstruction and saved
+    if it does not exist, is older than the reconstruction or was built
+    from another reconstruction.  Only the
+    AprilTag detector runs on the query images.  If refine is set, the
+    pose is refined with the features matching reconstructed points that
+    agree with it, which takes the time of the feature pipeline.
+    """
+
+    def __init__(self, data, reconstruction_index=0, refine=False):
+        self.data = data
+        self.config = data.config
+        saved = None
+        if data.tag_map_exists():
+            saved = data.load_tag_map()
+            if saved[0] != reconstruction_index:
+                saved = None
+        if saved is None:
+            reconstruction = data.load_reconstruction()[reconstruction_index]
+            self.tag_map = tag_map(reconstruction)
+            self.cameras = reconstruction.cameras
+            data.save_tag_map(reconstruction_index, self.tag_map, self.cameras)
+        else:
+            _, self.tag_map, self.cameras = saved
+        self.localizer = None
+        if refine:
+            self.localizer = Localizer(data, reconstruction_index)
+
+    def camera(self, metadata):
+        """Camera of an image given its EXIF metadata."""
+        camera = self.cameras.get(metadata['camera'])
+        if camera is None:
+            camera = exif.camera_from_exif_metadata(metadata, self.data)
+        return camera
+
+    def detect(self, filename):
+        """Tag detections of an image file."""
+        folder = tempfile.mkdtemp()
+        try:
+            jsonpath = os.path.join(folder, 'detections.json')
+            detect_tags.run_apriltag_detector(os.path.abspath(filename), jsonpath)
+            if not os.path.isfile(jsonpath):
+                return []
+            with open(jsonpath) as fin:
+                detections = io.tag_detections_from_json(json.load(fin))
+        finally:
+            shutil.rmtree(folder)
+        return [d for image_detections in detections.values()
+                for d in image_detections]
+
+    def localize_tags(self, detections, camera):
+        """Pose of a camera from the tags detected in its image.
+
+        A pose is computed from each tag of the map with planar PnP.  The
+        one that agrees with the most corners is refined on them.
+
+        Returns:
+            a dict with the pose T = [R|t], None if the image could not be
+            localized, the number of tags of the map and of inlier corners.
+        """
+        bs, Xs = [], []
+        for detection in detections:
+            corners = self.tag_map.get(str(detection.id))
+            if corners is not None:
+                pixels = features.normalized_image_coordinates(
+                    np.array(detection.corners, dtype=float),
+                    camera.width, camera.height)
+                bs.append(camera.pixel_bearings(pixels))
+                Xs.append(corners)
+        result = {'T': None, 'num_tags': len(bs), 'num_inliers': 0}
+        if not bs:
+            return result
+        bs = np.concatenate(bs)
+        Xs = np.concatenate(Xs)
+
+        threshold = self.config.get('resection_threshold', 0.004)
+        best_T, best_inliers = None, None
+        for i in range(0, len(bs), 4):
+            T = recon.tag_pnp_pose(bs[i:i + 4], Xs[i:i + 4])
+            if T is None:
+                continue
+            inliers = recon.resection_inliers(bs, Xs, T, threshold)
+            if best_T is None or np.sum(inliers) > np.sum(best_inliers):
+                best_T, best_inliers = T, inliers
+        if best_T is None:
+            return result
+
+        T = best_T
+        if np.sum(best_inliers) > 4:
+            T = pyopengv.absolute_pose_optimize_nonlinear(
+                bs[best_inliers], Xs[best_inliers], best_T[:, 3], best_T[:, :3])
+        result['T'] = T
+        result['bearings'] = bs[best_inliers]
+        result['points'] = Xs[best_inliers]
+        result['num_inliers'] = int(np.sum(best_inliers))
+        return result
+
+    def refine(self, result, image, camera):
+        """Refine a pose with the feature matches that agree with it."""
+        points, descriptors, _ = features.extract_features(image, self.config)
+        matches = self.localizer.match(descriptors)
+        result['num_matches'] = len(matches)
+        if len(matches) == 0:
+            return
+
+        bs = camera.pixel_bearings(points[matches[:, 0], :2])
+        Xs = self.localizer.points[matches[:, 1]]
+        threshold = self.config.get('resection_threshold', 0.004)
+        inliers = recon.resection_inliers(bs, Xs, result['T'], threshold)
+        result['num_point_inliers'] = int(np.sum(inliers))
+        if np.any(inliers):
+            bs = np.concatenate((result['bearings'], bs[inliers]))
+            Xs = np.concatenate((result['points'], Xs[inliers]))
+            result['T'] = pyopengv.absolute_pose_optimize_nonlinear(
+                bs, Xs, result['T'][:, 3], result['T'][:, :3])
+
+    def localize(self, filename, camera=None):
+        """Localize an image file.
+
+        The camera model is computed from the EXIF metadata of the image
+        if not given.
+
+        Returns:
+            a dict with the pose, the camera, the number of tags of the map
+            seen by the image and of inlier corners and the time it took.
+        """
+        start = time.time()
+        image = None
+        if camera is None:
+            with open(filename, 'rb') as fin:
+                metadata = exif.extract_exif_from_file(fin)
+            if metadata['width'] <= 0 or not self.config['use_exif_size']:
+                image = io.imread(filename)
+                metadata['height'], metadata['width'] = image.shape[:2]
+            camera = self.camera(metadata)
+
+        result = self.localize_tags(self.detect(filename), camera)
+        if result['T'] is not None and self.localizer is not None:
+            if image is None:
+                image = io.imread(filename)
+            self.refine(result, image, camera)
+
+        result['pose'] = None
+        if result['T'] is not None:
+            result['pose'] = recon.pose_from_resection(result['T'])
+        for key in ['T', 'bearings', 'points']:
+            result.pop(key, None)
+        result['camera'] = camera
+        result['time'] = time.time() - start
+        return result
+
+
+def result_to_json(image, result):
+    """JSON serializable version of a localization result."""
+    obj = {
+        'image': image,
+        'localized': result['pose'] is not None,
+        'time': result.get('time'),
+    }
+    for key, value in result.items():
+        if key.startswith('num_'):
+            obj[key] = value
+    if result['pose'] is not None:
+        obj['camera'] = result['camera'].id
+        obj['rotation'] = list(result['pose'].rotation)
+        obj['translation'] = list(result['pose'].translation)
+    return obj
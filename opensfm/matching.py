@@ -246,6 +246,90 @@ def create_tracks_graph(features, colors, matches, tag_features, tag_idx, tag_co
     return tracks_graph
 
 
+def extend_tracks_graph(graph, features, colors, matches, tag_features, tag_idx, tag_colors, tag_matches, tag_ids, config):
+    """Add the matches of new images to an existing tracks graph.
+
+    The matches are those of the new images with the images of the graph
+    or between themselves.  A set of matched features joining a single
+    track of the graph extends that track, a set joining no track makes a
+    new track and a set joining several tracks is dropped, since these
+    tracks may already be reconstructed as different points.
+
+    Only the features and tag features of the images of the matches are
+    needed.  Returns the number of extended and new tracks.
+    """
+    tracks, _ = tracks_and_images(graph)
+    next_track_id = max([int(t) for t in tracks] + [-1]) + 1
+    min_length = config.get('min_track_length', 2)
+
+    # features are (image, feature id, is tag feature)
+    uf = UnionFind()
+    for im1, im2 in matches:
+        for f1, f2 in matches[im1, im2]:
+            uf.union((im1, f1, False), (im2, f2, False))
+    tag_of = {}
+    if config.get('tag_tracks', False):
+        for im1, im2 in tag_matches:
+            for f1, f2, tag_id in tag_matches[im1, im2]:
+                uf.union((im1, f1, True), (im2, f2, True))
+                tag_of[im1, f1] = tag_of[im2, f2] = tag_id
+
+    # tracks of the matched features already in the graph
+    existing = {}
+    for image in set(element[0] for element in uf):
+        if image in graph:
+            for track, edge in graph[image].iteritems():
+                key = (image, edge['feature_id'], bool(edge.get('tag_feature', 0)))
+                existing[key] = track
+
+    sets = {}
+    for element in uf:
+        sets.setdefault(uf[element], []).append(element)
+
+    extended, created = 0, 0
+    for elements in sets.values():
+        new_elements = [e for e in elements if e not in existing]
+        joined = set(existing[e] for e in elements if e in existing)
+        images = [e[0] for e in elements]
+        if not new_elements or len(joined) > 1 or len(images) != len(set(images)):
+            continue
+        if joined:
+            track = joined.pop()
+            if any(e[0] in graph[track] for e in new_elements):
+                continue
+            extended += 1
+        else:
+            if len(elements) < min_length:
+                continue
+            track = str(next_track_id)
+            next_track_id += 1
+            created += 1
+
+        graph.add_node(track, bipartite=1)
+        for image, feature_id, on_tag in new_elements:
+            if on_tag:
+                x, y = tag_features[image][feature_id]
+                r, g, b = tag_colors[image][feature_id]
+                tag_id = tag_of[image, feature_id]
+                corner_id = tag_idx[image][feature_id]
+            else:
+                x, y = features[image][feature_id]
+                r, g, b = colors[image][feature_id]
+                tag_id, corner_id = 0, 0
+            graph.add_node(image, bipartite=0)
+            graph.add_edge(image,
+                           track,
+                           feature=(x, y),
+                           feature_id=feature_id,
+                           feature_color=(float(r), float(g), float(b)),
+                           tag_feature=int(on_tag),
+                           tag_id=tag_id,
+                           corner_id=corner_id)
+
+    logger.debug('Extended tracks: {}  new tracks: {}'.format(extended, created))
+    return extended, created
+
+
 def tracks_and_images(graph):
     """List of tracks and images in the graph."""
     tracks, images = [], []
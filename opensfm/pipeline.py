@@ -0,0 +1,366 @@
+"""Incremental runner of the reconstruction pipeline.
+
+The pipeline is a graph of stages, one per command.  Every stage has a
+fingerprint made of the values of the config keys it reads, the
+fingerprints of the stages it depends on and, for the stages reading
+the images, the digests of the images.  The fingerprints of the stages
+that ran successfully are recorded in the dataset, and a stage only runs
+again when its fingerprint changed.
+
+Stages doing independent work per image also record a fingerprint per
+image.  Before running them again, the outputs of the images whose
+fingerprint changed are removed, so that the command, which skips the
+images that already have outputs, only processes those images.
+
+Stages whose dependencies are done run concurrently, up to a number of
+jobs, as separate `bin/opensfm` processes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from opensfm import dataset
+
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+TAG_CONFIG_KEYS = ['use_apriltags', 'use_arucotags', 'use_chromatags']
+
+
+class Stage(object):
+    """A step of the pipeline.
+
+    Attributes:
+        name: the name of the command running the stage.
+        dependencies: names of the stages that must run before.
+        config_keys: config keys read by the stage.  Keys ending with an
+            underscore match all the keys starting with them.
+        tag_dependencies: extra dependencies when tags are used.
+        reads_images: whether the stage reads the images.
+        input_files: other files of the dataset read by the stage.
+        clean_image: function(data, image) removing the outputs of an
+            image, for stages skipping the images with outputs.
+        clean: function(data) removing the outputs of the stage, for
+            stages that would otherwise skip work.
+    """
+
+    def __init__(self, name, dependencies=(), config_keys=(),
+                 tag_dependencies=(), reads_images=False, input_files=(),
+                 clean_image=None, clean=None):
+        self.name = name
+        self.dependencies = list(dependencies)
+        self.config_keys = list(config_keys)
+        self.tag_dependencies = list(tag_dependencies)
+        self.reads_images = reads_images
+        self.input_files = list(input_files)
+        self.clean_image = clean_image
+        self.clean = clean
+
+    def stage_dependencies(self, config):
+        """Names of the stages this stage depends on with a given config."""
+        if uses_tags(config):
+            return self.dependencies + self.tag_dependencies
+        return self.dependencies
+
+    def config_values(self, config):
+        """Values of the config keys read by the stage."""
+        values = {}
+        for key in sorted(config):
+            for pattern in self.config_keys:
+                if key == pattern or (pattern.endswith('_') and key.startswith(pattern)):
+                    values[key] = config[key]
+                    break
+        return values
+
+
+def uses_tags(config):
+    return any(config.get(key, False) for key in TAG_CONFIG_KEYS)
+
+
+def _clean_tag_detection(data, image):
+    data.remove_tag_detection(image)
+
+
+def _clean_merged_tag_detection(data):
+    data.remove_tag_detection()
+
+
+def _clean_features(data, image):
+    data.remove_features(image)
+
+
+def _clean_depthmaps(data):
+    path = data._depthmap_path()
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+TAG_KEYS = TAG_CONFIG_KEYS + ['ratio_tags_to_keep']
+
+STAGES = [
+    Stage('extract_metadata',
+          config_keys=['use_exif_size', 'default_focal_prior'],
+          reads_images=True,
+          input_files=['camera_models_overrides.json']),
+    Stage('detect_tags',
+          config_keys=TAG_KEYS,
+          reads_images=True,
+          clean_image=_clean_tag_detection,
+          clean=_clean_merged_tag_detection),
+    Stage('detect_features',
+          dependencies=['extract_metadata'],
+          tag_dependencies=['detect_tags'],
+          config_keys=['feature_', 'sift_', 'surf_', 'akaze_', 'hahog_',
+                       'preemptive_max', 'matcher_type', 'flann_',
+                       'prune_features_on_tags'] + TAG_KEYS,
+          reads_images=True,
+          clean_image=_clean_features),
+    Stage('match_features',
+          dependencies=['extract_metadata', 'detect_features'],
+          tag_dependencies=['detect_tags'],
+          config_keys=['lowes_ratio', 'preemptive_', 'matcher_type',
+                       'prune_with_', 'flann_', 'matching_',
+                       'robust_matching_'] + TAG_KEYS),
+    Stage('create_tracks',
+          dependencies=['match_features'],
+          config_keys=['min_track_length', 'tag_tracks'] + TAG_KEYS),
+    Stage('reconstruct',
+          dependencies=['create_tracks'],
+          config_keys=['five_point_', 'triangulation_', 'resection_',
+                       'lazy_pair_', 'precompute_cache', 'retriangulation',
+                       'min_track_length', 'loss_function', 'homography_',
+                       'reprojection_error_sd', 'exif_focal_sd',
+                       'radial_distorsion_', 'bundle_', 'optimize_',
+                       'local_bundle_radius', 'reconstruction_format',
+                       'save_partial_reconstructions',
+                       'partial_reconstructions_format', 'journal_',
+                       'use_altitude_tag', 'align_', 'tag_',
+                       'ba_constraint_'] + TAG_KEYS),
+    Stage('mesh',
+          dependencies=['reconstruct'],
+          config_keys=['reconstruction_format']),
+    Stage('undistort',
+          dependencies=['reconstruct'],
+          config_keys=['undistort_', 'reconstruction_format']),
+    Stage('compute_depthmaps',
+          dependencies=['undistort'],
+          config_keys=['depthmap_', 'ply_format'],
+          clean=_clean_depthmaps),
+    Stage('export_ply',
+          dependencies=['reconstruct'],
+          config_keys=['ply_format', 'reconstruction_format']),
+]
+
+DEFAULT_STAGES = ['extract_metadata', 'detect_tags', 'detect_features',
+                  'match_features', 'create_tracks', 'reconstruct', 'mesh',
+                  'undistort', 'export_ply']
+
+
+def _digest(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True)).hexdigest()
+
+
+def opensfm_command_launcher(stage, data):
+    """Run a stage with bin/opensfm in a separate process."""
+    opensfm = os.path.join(os.path.dirname(__file__), '..', 'bin', 'opensfm')
+    return subprocess.Popen([sys.executable, opensfm, stage.name, data.data_path])
+
+
+class PipelineRunner(object):
+    """Run the stages of the pipeline whose fingerprints changed."""
+
+    def __init__(self, data, stage_names=None, jobs=2, stages=None,
+                 launcher=opensfm_command_launcher, poll_interval=0.5):
+        stages = stages or STAGES
+        stage_names = stage_names or DEFAULT_STAGES
+        self.data = data
+        self.stages = [s for s in stages if s.name in stage_names]
+        self.jobs = max(1, jobs)
+        self.launcher = launcher
+        self.poll_interval = poll_interval
+        self.state = self._load_state()
+
+    def _load_state(self):
+        filename = self.data.pipeline_state_file()
+        if os.path.isfile(filename):
+            with open(filename) as fin:
+                state = json.load(fin)
+            if state.get('version') == STATE_VERSION:
+                return state
+        return {'version': STATE_VERSION, 'images': {}, 'stages': {}}
+
+    def _save_state(self):
+        filename = self.data.pipeline_state_file()
+        temp_file = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(temp_file, 'w') as fout:
+            json.dump(self.state, fout, indent=4, sort_keys=True)
+        os.rename(temp_file, filename)
+
+    def image_digests(self):
+        """Digests of the images, only rehashing the modified files."""
+        known = self.state['images']
+        images = {}
+        for image in self.data.images():
+            size, mtime = self.data.image_stat(image)
+            entry = known.get(image)
+            if entry is None or entry[0] != size or entry[1] != mtime:
+                entry = [size, mtime, self.data.image_digest(image)]
+            images[image] = entry
+        self.state['images'] = images
+        return {image: entry[2] for image, entry in images.items()}
+
+    def fingerprints(self):
+        """Compute the stage and per image fingerprints.
+
+        Returns:
+            a dict from stage names to (fingerprint, image fingerprints)
+            tuples, where image fingerprints is None for stages not
+            working per image.
+        """
+        config = self.data.config
+        digests = self.image_digests()
+        names = set(s.name for s in self.stages)
+        fingerprints = {}
+        for stage in self._sorted_stages():
+            dependencies = [d for d in stage.stage_dependencies(config)
+                            if d in names]
+            config_values = stage.config_values(config)
+            image_fingerprints = None
+            if stage.reads_images:
+                image_fingerprints = {}
+                for image, digest in digests.items():
+                    upstream = [fingerprints[d][1][image] for d in dependencies
+                                if fingerprints[d][1] is not None]
+                    image_fingerprints[image] = _digest(
+                        [stage.name, config_values, digest, upstream])
+            fingerprint = _digest([
+                stage.name,
+                config_values,
+                image_fingerprints or sorted(digests),
+                [fingerprints[d][0] for d in dependencies],
+                self._input_file_digests(stage),
+            ])
+            fingerprints[stage.name] = fingerprint, image_fingerprints
+        return fingerprints
+
+    def _input_file_digests(self, stage):
+        digests = []
+        for name in stage.input_files:
+            filename = os.path.join(self.data.data_path, name)
+            if os.path.isfile(filename):
+                digests.append([name, dataset.file_digest(filename)])
+        return digests
+
+    def _sorted_stages(self):
+        """Stages sorted so that dependencies come first."""
+        config = self.data.config
+        by_name = {s.name: s for s in self.stages}
+        done = set()
+        result = []
+
+        def visit(stage, path):
+            if stage.name in done:
+                return
+            if stage.name in path:
+                raise ValueError('Cyclic pipeline dependencies at {}'.format(stage.name))
+            for d in stage.stage_dependencies(config):
+                if d in by_name:
+                    visit(by_name[d], path + [stage.name])
+            done.add(stage.name)
+            result.append(stage)
+
+        for stage in self.stages:
+            visit(stage, [])
+        return result
+
+    def outdated_stages(self, fingerprints, force=()):
+        """Names of the stages that need to run."""
+        recorded = self.state['stages']
+        return [s.name for s in self._sorted_stages()
+                if s.name in force or
+                recorded.get(s.name, {}).get('fingerprint') != fingerprints[s.name][0]]
+
+    def _prepare(self, stage, fingerprints, force):
+        """Remove the outputs the stage would otherwise reuse."""
+        image_fingerprints = fingerprints[stage.name][1]
+        recorded = self.state['stages'].get(stage.name, {}).get('images', {})
+        if stage.clean_image is not None:
+            changed = [image for image, fingerprint in image_fingerprints.items()
+                       if stage.name in force or recorded.get(image) != fingerprint]
+            logger.info('{}: {} of {} images to process'.format(
+                stage.name, len(changed), len(image_fingerprints)))
+            for image in changed:
+                stage.clean_image(self.data, image)
+        if stage.clean is not None:
+            stage.clean(self.data)
+
+    def _record(self, stage, fingerprints):
+        fingerprint, image_fingerprints = fingerprints[stage.name]
+        self.state['stages'][stage.name] = {
+            'fingerprint': fingerprint,
+            'images': image_fingerprints or {},
+            'config': stage.config_values(self.data.config),
+        }
+        self._save_state()
+
+    def run(self, force=()):
+        """Run the outdated stages.
+
+        Returns:
+            the names of the stages that ran.
+        """
+        fingerprints = self.fingerprints()
+        outdated = self.outdated_stages(fingerprints, force)
+        for stage in self._sorted_stages():
+            if stage.name not in outdated:
+                logger.info('{}: up to date'.format(stage.name))
+        self._save_state()
+
+        config = self.data.config
+        by_name = {s.name: s for s in self.stages}
+        pending = [by_name[name] for name in outdated]
+        running = {}
+        finished = []
+        failed = []
+        while pending or running:
+            if not failed:
+                for stage in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+                    waiting = [d for d in stage.stage_dependencies(config)
+                               if d in by_name and
+                               (d in running or by_name[d] in pending)]
+                    if waiting:
+                        continue
+                    pending.remove(stage)
+                    self._prepare(stage, fingerprints, force)
+                    logger.info('{}: running'.format(stage.name))
+                    running[stage.name] = (stage, self.launcher(stage, self.data), time.time())
+            elif not running:
+                break
+
+            for name, (stage, process, start) in list(running.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                del running[name]
+                if code == 0:
+                    logger.info('{}: done in {:.1f}s'.format(name, time.time() - start))
+                    self._record(stage, fingerprints)
+                    finished.append(name)
+                else:
+                    logger.error('{}: failed with exit code {}'.format(name, code))
+                    failed.append(name)
+            if running:
+                time.sleep(self.poll_interval)
+
+        if failed:
+            raise RuntimeError('Pipeline stages failed: {}'.format(', '.join(failed)))
+        return finished
@@ -0,0 +1,223 @@
+"""Content-addressed cache of the reconstruction precomputations.
+
+The common tracks of the image pairs, their reconstructability scores and
+the tag graph components only depend on the tracks (and tag graph) files
+and on a few config values.  They are stored in the cache folder of the
+dataset as numpy .npz files named after a hash of the content of these
+files and of the relevant config values, so that repeated runs and
+experiment sweeps load them instead of recomputing them.
+
+The least recently used entries are removed when the cache grows bigger
+than `precompute_cache_size` megabytes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from opensfm import matching
+from opensfm import types
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+class PrecomputeCache:
+    """Cache of common tracks, pair scores and tag components."""
+
+    def __init__(self, data):
+        self.data = data
+        self.path = data.precompute_cache_path()
+        self.max_size = data.config.get('precompute_cache_size', 512) * 1024 * 1024
+        self._tracks_digest = None
+        self._tags_digest = None
+
+    def common_tracks(self, graph, tracks):
+        """Load or compute matching.all_common_tracks(graph, tracks)."""
+        key = self._key('common_tracks', tracks=True)
+        arrays = self._load(key)
+        if arrays is not None:
+            return _common_tracks_from_arrays(arrays)
+        common_tracks = matching.all_common_tracks(graph, tracks)
+        self._save(key, _common_tracks_to_arrays(common_tracks))
+        return common_tracks
+
+    def pair_scores(self):
+        """Load the known pair reconstructability scores.
+
+        Returns a dict that can be filled by the compute_image_pairs
+        functions and given back to save_pair_scores.
+        """
+        arrays = self._load(self._pair_scores_key())
+        if arrays is None:
+            return {}
+        images = arrays['images'].tolist()
+        return {(images[i], images[j]): int(r)
+                for (i, j), r in zip(arrays['pairs'], arrays['scores'])}
+
+    def save_pair_scores(self, scores):
+        """Store the pair scores if there are new ones."""
+        key = self._pair_scores_key()
+        arrays = self._load(key)
+        if arrays is not None and len(arrays['scores']) >= len(scores):
+            return
+        images = sorted(set(im for pair in scores for im in pair))
+        index = {im: i for i, im in enumerate(images)}
+        pairs = sorted(scores)
+        self._save(key, {
+            'images': np.array(images),
+            'pairs': np.array([(index[im1], index[im2]) for im1, im2 in pairs],
+                              dtype=np.int32).reshape(-1, 2),
+            'scores': np.array([scores[p] for p in pairs], dtype=np.int64),
+        })
+
+    def tag_components(self, tags_graph):
+        """Load or compute matching.tag_connected_components(tags_graph)."""
+        key = self._key('tag_components', tracks=False, tags=True)
+        arrays = self._load(key)
+        if arrays is not None:
+            nodes = arrays['nodes'].tolist()
+            offsets = arrays['offsets']
+            return [_tag_subgraph(tags_graph, nodes[offsets[i]:offsets[i + 1]])
+                    for i in range(len(offsets) - 1)]
+        components = matching.tag_connected_components(tags_graph)
+        nodes = [n for c in components for n in c.graph.nodes()]
+        offsets = np.cumsum([0] + [c.graph.number_of_nodes() for c in components])
+        self._save(key, {
+            'nodes': np.array(nodes),
+            'offsets': np.array(offsets, dtype=np.int64),
+        })
+        return components
+
+    def _pair_scores_key(self):
+        return self._key('pair_scores', tracks=True,
+                         homography_threshold=self.data.config.get('homography_threshold', 0.004))
+
+    def _key(self, name, tracks=True, tags=False, **values):
+        """Hash of the input files and config values of an entry."""
+        config = self.data.config
+        description = {
+            'version': CACHE_VERSION,
+            'name': name,
+            'min_track_length': config.get('min_track_length', 2),
+            'resection_with_tags': config.get('resection_with_tags', False),
+        }
+        description.update(values)
+        if tracks:
+            if self._tracks_digest is None:
+                self._tracks_digest = self.data.tracks_graph_digest()
+            description['tracks'] = self._tracks_digest
+        if tags:
+            if self._tags_digest is None:
+                self._tags_digest = self.data.tags_graph_digest()
+            description['tags'] = self._tags_digest
+        sha1 = hashlib.sha1(json.dumps(description, sort_keys=True))
+        return name + '_' + sha1.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def _load(self, key):
+        filename = self._file(key)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with open(filename, 'rb') as fin:
+                arrays = dict(np.load(fin).items())
+        except (IOError, ValueError, KeyError):
+            logger.warning('Ignoring corrupted cache entry {}'.format(filename))
+            return None
+        os.utime(filename, None)
+        logger.debug('Loaded {} from the precompute cache'.format(key))
+        return arrays
+
+    def _save(self, key, arrays):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        filename = self._file(key)
+        temp_file = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(temp_file, 'wb') as fout:
+            np.savez(fout, **arrays)
+        os.rename(temp_file, filename)
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries above the size limit."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                filename = os.path.join(self.path, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue  # removed by another process
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+            logger.debug('Evicted {} from the precompute cache'.format(filename))
+
+
+def _common_tracks_to_arrays(common_tracks):
+    pairs = sorted(common_tracks)
+    images = sorted(set(im for pair in pairs for im in pair))
+    index = {im: i for i, im in enumerate(images)}
+    counts = [len(common_tracks[p][0]) for p in pairs]
+
+    def concatenate(i, dtype=None):
+        values = [v for p in pairs for v in common_tracks[p][i]]
+        return np.array(values, dtype=dtype)
+
+    return {
+        'images': np.array(images),
+        'pairs': np.array([(index[im1], index[im2]) for im1, im2 in pairs],
+                          dtype=np.int32).reshape(-1, 2),
+        'offsets': np.cumsum([0] + counts).astype(np.int64),
+        'tracks': concatenate(0),
+        'p1': np.concatenate([common_tracks[p][1] for p in pairs]) if pairs else np.zeros((0, 2)),
+        'p2': np.concatenate([common_tracks[p][2] for p in pairs]) if pairs else np.zeros((0, 2)),
+        'ontag': concatenate(3, np.int8),
+        'tag_id': concatenate(4),
+        'corner_id': concatenate(5, np.int32),
+    }
+
+
+def _common_tracks_from_arrays(arrays):
+    images = arrays['images'].tolist()
+    offsets = arrays['offsets']
+    tracks = arrays['tracks'].tolist()
+    ontag = arrays['ontag'].tolist()
+    tag_id = arrays['tag_id'].tolist()
+    corner_id = arrays['corner_id'].tolist()
+    common_tracks = {}
+    for k, (i, j) in enumerate(arrays['pairs']):
+        a, b = offsets[k], offsets[k + 1]
+        common_tracks[images[i], images[j]] = (
+            tracks[a:b], arrays['p1'][a:b], arrays['p2'][a:b],
+            ontag[a:b], tag_id[a:b], corner_id[a:b])
+    return common_tracks
+
+
+def _tag_subgraph(tags_graph, nodes):
+    graph = tags_graph.subgraph(nodes)
+    component = types.TagSubGraph()
+    component.graph = graph
+    component.num_tags_in_images = {}
+    for n, d in graph.nodes(data=True):
+        if d['bipartite'] == 0:
+            component.num_tags_in_images[n] = len(graph[n])
+            component.num_imgs += 1
+        else:
+            component.num_tags += 1
+    return component
@@ -0,0 +1,420 @@
+"""Timing spans and counters of the pipeline.
+
+Code is instrumented with nested spans and counters:
+
+    with profiling.span('bundle'):
+        ...
+        profiling.count('bundle/iterations', n)
+
+When profiling is enabled, every span that ends is written as a JSON line
+with its path, the names of the enclosing spans joined by '/', and its
+duration.  Counters are accumulated in memory and written when a span
+ends, so that processes forked by a pool also report theirs.  When
+profiling is disabled, span returns a shared no-op context manager and
+count returns right away.
+
+The lines of a run share a run id, so that the runs of a command can be
+told apart when the file accumulates several of them.
+
+Memory profiling additionally samples the resident memory (RSS) of the
+process in a background thread and records the peak RSS of every span,
+and the sizes of the main structures given to size.  A snapshot of the
+allocations can be written at any time by sending SIGUSR1 to a process.
+It uses tracemalloc when it is available and tracing, and counts the
+objects tracked by the garbage collector by type otherwise.
+"""
+
+import gc
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+PROFILE_FILE = 'profile.jsonl'
+
+_recorder = None
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+class _Span(object):
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.stack = self.recorder.stack()
+        self.stack.append(self.name)
+        self.path = '/'.join(self.stack)
+        if self.recorder.memory:
+            self.rss_peak = current_rss()
+            self.recorder.open_span(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        duration = time.time() - self.start
+        self.stack.pop()
+        memory = None
+        if self.recorder.memory:
+            self.recorder.close_span(self)
+            rss = current_rss()
+            memory = {'rss': rss, 'rss_peak': max(self.rss_peak, rss)}
+        self.recorder.write_span(self.path, self.start, duration, memory)
+        return False
+
+
+def current_rss():
+    """Resident memory of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * _page_size()
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is not None:
+        # peak instead of current resident memory, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+
+def _page_size():
+    try:
+        return os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return 4096
+
+
+class Recorder(object):
+    """Write spans and counters to a JSON lines file."""
+
+    def __init__(self, filename, command, run=None, memory_interval=None):
+        self.filename = filename
+        self.command = command
+        self.run = run or uuid.uuid4().hex
+        self.counters = {}
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pid = os.getpid()
+        self.memory = memory_interval is not None
+        self.memory_interval = memory_interval
+        self.spans = set()
+        if self.memory:
+            self._start_sampler()
+
+    def _start_sampler(self):
+        stopped = self.sampler_stopped = threading.Event()
+
+        def sample():
+            while not stopped.wait(self.memory_interval):
+                rss = current_rss()
+                with self.lock:
+                    for span in self.spans:
+                        span.rss_peak = max(span.rss_peak, rss)
+
+        thread = threading.Thread(target=sample)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.memory:
+            self.sampler_stopped.set()
+
+    def open_span(self, span):
+        self._check_fork()
+        with self.lock:
+            self.spans.add(span)
+
+    def close_span(self, span):
+        with self.lock:
+            self.spans.discard(span)
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current_path(self):
+        return '/'.join(self.stack())
+
+    def _check_fork(self):
+        # Forked processes start with no counters, the parent reports the
+        # counts made before the fork
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.counters = {}
+            self.sizes = {}
+            self.lock = threading.Lock()
+            if self.memory:
+                # threads do not survive the fork
+                self.spans = set()
+                self._start_sampler()
+
+    def count(self, name, value):
+        self._check_fork()
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def size(self, name, value):
+        self._check_fork()
+        with self.lock:
+            self.sizes[name] = max(self.sizes.get(name, value), value)
+
+    def write_span(self, path, start, duration, memory=None):
+        event = {'type': 'span', 'name': path, 'start': start,
+                 'duration': duration}
+        if memory:
+            event.update(memory)
+        self._write([event] + self._counter_events())
+
+    def flush(self):
+        self._write(self._counter_events())
+
+    def _counter_events(self):
+        self._check_fork()
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            sizes, self.sizes = self.sizes, {}
+        return ([{'type': 'counter', 'name': name, 'value': value}
+                 for name, value in sorted(counters.items())] +
+                [{'type': 'size', 'name': name, 'value': value}
+                 for name, value in sorted(sizes.items())])
+
+    def _write(self, events):
+        if not events:
+            return
+        lines = []
+        for event in events:
+            event['run'] = self.run
+            event['command'] = self.command
+            event['pid'] = os.getpid()
+            lines.append(json.dumps(event) + '\n')
+        # A single append per call, so that the lines of concurrent
+        # processes do not interleave
+        with open(self.filename, 'a') as fout:
+            fout.write(''.join(lines))
+
+
+def enable(filename, command, run=None, memory_interval=None):
+    """Start recording spans and counters to filename.
+
+    If memory_interval is given, the RSS is sampled every memory_interval
+    seconds and SIGUSR1 writes allocation snapshots next to filename.
+    """
+    global _recorder
+    _recorder = Recorder(filename, command, run, memory_interval)
+    if memory_interval is not None:
+        folder = os.path.dirname(os.path.abspath(filename))
+        try:
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: write_snapshot(folder))
+        except (AttributeError, ValueError):
+            pass  # no SIGUSR1 or not in the main thread
+    return _recorder
+
+
+def start_command(command, data_path):
+    """Enable profiling of a command if the dataset config asks for it."""
+    from opensfm import config  # imports yaml, which is slow to import
+
+    config_file = os.path.join(data_path, 'config.yaml')
+    options = config.load_config(config_file)
+    memory = options.get('memory_profiling', False)
+    if options.get('profiling', False) or memory:
+        interval = options.get('memory_profiling_interval', 0.1) if memory else None
+        if memory and options.get('memory_profiling_tracemalloc', False):
+            start_tracemalloc()
+        enable(os.path.join(data_path, PROFILE_FILE), command,
+               memory_interval=interval)
+
+
+def disable():
+    """Write the pending counters and stop recording."""
+    global _recorder
+    if _recorder is not None:
+        _recorder.flush()
+        _recorder.stop()
+    _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def memory_enabled():
+    """Whether memory is profiled, to skip computing sizes otherwise."""
+    return _recorder is not None and _recorder.memory
+
+
+def span(name):
+    """Context manager timing a block of code."""
+    if _recorder is None:
+        return _no_span
+    return _Span(_recorder, name)
+
+
+def count(name, value=1):
+    """Add value to a counter."""
+    if _recorder is not None:
+        _recorder.count(name, value)
+
+
+def size(name, value):
+    """Record the size of a structure, keeping the largest value."""
+    if _recorder is not None and _recorder.memory:
+        _recorder.size(name, value)
+
+
+def start_tracemalloc():
+    """Start tracing allocations if tracemalloc is available."""
+    try:
+        import tracemalloc
+    except ImportError:
+        return False
+    tracemalloc.start()
+    return True
+
+
+def allocation_snapshot(limit=50):
+    """The largest allocations of the process.
+
+    Returns:
+        a dict with the kind of snapshot, 'tracemalloc' or 'gc', and a
+        list of entries with the size and count of the allocations of
+        each source line (tracemalloc) or object type (gc).  The sizes of
+        the gc census are shallow sizes.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+        entries = [{'where': str(s.traceback), 'size': s.size,
+                    'count': s.count} for s in statistics[:limit]]
+        return {'kind': 'tracemalloc', 'entries': entries}
+
+    sizes = {}
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+        sizes[name] = sizes.get(name, 0) + sys.getsizeof(obj, 0)
+    names = sorted(sizes, key=lambda n: -sizes[n])[:limit]
+    entries = [{'where': n, 'size': sizes[n], 'count': counts[n]}
+               for n in names]
+    return {'kind': 'gc', 'entries': entries}
+
+
+def write_snapshot(folder, limit=50):
+    """Write an allocation snapshot of this process to folder."""
+    snapshot = allocation_snapshot(limit)
+    snapshot['pid'] = os.getpid()
+    snapshot['time'] = time.time()
+    snapshot['rss'] = current_rss()
+    if _recorder is not None:
+        snapshot['command'] = _recorder.command
+        snapshot['span'] = _recorder.current_path()
+    filename = os.path.join(folder, 'memory_snapshot.{}.{}.json'.format(
+        os.getpid(), int(snapshot['time'])))
+    with open(filename, 'w') as fout:
+        json.dump(snapshot, fout, indent=4)
+    return filename
+
+
+def record(name, duration):
+    """Record a span already timed, nested in the current span."""
+    if _recorder is not None:
+        path = _recorder.current_path()
+        path = path + '/' + name if path else name
+        _recorder.write_span(path, time.time() - duration, duration)
+
+
+def load_events(filename):
+    """Read the events of a profile file, skipping truncated lines."""
+    events = []
+    if not os.path.isfile(filename):
+        return events
+    with open(filename) as fin:
+        for line in fin:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events
+
+
+def last_runs(events):
+    """Events of the last run of each command."""
+    last = {}
+    for event in events:
+        last[event['command']] = event['run']
+    return [e for e in events if last[e['command']] == e['run']]
+
+
+def percentile(values, p):
+    """Percentile of sorted values, with linear interpolation."""
+    if len(values) == 1:
+        return values[0]
+    position = (len(values) - 1) * p / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(events):
+    """Aggregate spans and counters.
+
+    Returns:
+        (spans, counters, sizes) where spans maps span names to dicts
+        with the count, total, p50, p90, p99 and max of their durations
+        and their peak RSS if memory was profiled, counters maps counter
+        names to their sums and sizes maps size names to their maximum.
+    """
+    durations = {}
+    peaks = {}
+    counters = {}
+    sizes = {}
+    for event in events:
+        name = event['name']
+        if event['type'] == 'span':
+            durations.setdefault(name, []).append(event['duration'])
+            if 'rss_peak' in event:
+                peaks[name] = max(peaks.get(name, 0), event['rss_peak'])
+        elif event['type'] == 'counter':
+            counters[name] = counters.get(name, 0) + event['value']
+        elif event['type'] == 'size':
+            sizes[name] = max(sizes.get(name, event['value']), event['value'])
+
+    spans = {}
+    for name, values in durations.items():
+        values = sorted(values)
+        spans[name] = {
+            'count': len(values),
+            'total': sum(values),
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': values[-1],
+        }
+        if name in peaks:
+            spans[name]['rss_peak'] = peaks[name]
+    return spans, counters, sizes
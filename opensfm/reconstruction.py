@@ -16,6 +16,9 @@ from multiprocessing import Pool
 from opensfm import align
 from opensfm import csfm
 from opensfm import geo
+from opensfm import journal as journaling
+from opensfm import precompute_cache
+from opensfm import profiling
 from opensfm import matching
 from opensfm import multiview
 from opensfm import types
@@ -181,6 +184,39 @@ def bundle(graph, reconstruction, gcp, config):
 
     logger.debug('Bundle setup/run/teardown {0}/{1}/{2}'.format(
         setup - start, run - setup, teardown - run))
+    _record_bundle('bundle', ba, start, setup, run, teardown)
+    if profiling.memory_enabled():
+        _record_bundle_size(graph, reconstruction)
+
+
+def _record_bundle(name, ba, start, setup, run, teardown):
+    """Record the timings and the size of a bundle adjustment."""
+    if profiling.enabled():
+        profiling.record(name + '/setup', setup - start)
+        profiling.record(name + '/run', run - setup)
+        profiling.record(name + '/teardown', teardown - run)
+        profiling.count(name + '/runs')
+        profiling.count(name + '/iterations', ba.num_iterations())
+
+
+def _record_common_tracks_size(common_tracks):
+    """Record the number of image pairs and tracks of the common tracks."""
+    profiling.size('common_tracks/pairs', len(common_tracks))
+    profiling.size('common_tracks/tracks',
+                   sum(len(v[0]) for v in common_tracks.values()))
+
+
+def _record_bundle_size(graph, reconstruction):
+    """Record the size of the problem of a global bundle adjustment."""
+    observations = 0
+    for shot_id in reconstruction.shots:
+        if shot_id in graph:
+            for track in graph[shot_id]:
+                if track in reconstruction.points:
+                    observations += 1
+    profiling.size('bundle/shots', len(reconstruction.shots))
+    profiling.size('bundle/points', len(reconstruction.points))
+    profiling.size('bundle/observations', observations)
 
 
 def bundle_single_view(graph, reconstruction, shot_id, config):
@@ -250,7 +286,11 @@ def bundle_single_view(graph, reconstruction, shot_id, config):
 
 
 def bundle_local(graph, reconstruction, gcp, central_shot_id, config):
-    """Bundle adjust the local neighborhood of a shot."""
+    """Bundle adjust the local neighborhood of a shot.
+
+    Returns:
+        the ids of the shots and points that were moved.
+    """
     start = time.time()
 
     interior, boundary = shot_neighborhood(
@@ -359,6 +399,8 @@ def bundle_local(graph, reconstruction, gcp, central_shot_id, config):
 
     logger.debug('Local bundle setup/run/teardown {0}/{1}/{2}'.format(
         setup - start, run - setup, teardown - run))
+    _record_bundle('bundle_local', ba, start, setup, run, teardown)
+    return interior, point_ids
 
 
 def shot_neighborhood(graph, reconstruction, central_shot_id, radius):
@@ -407,15 +449,25 @@ def pairwise_reconstructability(common_tracks, homography_inliers):
         return 0
 
 
-def compute_image_pairs(track_dict, config):
-    """All matched image pairs sorted by reconstructability."""
-    args = _pair_reconstructability_arguments(track_dict, config)
+def compute_image_pairs(track_dict, config, scores=None):
+    """All matched image pairs sorted by reconstructability.
+
+    Scores found in the optional scores dict are reused and the computed
+    ones are added to it.
+    """
+    if scores is None:
+        scores = {}
+    args = [a for a in _pair_reconstructability_arguments(track_dict, config)
+            if (a[1], a[2]) not in scores]
     processes = config.get('processes', 1)
-    if processes == 1:
+    if processes == 1 or len(args) <= 1:
         result = map(_compute_pair_reconstructability, args)
     else:
         p = Pool(processes)
         result = p.map(_compute_pair_reconstructability, args)
+    for im1, im2, r in result:
+        scores[im1, im2] = r
+    result = [(im1, im2, scores[im1, im2]) for im1, im2 in track_dict]
     pairs = [(im1, im2) for im1, im2, r in result if r > 0]
     score = [r for im1, im2, r in result if r > 0]
     order = np.argsort(-np.array(score))
@@ -431,6 +483,82 @@ def _compute_pair_reconstructability(args):
     r = pairwise_reconstructability(len(p1), inliers.sum())
     return (im1, im2, r)
 
+def lazy_image_pairs(track_dict, config, remaining_images,
+                     tag_components=None, scores=None):
+    """Matched image pairs sorted by reconstructability, scored on demand.
+
+    The reconstructability of a pair is either zero or its number of
+    common tracks.  Visiting the pairs by decreasing number of common
+    tracks (within each tag component bin, as in
+    compute_image_pairs_with_tags) and skipping those that score zero
+    thus gives the same order as the eager versions.  Homographies are
+    estimated in small parallel batches as the pairs are consumed, and
+    only for pairs whose images are still in remaining_images.
+
+    Args:
+        track_dict: common tracks as returned by matching.all_common_tracks
+        config: the dataset configuration
+        remaining_images: set of images not yet reconstructed.  It is read
+            every time a new batch is scored.
+        tag_components: tag graph components, to group the pairs by
+        scores: optional dict memoizing the pair scores
+    """
+    if scores is None:
+        scores = {}
+    ranked = sorted(track_dict, key=lambda pair: (
+        _tag_component_bin(pair, tag_components),
+        -len(track_dict[pair][1])))
+
+    threshold = config.get('homography_threshold', 0.004)
+    batch_size = max(1, config.get('lazy_pair_batch_size', 16))
+    processes = config.get('processes', 1)
+    pool = None
+    try:
+        position = 0
+        while position < len(ranked):
+            batch = []
+            while position < len(ranked) and len(batch) < batch_size:
+                im1, im2 = ranked[position]
+                position += 1
+                if im1 in remaining_images and im2 in remaining_images:
+                    batch.append((im1, im2))
+
+            args = []
+            for im1, im2 in batch:
+                if (im1, im2) not in scores:
+                    p1, p2 = track_dict[im1, im2][1:3]
+                    args.append((threshold, im1, im2, p1, p2))
+            if processes == 1 or len(args) <= 1:
+                result = map(_compute_pair_reconstructability, args)
+            else:
+                if pool is None:
+                    pool = Pool(processes)
+                result = pool.map(_compute_pair_reconstructability, args)
+            for im1, im2, r in result:
+                scores[im1, im2] = r
+
+            for pair in batch:
+                if scores[pair] > 0:
+                    yield pair
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _tag_component_bin(pair, tag_components):
+    """Index of the tag component containing both images of a pair.
+
+    Pairs across components go to a last bin.
+    """
+    if not tag_components:
+        return 0
+    for i, tag_component in enumerate(tag_components):
+        if (tag_component.graph.has_node(pair[0]) and
+                tag_component.graph.has_node(pair[1])):
+            return i
+    return len(tag_components)
+
+
 def get_image_metadata(data, image):
     """Get image metadata as a ShotMetadata object."""
     metadata = types.ShotMetadata()
@@ -662,9 +790,153 @@ def reconstructed_points_for_images(graph, reconstruction, images):
     return sorted(res, key=lambda x: -x[1])
 
 
-def resect(data, graph, reconstruction, shot_id):
+class ResectionCounters:
+    """Helper to keep track of resection attempts and successes."""
+
+    def __init__(self):
+        self.attempts = 0
+        self.tag_pnp_attempts = 0
+        self.tag_pnp_successes = 0
+        self.ransac_attempts = 0
+        self.ransac_successes = 0
+
+    def report(self):
+        logger.info("Resection attempts: {}  tag PnP: {} / {}  "
+                    "RANSAC: {} / {}".format(
+                        self.attempts,
+                        self.tag_pnp_successes, self.tag_pnp_attempts,
+                        self.ransac_successes, self.ransac_attempts))
+
+
+def resection_inliers(bs, Xs, T, threshold):
+    """Observations whose bearings agree with the pose T = [R|t]."""
+    R = T[:, :3]
+    t = T[:, 3]
+
+    reprojected_bs = R.T.dot((Xs - t).T).T
+    reprojected_bs /= np.linalg.norm(reprojected_bs, axis=1)[:, np.newaxis]
+
+    return np.linalg.norm(reprojected_bs - bs, axis=1) < threshold
+
+
+def absolute_pose_ransac(bs, Xs, threshold, iterations=1000):
+    """Pose T = [R|t] of a camera from bearings and 3D points, with RANSAC."""
+    return pyopengv.absolute_pose_ransac(
+        bs, Xs, "KNEIP", 1 - np.cos(threshold), iterations)
+
+
+def pose_from_resection(T):
+    """Pose of a shot from the pose T = [R|t] computed by resection."""
+    R = T[:, :3].T
+    t = -R.dot(T[:, 3])
+    pose = types.Pose()
+    pose.set_rotation_matrix(R)
+    pose.translation = t
+    return pose
+
+
+def _planar_pnp_flag():
+    """Best available OpenCV solver for planar PnP problems."""
+    for name in ['SOLVEPNP_IPPE', 'SOLVEPNP_ITERATIVE', 'CV_ITERATIVE']:
+        if hasattr(cv2, name):
+            return getattr(cv2, name)
+    return 0
+
+
+def tag_pnp_pose(bs, Xs):
+    """Camera pose from the bearings and 3D positions of the corners of a tag.
+
+    The corners are expressed in a frame aligned with the tag plane so that
+    a planar PnP solver (IPPE when OpenCV provides it) can be used.
+
+    Args:
+        bs: 4x3 array of bearings of the tag corners
+        Xs: 4x3 array of reconstructed tag corners
+
+    Returns:
+        a 3x4 matrix [R|t] following the pyopengv absolute pose convention
+        or None if the pose can not be computed.
+    """
+    if np.any(bs[:, 2] <= 0):
+        return None
+
+    center = Xs.mean(axis=0)
+    _, _, Vt = np.linalg.svd(Xs - center)
+    if np.linalg.det(Vt) < 0:
+        Vt[2] *= -1
+    local = (Xs - center).dot(Vt.T)
+    local[:, 2] = 0
+
+    image_points = (bs[:, :2] / bs[:, 2:]).reshape((-1, 1, 2))
+    ok, rvec, tvec = cv2.solvePnP(local.reshape((-1, 1, 3)), image_points,
+                                  np.eye(3), None, flags=_planar_pnp_flag())
+    if not ok:
+        return None
+
+    Rc = cv2.Rodrigues(rvec)[0].dot(Vt)
+    tc = tvec.ravel() - Rc.dot(center)
+    return np.column_stack((Rc.T, -Rc.T.dot(tc)))
+
+
+def _tags_with_reconstructed_corners(graph, reconstruction, shot_id):
+    """Tags seen in a shot whose four corners are reconstructed.
+
+    Returns:
+        A dict mapping tag ids to the list of corner tracks, ordered by
+        corner id.
+    """
+    corners = {}
+    for track, edge in graph[shot_id].iteritems():
+        if edge.get('tag_feature') and track in reconstruction.points:
+            corners.setdefault(edge['tag_id'], {})[edge['corner_id']] = track
+    return {tag_id: [tag_corners[c] for c in range(4)]
+            for tag_id, tag_corners in corners.iteritems()
+            if all(c in tag_corners for c in range(4))}
+
+
+def resect_with_tags_pnp(graph, reconstruction, shot_id, bs, Xs, tracks,
+                         ontag, threshold, min_inliers):
+    """Resect a shot from the tags it sees.
+
+    A pose is computed from each tag whose four corners are reconstructed.
+    The one supported by the most non-tag points is refined on all its
+    inliers.
+
+    Returns:
+        The 3x4 pose [R|t] if it has at least min_inliers non-tag inliers,
+        None otherwise.
+    """
+    index = {track: i for i, track in enumerate(tracks)}
+    tags = _tags_with_reconstructed_corners(graph, reconstruction, shot_id)
+
+    best_T, best_count = None, -1
+    for tag_id, corner_tracks in tags.iteritems():
+        rows = [index[track] for track in corner_tracks]
+        T = tag_pnp_pose(bs[rows], Xs[rows])
+        if T is None:
+            continue
+        count = np.sum(resection_inliers(bs, Xs, T, threshold) & ~ontag)
+        if count > best_count:
+            best_T, best_count = T, count
+
+    if best_T is None or best_count < min_inliers:
+        return None
+
+    inliers = resection_inliers(bs, Xs, best_T, threshold)
+    T = pyopengv.absolute_pose_optimize_nonlinear(
+        bs[inliers], Xs[inliers], best_T[:, 3], best_T[:, :3])
+    if np.sum(resection_inliers(bs, Xs, T, threshold) & ~ontag) < best_count:
+        T = best_T
+    return T
+
+
+def resect(data, graph, reconstruction, shot_id, counters=None):
     """Try resecting and adding a shot to the reconstruction.
 
+    If resection_tag_pnp is set, the pose is first computed from the
+    reconstructed tags seen by the shot and absolute pose RANSAC is only
+    run when that fails.
+
     Return:
         True on success.
     """
@@ -673,6 +945,8 @@ def resect(data, graph, reconstruction, shot_id):
 
     bs = []
     Xs = []
+    tracks = []
+    ontag = []
     for track in graph[shot_id]:
         if track in reconstruction.points:
             #if tag feature and not optimizing with tag features, skip
@@ -682,34 +956,51 @@ def resect(data, graph, reconstruction, shot_id):
             b = camera.pixel_bearing(x)
             bs.append(b)
             Xs.append(reconstruction.points[track].coordinates)
+            tracks.append(track)
+            ontag.append(bool(graph[track][shot_id].get('tag_feature', 0)))
     bs = np.array(bs)
     Xs = np.array(Xs)
+    ontag = np.array(ontag, dtype=bool)
     if len(bs) < 5:
         return False
 
-    threshold = data.config.get('resection_threshold', 0.004)
-    T = pyopengv.absolute_pose_ransac(bs, Xs, "KNEIP", 1 - np.cos(threshold), 1000)
+    if counters is not None:
+        counters.attempts += 1
+    profiling.count('resection/attempts')
 
-    R = T[:, :3]
-    t = T[:, 3]
-
-    reprojected_bs = R.T.dot((Xs - t).T).T
-    reprojected_bs /= np.linalg.norm(reprojected_bs, axis=1)[:, np.newaxis]
-
-    inliers = np.linalg.norm(reprojected_bs - bs, axis=1) < threshold
+    threshold = data.config.get('resection_threshold', 0.004)
+    min_inliers = data.config.get('resection_min_inliers', 15)
+
+    T = None
+    if data.config.get('resection_tag_pnp', False) and np.any(ontag):
+        if counters is not None:
+            counters.tag_pnp_attempts += 1
+        T = resect_with_tags_pnp(graph, reconstruction, shot_id, bs, Xs,
+                                 tracks, ontag, threshold, min_inliers)
+        if T is not None:
+            logger.info("{} resected from tags".format(shot_id))
+            if counters is not None:
+                counters.tag_pnp_successes += 1
+
+    from_tags = T is not None
+    if not from_tags:
+        if counters is not None:
+            counters.ransac_attempts += 1
+        T = absolute_pose_ransac(bs, Xs, threshold)
+
+    inliers = resection_inliers(bs, Xs, T, threshold)
     ninliers = sum(inliers)
 
     logger.info("{} resection inliers: {} / {}".format(
         shot_id, ninliers, len(bs)))
-    if ninliers >= data.config.get('resection_min_inliers', 15):
-        R = T[:, :3].T
-        t = -R.dot(T[:, 3])
+    if ninliers >= min_inliers:
+        if counters is not None and not from_tags:
+            counters.ransac_successes += 1
+        profiling.count('resection/successes')
         shot = types.Shot()
         shot.id = shot_id
         shot.camera = camera
-        shot.pose = types.Pose()
-        shot.pose.set_rotation_matrix(R)
-        shot.pose.translation = t
+        shot.pose = pose_from_resection(T)
         shot.metadata = get_image_metadata(data, shot_id)
         reconstruction.add_shot(shot)
         bundle_single_view(graph, reconstruction, shot_id, data.config)
@@ -813,9 +1104,14 @@ def triangulate_shot_features(graph, reconstruction, shot_id, reproj_threshold,
     """Reconstruct as many tracks seen in shot_id as possible."""
     triangulator = TrackTriangulator(graph, reconstruction)
 
+    num_points = len(reconstruction.points)
+    num_tracks = 0
     for track in graph[shot_id]:
         if track not in reconstruction.points:
             triangulator.triangulate(track, reproj_threshold, min_ray_angle)
+            num_tracks += 1
+    profiling.count('triangulation/tracks', num_tracks)
+    profiling.count('triangulation/points', len(reconstruction.points) - num_points)
 
 
 def retriangulate(graph, reconstruction, config):
@@ -826,6 +1122,8 @@ def retriangulate(graph, reconstruction, config):
     tracks, images = matching.tracks_and_images(graph)
     for track in tracks:
         triangulator.triangulate(track, threshold, min_ray_angle)
+    profiling.count('retriangulation/tracks', len(tracks))
+    profiling.count('retriangulation/points', len(reconstruction.points))
 
 
 def remove_outliers(graph, reconstruction, config):
@@ -963,16 +1261,33 @@ class ShouldRetriangulate:
         self.num_points_last = len(reconstruction.points)
 
 
-def grow_reconstruction(data, graph, reconstruction, images, gcp):
-    """Incrementally add shots to an initial reconstruction."""
+def _journal_touch_shot(journal, graph, reconstruction, shot_id):
+    """Mark a resected shot and the points it sees as changed."""
+    if journal is not None:
+        journal.touch_shots([shot_id])
+        journal.touch_points(t for t in graph[shot_id]
+                             if t in reconstruction.points)
+
+
+def grow_reconstruction(data, graph, reconstruction, images, gcp, journal=None):
+    """Incrementally add shots to an initial reconstruction.
+
+    If a journal is given, the changes made to the reconstruction are
+    recorded into it after every added shot.
+    """
     bundle(graph, reconstruction, None, data.config)
     align.align_reconstruction(reconstruction, gcp, data.config)
+    if journal is not None:
+        journal.touch_all()
 
     should_bundle = ShouldBundle(data, reconstruction)
     should_retriangulate = ShouldRetriangulate(data, reconstruction)
+    resection_counters = ResectionCounters()
 
     while True:
-        if data.config.get('save_partial_reconstructions', False):
+        if journal is not None:
+            journal.record(reconstruction)
+        elif data.config.get('save_partial_reconstructions', False):
             paint_reconstruction(data, graph, reconstruction)
             data.save_reconstruction(
                 [reconstruction], 'reconstruction.{}.json'.format(
@@ -985,7 +1300,7 @@ def grow_reconstruction(data, graph, reconstruction, images, gcp):
 
         logger.info("-------------------------------------------------------")
         for image, num_tracks in common_tracks:
-            if resect(data, graph, reconstruction, image):
+            if resect(data, graph, reconstruction, image, resection_counters):
                 logger.info("Adding {0} to the reconstruction".format(image))
                 images.remove(image)
 
@@ -993,27 +1308,37 @@ def grow_reconstruction(data, graph, reconstruction, images, gcp):
                     graph, reconstruction, image,
                     data.config.get('triangulation_threshold', 0.004),
                     data.config.get('triangulation_min_ray_angle', 2.0))
+                _journal_touch_shot(journal, graph, reconstruction, image)
 
                 if should_bundle.should(reconstruction):
                     bundle(graph, reconstruction, None, data.config)
                     remove_outliers(graph, reconstruction, data.config)
                     align.align_reconstruction(reconstruction, gcp, data.config)
                     should_bundle.done(reconstruction)
+                    if journal is not None:
+                        journal.touch_all()
                 else:
                     if data.config['local_bundle_radius'] > 0:
-                        bundle_local(graph, reconstruction, None, image, data.config)
+                        shot_ids, point_ids = bundle_local(
+                            graph, reconstruction, None, image, data.config)
+                        if journal is not None:
+                            journal.touch_shots(shot_ids)
+                            journal.touch_points(point_ids)
 
                 if should_retriangulate.should(reconstruction):
                     logger.info("Re-triangulating")
                     retriangulate(graph, reconstruction, data.config)
                     bundle(graph, reconstruction, None, data.config)
                     should_retriangulate.done(reconstruction)
+                    if journal is not None:
+                        journal.touch_all()
                 break
         else:
             logger.info("Some images can not be added")
             break
 
     logger.info("-------------------------------------------------------")
+    resection_counters.report()
 
     bundle(graph, reconstruction, gcp, data.config)
     align.align_reconstruction(reconstruction, gcp, data.config)
@@ -1021,39 +1346,202 @@ def grow_reconstruction(data, graph, reconstruction, images, gcp):
     return reconstruction
 
 
-def incremental_reconstruction(data):
-    """Run the entire incremental reconstruction pipeline."""
+def partial_reconstruction_journal(data, resume=False):
+    """Journal for the reconstructions being grown, if enabled."""
+    if resume or (
+            data.config.get('save_partial_reconstructions', False) and
+            data.config.get('partial_reconstructions_format', 'journal') == 'journal'):
+        return journaling.ReconstructionJournal(data)
+    return None
+
+
+def resume_reconstructions(data, journal, remaining_images, grow, filename=None):
+    """Reload the reconstructions of an interrupted run.
+
+    The reconstructions already saved are loaded and the one that was being
+    grown is rebuilt from the journal and grown further.
+
+    Args:
+        journal: the ReconstructionJournal of the interrupted run
+        remaining_images: set of images not reconstructed yet.  Images of
+            the reloaded reconstructions are removed from it.
+        grow: function growing a reconstruction
+        filename: file where the reconstructions are saved
+
+    Returns:
+        the list of reconstructions sorted by number of shots
+    """
+    state = journal.load()
+    if state is None:
+        logger.info("No reconstruction journal found, starting from scratch")
+        return []
+
+    num_finished, reconstruction = state
+    reconstructions = []
+    if num_finished > 0:
+        reconstructions = data.load_reconstruction(filename)
+        if len(reconstructions) != num_finished:
+            logger.warning("Expected {} saved reconstructions, found {}".format(
+                num_finished, len(reconstructions)))
+    for r in reconstructions:
+        remaining_images.difference_update(r.shots)
+    logger.info("Resuming with {} finished reconstructions".format(
+        len(reconstructions)))
+
+    if reconstruction is not None:
+        remaining_images.difference_update(reconstruction.shots)
+        reconstruction = grow(reconstruction)
+        reconstructions.append(reconstruction)
+        reconstructions = sorted(reconstructions, key=lambda x: -len(x.shots))
+        data.save_reconstruction(reconstructions, filename)
+        journal.finish(len(reconstructions))
+    return reconstructions
+
+
+def incremental_reconstruction(data, resume=False, graph=None,
+                               common_tracks=None, pair_scores=None):
+    """Run the entire incremental reconstruction pipeline.
+
+    If resume is set, the reconstructions of an interrupted run are
+    reloaded from the journal and the pipeline continues from there.
+
+    The tracks graph, the common tracks and a dict of pair scores can be
+    given when they are already loaded, e.g. when running experiments.
+    Returns the list of reconstructions.
+    """
     logger.info("Starting incremental reconstruction")
     if not data.reference_lla_exists():
         data.invent_reference_lla()
 
-    graph = data.load_tracks_graph()
+    if graph is None:
+        graph = data.load_tracks_graph()
     tracks, images = matching.tracks_and_images(graph)
     remaining_images = set(images)
     gcp = None
     if data.ground_control_points_exist():
         gcp = data.load_ground_control_points()
-    common_tracks = matching.all_common_tracks(graph, tracks)
+    cache = None
+    if data.config.get('precompute_cache', False):
+        cache = precompute_cache.PrecomputeCache(data)
+    if common_tracks is None:
+        if cache is not None:
+            common_tracks = cache.common_tracks(graph, tracks)
+        else:
+            common_tracks = matching.all_common_tracks(graph, tracks)
+    if pair_scores is None and cache is not None:
+        pair_scores = cache.pair_scores()
+    if profiling.memory_enabled():
+        _record_common_tracks_size(common_tracks)
     
+    recon_name = None
+    if data.config.get('experiments_path', False):
+        recon_name = os.path.join(data.config['experiments_path'],
+                                  data.reconstruction_name_from_settings())
+
     reconstructions = []
-    pairs = compute_image_pairs(common_tracks, data.config)
+    journal = partial_reconstruction_journal(data, resume)
+    if resume:
+        reconstructions = resume_reconstructions(
+            data, journal, remaining_images,
+            lambda r: grow_reconstruction(
+                data, graph, r, remaining_images, gcp, journal),
+            recon_name)
+
+    if data.config.get('lazy_pair_scoring', False):
+        pairs = lazy_image_pairs(common_tracks, data.config, remaining_images,
+                                 scores=pair_scores)
+    else:
+        pairs = compute_image_pairs(common_tracks, data.config, pair_scores)
     for im1, im2 in pairs:
         if im1 in remaining_images and im2 in remaining_images:
             tracks, p1, p2, _, _, _ = common_tracks[im1, im2]
-            reconstruction = bootstrap_reconstruction(data, graph, im1, im2, p1, p2)
+            with profiling.span('bootstrap'):
+                reconstruction = bootstrap_reconstruction(data, graph, im1, im2, p1, p2)
             if reconstruction:
                 remaining_images.remove(im1)
                 remaining_images.remove(im2)
-                reconstruction = grow_reconstruction(data, graph, reconstruction, remaining_images, gcp)
+                if journal is not None:
+                    journal.start(reconstruction, len(reconstructions))
+                with profiling.span('grow'):
+                    reconstruction = grow_reconstruction(data, graph, reconstruction, remaining_images, gcp, journal)
                 reconstructions.append(reconstruction)
                 reconstructions = sorted(reconstructions, key=lambda x: -len(x.shots))
-                data.save_reconstruction(reconstructions)
+                data.save_reconstruction(reconstructions, recon_name)
+                if journal is not None:
+                    journal.finish(len(reconstructions))
+
+    if journal is not None:
+        journal.close()
+    if cache is not None:
+        cache.save_pair_scores(pair_scores)
 
     for k, r in enumerate(reconstructions):
         logger.info("Reconstruction {}: {} images, {} points".format(
             k, len(r.shots), len(r.points)))
     logger.info("{} partial reconstructions in total.".format(
         len(reconstructions)))
+    return reconstructions
+
+
+def extend_reconstructions(data, graph, reconstructions, images, global_bundle=False):
+    """Add new images to existing reconstructions.
+
+    Each image is resected into the first reconstruction it can be added
+    to, in the given order, and its tracks are triangulated.  Only the
+    shots within extension_bundle_radius of the added image in the image
+    graph are bundle adjusted.  The whole reconstructions are bundle
+    adjusted at the end only if global_bundle is set.
+
+    Returns:
+        the set of images that could not be added.
+    """
+    remaining_images = set(image for image in images if image in graph)
+    gcp = None
+    if data.ground_control_points_exist():
+        gcp = data.load_ground_control_points()
+    config = dict(data.config)
+    config['local_bundle_radius'] = data.config.get('extension_bundle_radius', 1)
+    camera_models = data.load_camera_models()
+    resection_counters = ResectionCounters()
+
+    for reconstruction in reconstructions:
+        for image in remaining_images:
+            camera_id = data.load_exif(image)['camera']
+            if camera_id not in reconstruction.cameras:
+                reconstruction.add_camera(camera_models[camera_id])
+
+        added = []
+        while True:
+            common_tracks = reconstructed_points_for_images(
+                graph, reconstruction, remaining_images)
+            for image, num_tracks in common_tracks:
+                if resect(data, graph, reconstruction, image, resection_counters):
+                    logger.info("Adding {0} to the reconstruction".format(image))
+                    remaining_images.remove(image)
+                    added.append(image)
+
+                    triangulate_shot_features(
+                        graph, reconstruction, image,
+                        data.config.get('triangulation_threshold', 0.004),
+                        data.config.get('triangulation_min_ray_angle', 2.0))
+                    if config['local_bundle_radius'] > 0:
+                        bundle_local(graph, reconstruction, None, image, config)
+                    break
+            else:
+                break
+
+        if added:
+            if global_bundle:
+                bundle(graph, reconstruction, gcp, data.config)
+                remove_outliers(graph, reconstruction, data.config)
+                align.align_reconstruction(reconstruction, gcp, data.config)
+            paint_reconstruction(data, graph, reconstruction)
+
+    resection_counters.report()
+    remaining_images.update(image for image in images if image not in graph)
+    logger.info("{} images added, {} could not be added".format(
+        len(images) - len(remaining_images), len(remaining_images)))
+    return remaining_images
 
 #======================================================================================#
 #============================== Reconstruction with Tags ==============================#
@@ -1064,9 +1552,13 @@ def incremental_reconstruction(data):
 #
 # input:
 #    data - loaded data object with tracks and images
+#    resume - continue the interrupted run recorded in the journal
+#    graph - optional tracks graph if already loaded
+#    common_tracks - optional common tracks if already computed
+#    pair_scores - optional dict of pair reconstructability scores
 # output:
 #    reconstructions - list of reconstructions from data
-def incremental_reconstruction_with_tags(data):
+def incremental_reconstruction_with_tags(data, resume=False, graph=None, common_tracks=None, pair_scores=None):
 
     # start
     logger.info("Starting incremental recontsruction with tags")
@@ -1074,28 +1566,56 @@ def incremental_reconstruction_with_tags(data):
         data.invent_reference_lla()
 
     # load tracks
-    graph = data.load_tracks_graph()
+    if graph is None:
+        graph = data.load_tracks_graph()
     tracks, images = matching.tracks_and_images(graph)
-    common_tracks  = matching.all_common_tracks(graph, tracks)
+    cache = None
+    if data.config.get('precompute_cache', False):
+        cache = precompute_cache.PrecomputeCache(data)
+    if common_tracks is None:
+        if cache is not None:
+            common_tracks = cache.common_tracks(graph, tracks)
+        else:
+            common_tracks  = matching.all_common_tracks(graph, tracks)
+    if pair_scores is None and cache is not None:
+        pair_scores = cache.pair_scores()
+    if profiling.memory_enabled():
+        _record_common_tracks_size(common_tracks)
     
     # load tag graphs
     tags_graph = None
     tag_components = None
     if data.config.get('resection_with_tags',False):
         tags_graph = data.load_tags_graph()
-        tag_components = matching.tag_connected_components(tags_graph)
+        if cache is not None:
+            tag_components = cache.tag_components(tags_graph)
+        else:
+            tag_components = matching.tag_connected_components(tags_graph)
     
     # ground control points
     gcp = None
     if data.ground_control_points_exist():
         gcp = data.load_ground_control_points()
 
+    # where to save reconstructions
+    recon_name = None
+    if data.config.get('experiments_path',False):
+        recon_name = os.path.join(data.config['experiments_path'],data.reconstruction_name_from_settings())
+
+    # reload reconstructions of an interrupted run
+    remaining_images = set(images)
+    reconstructions = []
+    journal = partial_reconstruction_journal(data, resume)
+    if resume:
+        reconstructions = resume_reconstructions(data, journal, remaining_images, lambda r: grow_reconstruction_with_tags(data, graph, r, remaining_images, gcp, tags_graph, journal), recon_name)
+
     # order pairs by reconstructability
-    pairs = compute_image_pairs_with_tags(common_tracks, data.config, tag_components)
+    if data.config.get('lazy_pair_scoring', False):
+        pairs = lazy_image_pairs(common_tracks, data.config, remaining_images, tag_components, pair_scores)
+    else:
+        pairs = compute_image_pairs_with_tags(common_tracks, data.config, tag_components, pair_scores)
     
     # start reconstruction
-    reconstructions = []
-    remaining_images = set(images)
     for im1, im2 in pairs:
 
         # if image pairs in remaining images, start with these two images
@@ -1105,7 +1625,8 @@ def incremental_reconstruction_with_tags(data):
             tracks, p1, p2, on_tag, tag_id, corner_id = common_tracks[im1, im2]
 
             # begin reconstruction
-            reconstruction = bootstrap_reconstruction_with_tags(data, graph, im1, im2, p1, p2, on_tag)
+            with profiling.span('bootstrap'):
+                reconstruction = bootstrap_reconstruction_with_tags(data, graph, im1, im2, p1, p2, on_tag)
 
             # grow reconstruction
             if reconstruction:
@@ -1115,43 +1636,58 @@ def incremental_reconstruction_with_tags(data):
                 remaining_images.remove(im2)
 
                 # grow
-                reconstruction = grow_reconstruction_with_tags(data, graph, reconstruction, remaining_images, gcp, tags_graph)
+                if journal is not None:
+                    journal.start(reconstruction, len(reconstructions))
+                with profiling.span('grow'):
+                    reconstruction = grow_reconstruction_with_tags(data, graph, reconstruction, remaining_images, gcp, tags_graph, journal)
                 reconstructions.append(reconstruction)
 
                 # sort by number of registered images
                 reconstructions = sorted(reconstructions, key = lambda x: -len(x.shots))
 
                 # save reconstructions
-                if data.config.get('experiments_path',False):
-                    recon_name = os.path.join(data.config['experiments_path'],data.reconstruction_name_from_settings())
-                    data.save_reconstruction(reconstructions,recon_name)
-                else:
-                    data.save_reconstruction(reconstructions)
+                data.save_reconstruction(reconstructions, recon_name)
+                if journal is not None:
+                    journal.finish(len(reconstructions))
+
+    # remove journal
+    if journal is not None:
+        journal.close()
+
+    # keep pair scores for the next runs
+    if cache is not None:
+        cache.save_pair_scores(pair_scores)
 
     # end
     for k, r in enumerate(reconstructions):
         logger.info("Reconstruction {}: {} images, {} points".format(k, len(r.shots), len(r.points)))
     logger.info("{} partial reconstructions in total.".format(len(reconstructions)))
+    return reconstructions
 #============= End Incremental Reconstruction With Tags =============#
 
 
 #=============== Grow Reconstruction With Tags ===============#
 # 
-def grow_reconstruction_with_tags(data, graph, reconstruction, images, gcp, tags_graph):
+def grow_reconstruction_with_tags(data, graph, reconstruction, images, gcp, tags_graph, journal=None):
     
     # bundle and align
     bundle(graph, reconstruction, None, data.config)
     align.align_reconstruction(reconstruction, gcp, data.config)
+    if journal is not None:
+        journal.touch_all()
 
     # set should bundle and retriangulate
     should_bundle = ShouldBundle(data, reconstruction)
     should_retriangulate = ShouldRetriangulate(data, reconstruction)
+    resection_counters = ResectionCounters()
 
     # iterate to add more images
     while True:
 
         # save partial reconstruction
-        if data.config.get('save_partial_reconstructions', False):
+        if journal is not None:
+            journal.record(reconstruction)
+        elif data.config.get('save_partial_reconstructions', False):
             paint_reconstruction(data, graph, reconstruction)
             data.save_reconstruction([reconstruction], 'reconstruction.{}.json'.format(datetime.datetime.now().isoformat().replace(':', '_')))
 
@@ -1169,7 +1705,7 @@ def grow_reconstruction_with_tags(data, graph, reconstruction, images, gcp, tags
         for image, num_tracks in common_tracks:
 
             # try to resection
-            if resect(data, graph, reconstruction, image):
+            if resect(data, graph, reconstruction, image, resection_counters):
 
                 # remove image from remaining
                 logger.info("Adding {0} to the reconstruction".format(image))
@@ -1177,6 +1713,7 @@ def grow_reconstruction_with_tags(data, graph, reconstruction, images, gcp, tags
 
                 # triangulate
                 triangulate_shot_features(graph, reconstruction, image, data.config.get('triangulation_threshold', 0.004), data.config.get('triangulation_min_ray_angle', 2.0))
+                _journal_touch_shot(journal, graph, reconstruction, image)
 
                 # should bundle
                 if should_bundle.should(reconstruction):
@@ -1184,11 +1721,16 @@ def grow_reconstruction_with_tags(data, graph, reconstruction, images, gcp, tags
                     remove_outliers(graph, reconstruction, data.config)
                     align.align_reconstruction(reconstruction, gcp, data.config)
                     should_bundle.done(reconstruction)
+                    if journal is not None:
+                        journal.touch_all()
                 
                 # check for local bundle
                 else:
                     if data.config['local_bundle_radius'] > 0:
-                        bundle_local(graph, reconstruction, None, image, data.config)
+                        shot_ids, point_ids = bundle_local(graph, reconstruction, None, image, data.config)
+                        if journal is not None:
+                            journal.touch_shots(shot_ids)
+                            journal.touch_points(point_ids)
 
                 # should retriangulate
                 if should_retriangulate.should(reconstruction):
@@ -1196,6 +1738,8 @@ def grow_reconstruction_with_tags(data, graph, reconstruction, images, gcp, tags
                     retriangulate(graph, reconstruction, data.config)
                     bundle(graph, reconstruction, None, data.config)
                     should_retriangulate.done(reconstruction)
+                    if journal is not None:
+                        journal.touch_all()
                 break
         
         # unable to add image
@@ -1205,6 +1749,7 @@ def grow_reconstruction_with_tags(data, graph, reconstruction, images, gcp, tags
 
     # done with reconstruction
     logger.info("-------------------------------------------------------")
+    resection_counters.report()
 
     # bundle, align, paint
     bundle(graph, reconstruction, gcp, data.config)
@@ -1359,21 +1904,30 @@ def run_relative_pose_optimize_nonlinear_with_tags(b1, b2, t, R):
 # input:
 #    track_dict -
 #    config -
+#    tag_components -
+#    scores - optional dict of already computed scores, new scores are added to it
 # output:
 #    list of pairs in sorted order by reconstructability
-def compute_image_pairs_with_tags(track_dict, config, tag_components):
+def compute_image_pairs_with_tags(track_dict, config, tag_components, scores=None):
 
-    # get slices
-    args = _pair_reconstructability_arguments_with_tags(track_dict, config)
+    # get slices for pairs without a score yet
+    if scores is None:
+        scores = {}
+    args = [a for a in _pair_reconstructability_arguments_with_tags(track_dict, config) if (a[1], a[2]) not in scores]
     
     # parallel if processe > 1
     processes = config.get('processes', 1)
-    if processes == 1:
+    if processes == 1 or len(args) <= 1:
         result = map(_compute_pair_reconstructability_with_tags, args)
     else:
         p = Pool(processes)
         result = p.map(_compute_pair_reconstructability_with_tags, args)
 
+    # memoize scores
+    for im1, im2, r in result:
+        scores[im1, im2] = r
+    result = [(im1, im2, scores[im1, im2]) for im1, im2 in track_dict]
+
     # filter out pairs with 0 scores
     pairs = [(im1, im2) for im1, im2, r in result if r > 0]
 
@@ -1453,6 +1453,10 @@ class BundleAdjuster {
     return last_run_summary_.FullReport();
   }
 
+  int NumIterations() {
+    return last_run_summary_.iterations.size();
+  }
+
  private:
   std::map<std::string, std::unique_ptr<BACamera> > cameras_;
   std::map<std::string, BAShot> shots_;
@@ -121,6 +121,7 @@ BOOST_PYTHON_MODULE(csfm) {
     .def("set_use_tag_reproj_constraint", &BundleAdjuster::SetUseTagReprojConstraint)
     .def("brief_report", &BundleAdjuster::BriefReport)
     .def("full_report", &BundleAdjuster::FullReport)
+    .def("num_iterations", &BundleAdjuster::NumIterations)
   ;
 
   class_<BAPerspectiveCamera>("BAPerspectiveCamera")
@@ -174,6 +175,7 @@ BOOST_PYTHON_MODULE(csfm) {
     .def("set_depth_range", &csfm::DepthmapEstimatorWrapper::SetDepthRange)
     .def("set_patchmatch_iterations", &csfm::DepthmapEstimatorWrapper::SetPatchMatchIterations)
     .def("set_min_patch_sd", &csfm::DepthmapEstimatorWrapper::SetMinPatchSD)
+    .def("set_initial_planes", &csfm::DepthmapEstimatorWrapper::SetInitialPlanes)
     .def("add_view", &csfm::DepthmapEstimatorWrapper::AddView)
     .def("compute_patch_match", &csfm::DepthmapEstimatorWrapper::ComputePatchMatch)
     .def("compute_patch_match_sample", &csfm::DepthmapEstimatorWrapper::ComputePatchMatchSample)
@@ -189,6 +191,7 @@ BOOST_PYTHON_MODULE(csfm) {
 
   class_<csfm::DepthmapMergerWrapper>("DepthmapMerger")
     .def("set_same_depth_threshold", &csfm::DepthmapMergerWrapper::SetSameDepthThreshold)
+    .def("set_output_views", &csfm::DepthmapMergerWrapper::SetOutputViews)
     .def("add_view", &csfm::DepthmapMergerWrapper::AddView)
     .def("merge", &csfm::DepthmapMergerWrapper::Merge)
   ;
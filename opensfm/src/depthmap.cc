@@ -181,6 +181,10 @@ class DepthmapEstimator {
     min_patch_variance_ = sd * sd;
   }
 
+  void SetInitialPlanes(const float *pplanes, int width, int height) {
+    initial_planes_ = cv::Mat(height, width, CV_32FC3, (void *)pplanes).clone();
+  }
+
   void ComputeBruteForce(cv::Mat *best_depth, cv::Mat *best_plane, cv::Mat *best_score, cv::Mat *best_nghbr) {
     AssignMatrices(best_depth, best_plane, best_score, best_nghbr);
 
@@ -242,6 +246,18 @@ class DepthmapEstimator {
           ComputePlaneScore(i, j, plane, &score, &nghbr);
         }
         AssignPixel(best_depth, best_plane, best_score, best_nghbr, i, j, depth, plane, score, nghbr);
+
+        // Check the initial plane hypothesis, if any.
+        if (!initial_planes_.empty()) {
+          cv::Vec3f initial_plane = initial_planes_.at<cv::Vec3f>(i, j);
+          if (initial_plane != cv::Vec3f(0, 0, 0)) {
+            if (sample) {
+              CheckPlaneImageCandidate(best_depth, best_plane, best_score, best_nghbr, i, j, initial_plane, nghbr);
+            } else {
+              CheckPlaneCandidate(best_depth, best_plane, best_score, best_nghbr, i, j, initial_plane);
+            }
+          }
+        }
       }
     }
   }
@@ -460,6 +476,7 @@ class DepthmapEstimator {
   std::vector<cv::Matx33d> Kinvs_;
   std::vector<cv::Matx33d> Qs_;
   std::vector<cv::Vec3d> as_;
+  cv::Mat initial_planes_;
   int patch_size_;
   double min_depth_, max_depth_;
   int num_depth_planes_;
@@ -544,6 +561,12 @@ class DepthmapMerger {
     same_depth_threshold_ = t;
   }
 
+  // Only collect the points of the given views.  The other views are
+  // only used to prune the output views.  An empty list collects all views.
+  void SetOutputViews(const std::vector<int> &views) {
+    output_views_ = views;
+  }
+
   void AddView(const double *pK,
                const double *pR,
                const double *pt,
@@ -573,7 +596,14 @@ class DepthmapMerger {
       PruneDepthmap(i);
     }
 
-    for (int i = 0; i < depths_.size(); ++i) {
+    std::vector<int> output_views = output_views_;
+    if (output_views.empty()) {
+      for (int i = 0; i < depths_.size(); ++i) {
+        output_views.push_back(i);
+      }
+    }
+    for (int k = 0; k < output_views.size(); ++k) {
+      int i = output_views[k];
       CollectDepthmapPoints(depths_[i], planes_[i], colors_[i],
                             Ks_[i], Rs_[i], ts_[i],
                             merged_points, merged_normals, merged_colors);
@@ -647,6 +677,7 @@ class DepthmapMerger {
   std::vector<cv::Matx33d> Rs_;
   std::vector<cv::Vec3d> ts_;
   float same_depth_threshold_;
+  std::vector<int> output_views_;
 };
 
 
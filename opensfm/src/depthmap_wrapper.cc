@@ -31,6 +31,12 @@ class DepthmapEstimatorWrapper {
     de_.SetMinPatchSD(sd);
   }
 
+  void SetInitialPlanes(PyObject *planes) {
+    PyArrayContiguousView<float> planes_view((PyArrayObject *)planes);
+    de_.SetInitialPlanes(planes_view.data(),
+                         planes_view.shape(1), planes_view.shape(0));
+  }
+
   bp::object ComputePatchMatch() {
     cv::Mat depth, plane, score, nghbr;
     de_.ComputePatchMatch(&depth, &plane, &score, &nghbr);
@@ -107,6 +113,14 @@ class DepthmapMergerWrapper {
     dm_.SetSameDepthThreshold(t);
   }
 
+  void SetOutputViews(bp::object views) {
+    std::vector<int> views_vector;
+    for (int i = 0; i < bp::len(views); ++i) {
+      views_vector.push_back(bp::extract<int>(views[i]));
+    }
+    dm_.SetOutputViews(views_vector);
+  }
+
   void AddView(PyObject *K,
                PyObject *R,
                PyObject *t,
@@ -4,36 +4,10 @@ import networkx as nx
 import numpy as np
 
 from opensfm import types
+from opensfm.benchmark.synthetic import camera_pose
 import opensfm.dataset
 
 
-def normalized(x):
-    return x / np.linalg.norm(x)
-
-
-def camera_pose(position, lookat, up):
-    '''
-    Pose from position and look at direction
-
-    >>> position = [1.0, 2.0, 3.0]
-    >>> lookat = [0., 10.0, 2.0]
-    >>> up = [0.0, 0.0, 1.0]
-    >>> pose = camera_pose(position, lookat, up)
-    >>> np.allclose(pose.get_origin(), position)
-    True
-    >>> d = normalized(pose.transform(lookat))
-    >>> np.allclose(d, [0, 0, 1])
-    True
-    '''
-    ez = normalized(np.array(lookat) - np.array(position))
-    ex = normalized(np.cross(ez, up))
-    ey = normalized(np.cross(ez, ex))
-    pose = types.Pose()
-    pose.set_rotation_matrix([ex, ey, ez])
-    pose.set_origin(position)
-    return pose
-
-
 class CubeDataset:
     '''
     Dataset of cameras looking at point in a cube
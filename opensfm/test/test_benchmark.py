@@ -0,0 +1,45 @@
+import json
+
+import numpy as np
+
+from opensfm.benchmark import runner
+from opensfm.benchmark import synthetic
+
+
+def test_synthetic_scene():
+    scene = synthetic.SyntheticScene(num_images=6, num_points=500,
+                                     tags_per_image=2, noise=0.0)
+
+    assert len(scene.shots) == 6
+    assert len(scene.tags) > 0
+    for image in scene.images():
+        # noiseless features are the projections of their points
+        shot = scene.shots[image]
+        points = scene.points[scene.feature_points[image]]
+        for point, feature in zip(points[:10], scene.features[image]):
+            assert np.allclose(shot.project(point), feature)
+        assert len(scene.tag_features[image]) > 0
+
+    matches = scene.matches()
+    assert matches
+    for (im1, im2), pair in matches.items():
+        p1 = scene.feature_points[im1][pair[:, 0]]
+        p2 = scene.feature_points[im2][pair[:, 1]]
+        inliers = p1 >= 0
+        assert np.all(p1[inliers] == p2[inliers])
+        assert np.all(p2[~inliers] < 0)
+        assert 0.8 < np.mean(inliers) < 1
+
+
+def test_benchmark_stages(tmpdir):
+    scene = synthetic.SyntheticScene(num_images=5, num_points=300)
+    results = runner.run_benchmark(
+        scene, str(tmpdir), ['tag_matching', 'all_common_tracks'])
+
+    assert sorted(results['stages']) == ['all_common_tracks', 'create_tracks',
+                                         'tag_matching']
+    assert all(t >= 0 for t in results['stages'].values())
+    assert results['sizes']['images'] == 5
+    assert results['sizes']['tracks_graph_edges'] > 0
+    assert results['sizes']['common_tracks_pairs'] > 0
+    json.dumps(results)
@@ -0,0 +1,51 @@
+import json
+import os.path
+
+from opensfm import binary_reconstruction
+from opensfm import io
+
+filename = os.path.join(os.path.dirname(__file__),
+                        'reconstruction_berlin.json')
+
+
+def test_binary_round_trip(tmpdir):
+    with open(filename) as fin:
+        reconstructions = io.reconstructions_from_json(json.load(fin))
+    obj = json.loads(io.json_dumps(io.reconstructions_to_json(reconstructions)))
+
+    binary_file = str(tmpdir.join('reconstruction.bin'))
+    json_file = str(tmpdir.join('reconstruction.json'))
+    binary_reconstruction.json_to_binary(filename, binary_file)
+    binary_reconstruction.binary_to_json(binary_file, json_file)
+    with open(json_file) as fin:
+        converted = json.load(fin)
+
+    assert converted == obj
+
+
+def test_points_are_loaded_lazily(tmpdir):
+    with open(filename) as fin:
+        reconstructions = io.reconstructions_from_json(json.load(fin))
+    binary_file = str(tmpdir.join('reconstruction.bin'))
+    binary_reconstruction.write_reconstructions(reconstructions, binary_file)
+
+    loaded = binary_reconstruction.read_reconstructions(binary_file)
+    points = loaded[0].points
+    assert len(loaded[0].shots) == 3
+    assert len(points) == 1588
+    assert not points.loaded()
+
+    # points are copied without being built
+    copy_file = str(tmpdir.join('copy.bin'))
+    binary_reconstruction.write_reconstructions(loaded, copy_file)
+    assert not points.loaded()
+
+    point_id = sorted(reconstructions[0].points)[0]
+    point = points[point_id]
+    assert points.loaded()
+    expected = reconstructions[0].points[point_id]
+    assert point.coordinates == expected.coordinates
+    assert point.color == expected.color
+
+    copy = binary_reconstruction.read_reconstructions(copy_file)
+    assert sorted(copy[0].points) == sorted(reconstructions[0].points)
@@ -1,4 +1,7 @@
 import argparse
+import os
+import subprocess
+import sys
 
 from opensfm import commands
 import data_generation
@@ -15,18 +18,51 @@ def test_run_all(tmpdir):
     data = data_generation.create_berlin_test_folder(tmpdir)
 
     run_all_commands = [
-        commands.extract_metadata,
-        commands.detect_features,
-        commands.match_features,
-        commands.create_tracks,
-        commands.reconstruct,
-        commands.mesh,
+        'extract_metadata',
+        'detect_features',
+        'match_features',
+        'create_tracks',
+        'reconstruct',
+        'mesh',
     ]
 
-    for module in run_all_commands:
-        command = module.Command()
+    for name in run_all_commands:
+        command = commands.load_command(name)
         run_command(command, [data.data_path])
 
     reconstruction = data.load_reconstruction()
     assert len(reconstruction[0].shots) == 3
     assert len(reconstruction[0].points) > 1000
+
+
+def test_command_registry():
+    for name, help in commands.opensfm_commands:
+        command = commands.load_command(name)
+        assert command.name == name
+        assert command.help == help
+
+
+def test_listing_commands_does_not_import_heavy_modules():
+    code = ('import sys\n'
+            'from opensfm import commands\n'
+            'commands.command_names()\n'
+            'heavy = ["cv2", "networkx", "scipy", "matplotlib", "pyopengv"]\n'
+            'print(" ".join(m for m in heavy if m in sys.modules))\n')
+    root = os.path.join(os.path.dirname(__file__), '..', '..')
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert output.strip() == ''
+
+
+class DyingExperiments(commands.load_command('reconstruct').__class__):
+    def run_experiment(self, args, config_path):
+        if config_path == 'crash.yaml':
+            os._exit(1)
+        return {'name': config_path}
+
+
+def test_experiment_processes_report_dead_children():
+    command = DyingExperiments()
+    results = command.run_experiment_processes(
+        None, ['a.yaml', 'crash.yaml', 'b.yaml'], 2)
+    assert [r['name'] for r in results] == [
+        'a.yaml', 'crash.yaml (failed)', 'b.yaml']
@@ -1,5 +1,6 @@
 import numpy as np
 
+from opensfm import config
 from opensfm import dense
 from opensfm import types
 
@@ -43,3 +44,200 @@ def test_depthmap_to_ply():
 
     ply = dense.depthmap_to_ply(shot, depth, image)
     assert len(ply.splitlines()) == 16
+
+
+class DepthmapViewTestDataSet:
+    def __init__(self):
+        self.config = {'depthmap_resolution': 8}
+        self.views = {}
+        self.decoded = 0
+
+    def undistorted_image_as_array(self, image):
+        self.decoded += 1
+        return np.arange(24 * 32 * 3, dtype=np.uint8).reshape(24, 32, 3)
+
+    def depthmap_view_exists(self, image, resolution):
+        return (image, resolution) in self.views
+
+    def save_depthmap_view(self, image, resolution, gray, color):
+        self.views[image, resolution] = gray, color
+
+    def load_depthmap_view(self, image, resolution):
+        return self.views[image, resolution]
+
+
+def test_depthmap_views_are_decoded_once():
+    data = DepthmapViewTestDataSet()
+    shot = types.Shot()
+    shot.id = 'shot1'
+
+    dense.prepare_depthmap_view((data, shot))
+    dense.prepare_depthmap_view((data, shot))
+    gray, color = dense.load_depthmap_view(data, shot)
+
+    assert data.decoded == 1
+    assert gray.shape == (6, 8)
+    assert color.shape == (6, 8, 3)
+
+
+def _square(x):
+    return x * x
+
+
+def test_run_task_graph_respects_dependencies():
+    tasks = {
+        ('compute', 'a'): (_square, 1, [], 1),
+        ('compute', 'b'): (_square, 2, [], 1),
+        ('compute', 'c'): (_square, 3, [], 1),
+        ('clean', 'a'): (_square, 4, [('compute', 'a'), ('compute', 'b')], 0),
+        ('clean', 'c'): (_square, 5, [('compute', 'c')], 0),
+    }
+    for processes in [1, 2]:
+        done = []
+        dense.run_task_graph(tasks, processes, done.append)
+        assert sorted(done) == sorted(tasks)
+        for name, task in tasks.items():
+            for dependency in task[2]:
+                assert done.index(dependency) < done.index(name)
+
+    done = []
+    dense.run_task_graph(tasks, 1, done.append)
+    assert done == [('compute', 'a'), ('compute', 'b'), ('clean', 'a'),
+                    ('compute', 'c'), ('clean', 'c')]
+
+
+def test_tag_planes_and_depth_range():
+    camera = types.PerspectiveCamera()
+    camera.id = 'cam1'
+    camera.focal = 1.0
+    camera.k1 = 0.0
+    camera.k2 = 0.0
+    camera.width = 40
+    camera.height = 30
+
+    shot = types.Shot()
+    shot.id = 'shot1'
+    shot.camera = camera
+    shot.pose = types.Pose([0.0, 0.0, 0.0], [0.0, 0.0, 0.0])
+
+    reconstruction = types.Reconstruction()
+    graph = {shot.id: {}}
+    corners = [[-1, -1, 5], [1, -1, 5], [1, 1, 5], [-1, 1, 5]]
+    for i, coordinates in enumerate(corners):
+        point = types.Point()
+        point.id = 'tag{}'.format(i)
+        point.coordinates = coordinates
+        point.on_tag = True
+        point.tag_id = 7
+        point.tag_corner = i
+        reconstruction.add_point(point)
+        graph[shot.id][point.id] = {}
+    for i, z in enumerate(np.linspace(4.0, 6.0, 11)):
+        point = types.Point()
+        point.id = 'point{}'.format(i)
+        point.coordinates = [0.1 * i, 0.0, z]
+        reconstruction.add_point(point)
+        graph[shot.id][point.id] = {}
+
+    tag_planes = dense.compute_tag_planes(graph, reconstruction, shot)
+    assert len(tag_planes) == 1
+    assert np.allclose(tag_planes[0][0], [0, 0, -0.2])
+
+    min_depth, max_depth = dense.compute_depth_range_with_tags(
+        graph, reconstruction, shot, tag_planes, 0.05)
+    default_min, default_max = dense.compute_depth_range(
+        graph, reconstruction, shot)
+    assert default_min < min_depth < 4.2
+    assert 5.8 < max_depth < default_max
+
+    planes = dense.tag_plane_image(shot, tag_planes, 40, 30)
+    assert np.allclose(planes[15, 20], [0, 0, -0.2])
+    assert np.all(planes[0, 0] == 0)
+    assert 0.0 < dense.tag_plane_coverage(planes) < 0.5
+
+
+def test_merge_chunks():
+    reconstruction = types.Reconstruction()
+    centers = {'a': [0.5, 0, 0], 'b': [1.5, 0, 0], 'c': [0.2, 0.9, 0.1],
+               'd': [-0.5, 0, 0]}
+    for shot_id, center in centers.items():
+        shot = types.Shot()
+        shot.id = shot_id
+        shot.pose = types.Pose()
+        shot.pose.set_origin(np.array(center))
+        reconstruction.add_shot(shot)
+
+    chunks = dense.merge_chunks(reconstruction, sorted(centers), 1.0)
+    assert chunks == [['d'], ['a', 'c'], ['b']]
+    assert dense.merge_chunks(reconstruction, sorted(centers), 10.0) == [
+        ['d'], ['a', 'b', 'c']]
+
+
+class MergeTestDataSet:
+    def __init__(self, path, shots, chunk_size):
+        self.config = config.default_config()
+        self.config['depthmap_resolution'] = 16
+        self.config['depthmap_merge_chunk_size'] = chunk_size
+        self.path = path
+        self.shots = shots
+
+    def clean_depthmap_exists(self, image):
+        return image in self.shots
+
+    def load_clean_depthmap(self, image):
+        # all the shots look at the plane z = 5
+        depth = np.full((12, 16), 5.0, dtype=np.float32)
+        plane = np.zeros((12, 16, 3), dtype=np.float32)
+        plane[:, :, 2] = -0.2
+        return depth, plane, np.ones((12, 16), dtype=np.float32)
+
+    def depthmap_view_exists(self, image, resolution):
+        return True
+
+    def load_depthmap_view(self, image, resolution):
+        return (np.zeros((12, 16), dtype=np.uint8),
+                np.zeros((12, 16, 3), dtype=np.uint8))
+
+    def _depthmap_path(self):
+        return self.path
+
+
+def _ply_vertices(filename):
+    with open(filename) as fin:
+        lines = fin.read().split('end_header\n')[1].splitlines()
+    return sorted(tuple(line.split()[:3]) for line in lines)
+
+
+def test_chunked_merge_matches_global_merge(tmpdir):
+    camera = types.PerspectiveCamera()
+    camera.id = 'cam1'
+    camera.focal = 1.0
+    camera.k1 = camera.k2 = 0.0
+    camera.width, camera.height = 160, 120
+
+    reconstruction = types.Reconstruction()
+    for shot_id, x in [('a', 0.2), ('b', 0.6), ('c', 1.2), ('d', 1.6)]:
+        shot = types.Shot()
+        shot.id = shot_id
+        shot.camera = camera
+        shot.pose = types.Pose()
+        shot.pose.set_origin(np.array([x, 0.0, 0.0]))
+        reconstruction.add_shot(shot)
+
+    neighbors = {}
+    for shot in reconstruction.shots.values():
+        others = sorted(reconstruction.shots.values(), key=lambda s: (
+            abs(s.pose.get_origin()[0] - shot.pose.get_origin()[0]), s.id))
+        neighbors[shot.id] = others
+
+    assert len(dense.merge_chunks(reconstruction, sorted(neighbors), 1.0)) == 2
+
+    vertices = []
+    for chunk_size in [0, 1.0]:
+        path = str(tmpdir.mkdir('chunk{}'.format(chunk_size)))
+        data = MergeTestDataSet(path, reconstruction.shots, chunk_size)
+        dense.merge_depthmaps(data, None, reconstruction, neighbors)
+        vertices.append(_ply_vertices(path + '/merged.ply'))
+
+    assert 0 < len(vertices[0]) < 4 * 12 * 16
+    assert vertices[1] == vertices[0]
@@ -0,0 +1,38 @@
+import os
+
+from opensfm.commands import detect_and_match
+
+
+def _detect(image):
+    with open(image, 'w') as fout:
+        fout.write(os.path.basename(image))
+
+
+def _match(pair):
+    assert os.path.isfile(pair[0]) and os.path.isfile(pair[1])
+    return sorted(os.path.basename(image) for image in pair)
+
+
+def test_detect_and_match_starts_matching_early(tmpdir):
+    images = [str(tmpdir.join(name)) for name in 'abcd']
+    a, b, c, d = images
+    pairs = [(a, b), (a, c), (b, c), (c, d), (a, d)]
+
+    for processes in [1, 2]:
+        for image in images:
+            if os.path.isfile(image):
+                os.remove(image)
+        matched = []
+
+        def on_matched(pair, result):
+            detected = [i for i in images if os.path.isfile(i)]
+            matched.append((pair, result, len(detected)))
+
+        detect_and_match.detect_and_match(
+            images, pairs, _detect, _match, on_matched, processes)
+
+        assert sorted(m[0] for m in matched) == sorted(pairs)
+        for pair, result, _ in matched:
+            assert result == sorted(os.path.basename(i) for i in pair)
+        if processes == 1:
+            assert [m[2] for m in matched] == [2, 3, 3, 4, 4]
@@ -1,9 +1,11 @@
 import json
 import os.path
+import StringIO
 
 import numpy as np
 
 from opensfm import io
+from opensfm import types
 
 filename = os.path.join(os.path.dirname(__file__),
                         'reconstruction_berlin.json')
@@ -21,6 +23,22 @@ def test_reconstructions_from_json():
     assert len(reconstructions[0].points) == 1588
 
 
+def test_json_dump_reconstructions_is_identical():
+    with open(filename) as fin:
+        obj = json.loads(fin.read())
+    reconstructions = io.reconstructions_from_json(obj)
+    reconstructions.append(types.Reconstruction())
+    reconstructions[0].main_shot = '03.jpg'
+
+    for minify in [False, True]:
+        expected = StringIO.StringIO()
+        io.json_dump(io.reconstructions_to_json(reconstructions),
+                     expected, minify)
+        streamed = StringIO.StringIO()
+        io.json_dump_reconstructions(reconstructions, streamed, minify)
+        assert streamed.getvalue() == expected.getvalue()
+
+
 def test_reconstruction_to_ply():
     with open(filename) as fin:
         obj = json.loads(fin.read())
@@ -29,6 +47,50 @@ def test_reconstruction_to_ply():
     assert len(ply.splitlines()) > len(reconstructions[0].points)
 
 
+def test_binary_ply():
+    with open(filename) as fin:
+        obj = json.loads(fin.read())
+    reconstructions = io.reconstructions_from_json(obj)
+    points, colors = io.reconstruction_to_ply_arrays(reconstructions[0])
+    assert len(points) == len(reconstructions[0].points) + 3 * 3 * 10
+
+    fout = StringIO.StringIO()
+    io.write_binary_ply(fout, points, colors)
+    header, data = fout.getvalue().split('end_header\n')
+    assert 'format binary_little_endian 1.0' in header
+    assert 'element vertex {}'.format(len(points)) in header
+    vertices = np.frombuffer(data, dtype=[
+        ('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+        ('r', 'u1'), ('g', 'u1'), ('b', 'u1')])
+    assert np.allclose(vertices['x'], points[:, 0], atol=1e-3)
+    assert np.all(vertices['g'] == colors[:, 1].astype(np.uint8))
+
+
+def test_ply_stream_writer(tmpdir):
+    np.random.seed(42)
+    points = np.random.rand(10, 3)
+    normals = np.random.rand(10, 3)
+    colors = np.random.randint(0, 255, (10, 3))
+
+    streamed = str(tmpdir.join('streamed.ply'))
+    with io.PlyStreamWriter(streamed, normals=True, binary=True) as writer:
+        writer.write(points[:4], colors[:4], normals[:4])
+        writer.write(points[4:], colors[4:], normals[4:])
+    expected = StringIO.StringIO()
+    io.write_binary_ply(expected, points, colors, normals)
+    with open(streamed, 'rb') as fin:
+        assert fin.read() == expected.getvalue()
+
+    with io.PlyStreamWriter(streamed) as writer:
+        writer.write(points[:4], colors[:4])
+        writer.write(points[4:], colors[4:])
+    with open(streamed) as fin:
+        lines = fin.read().splitlines()
+    assert 'element vertex 10' in lines
+    assert len(lines) == lines.index('end_header') + 11
+    assert os.listdir(str(tmpdir)) == ['streamed.ply']
+
+
 def test_parse_projection():
     proj = io._parse_projection('WGS84')
     assert proj is None
@@ -38,3 +100,37 @@ def test_parse_projection():
     lat, lon = 41.38946, 2.18378
     plon, plat = proj(easting, northing, inverse=True)
     assert np.allclose((lat, lon), (plat, plon))
+
+
+def test_depthmap_channels_round_trip(tmpdir):
+    np.random.seed(42)
+    channels = {
+        'depth': np.random.uniform(1, 100, (6, 8)).astype(np.float32),
+        'plane': np.random.uniform(-1, 1, (6, 8, 3)).astype(np.float32),
+        'score': np.random.rand(6, 8).astype(np.float32),
+        'nghbr': np.random.randint(0, 5, (6, 8)).astype(np.int32),
+        'nghbrs': ['im1', 'im2'],
+    }
+    channels['depth'][0, 0] = 0
+    path = str(tmpdir.join('im0.raw'))
+    for storage in ['npz', 'npy']:
+        for precision in ['float32', 'float16']:
+            io.save_depthmap_channels(path, channels, storage, precision)
+            assert io.depthmap_channels_exist(path)
+            assert os.listdir(str(tmpdir)) == [
+                'im0.raw.npz' if storage == 'npz' else 'im0.raw']
+
+            o = io.DepthmapChannels(path)
+            tolerance = 1e-3 if precision == 'float16' else 1e-6
+            assert o['depth'].dtype == np.float32
+            assert np.allclose(o['depth'], channels['depth'], rtol=tolerance)
+            assert np.allclose(o['score'], channels['score'], atol=tolerance)
+            assert np.all(o['nghbr'] == channels['nghbr'])
+            assert list(o['nghbrs']) == channels['nghbrs']
+            normals = channels['plane'] / np.linalg.norm(
+                channels['plane'], axis=2)[..., np.newaxis]
+            plane = o['plane']
+            if precision == 'float32':
+                assert np.allclose(plane, channels['plane'])
+            else:
+                assert np.allclose(plane, normals, atol=1e-2)
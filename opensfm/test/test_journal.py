@@ -0,0 +1,113 @@
+import numpy as np
+
+from opensfm import config
+from opensfm import journal
+from opensfm import types
+
+
+class JournalTestDataSet:
+    def __init__(self, path):
+        self.config = config.default_config()
+        self.path = path
+
+    def reconstruction_journal_file(self):
+        return self.path + '/reconstruction.journal'
+
+    def reconstruction_snapshot_file(self):
+        return self.path + '/reconstruction.snapshot.json'
+
+
+def _add_shot(reconstruction, shot_id, x):
+    shot = types.Shot()
+    shot.id = shot_id
+    shot.camera = reconstruction.cameras['camera']
+    shot.pose = types.Pose([0.0, 0.0, 0.0], [x, 0.0, 0.0])
+    shot.metadata = types.ShotMetadata()
+    reconstruction.add_shot(shot)
+
+
+def _add_point(reconstruction, point_id, x):
+    point = types.Point()
+    point.id = point_id
+    point.coordinates = [x, 1.0, 2.0]
+    reconstruction.add_point(point)
+
+
+def test_journal_replay(tmpdir):
+    data = JournalTestDataSet(str(tmpdir))
+
+    reconstruction = types.Reconstruction()
+    camera = types.PerspectiveCamera()
+    camera.id = 'camera'
+    camera.width, camera.height = 800, 600
+    camera.focal = camera.focal_prior = 0.9
+    camera.k1 = camera.k1_prior = camera.k2 = camera.k2_prior = 0.0
+    reconstruction.add_camera(camera)
+    _add_shot(reconstruction, 'im0', 0.0)
+    _add_shot(reconstruction, 'im1', 1.0)
+    for i in range(10):
+        _add_point(reconstruction, str(i), float(i))
+
+    j = journal.ReconstructionJournal(data)
+    j.start(reconstruction, 0)
+
+    _add_shot(reconstruction, 'im2', 2.0)
+    _add_point(reconstruction, '10', 10.0)
+    del reconstruction.points['3']
+    reconstruction.points['4'].coordinates = [4.5, 1.0, 2.0]
+    j.touch_shots(['im2'])
+    j.touch_points(['10', '3', '4'])
+    j.record(reconstruction)
+
+    with open(data.reconstruction_journal_file()) as fin:
+        records = fin.readlines()
+    assert len(records) == 1
+
+    num_finished, replayed = journal.ReconstructionJournal(data).load()
+    assert num_finished == 0
+    assert set(replayed.shots) == set(reconstruction.shots)
+    assert set(replayed.points) == set(reconstruction.points)
+    assert np.allclose(replayed.points['4'].coordinates, [4.5, 1.0, 2.0])
+    assert np.allclose(replayed.shots['im2'].pose.translation, [2.0, 0, 0])
+
+    j.finish(1)
+    assert journal.ReconstructionJournal(data).load() == (1, None)
+
+
+def test_journal_only_records_touched(tmpdir):
+    data = JournalTestDataSet(str(tmpdir))
+
+    reconstruction = types.Reconstruction()
+    camera = types.PerspectiveCamera()
+    camera.id = 'camera'
+    camera.width, camera.height = 800, 600
+    camera.focal = camera.focal_prior = 0.9
+    camera.k1 = camera.k1_prior = camera.k2 = camera.k2_prior = 0.0
+    reconstruction.add_camera(camera)
+    _add_shot(reconstruction, 'im0', 0.0)
+    for i in range(10):
+        _add_point(reconstruction, str(i), float(i))
+
+    j = journal.ReconstructionJournal(data)
+    j.start(reconstruction, 0)
+
+    reconstruction.points['1'].coordinates = [1.5, 1.0, 2.0]
+    reconstruction.points['2'].coordinates = [2.5, 1.0, 2.0]
+    j.touch_points(['1'])
+    j.record(reconstruction)
+
+    _, replayed = journal.ReconstructionJournal(data).load()
+    assert np.allclose(replayed.points['1'].coordinates, [1.5, 1.0, 2.0])
+    assert np.allclose(replayed.points['2'].coordinates, [2.0, 1.0, 2.0])
+
+    j = journal.ReconstructionJournal(data)
+    j.start(reconstruction, 0)
+    for point in reconstruction.points.values():
+        point.coordinates[0] += 1.0
+    j.touch_all()
+    j.record(reconstruction)
+    with open(data.reconstruction_journal_file()) as fin:
+        assert fin.read() == ''
+
+    _, replayed = journal.ReconstructionJournal(data).load()
+    assert np.allclose(replayed.points['9'].coordinates, [10.0, 1.0, 2.0])
@@ -0,0 +1,142 @@
+import numpy as np
+
+from opensfm import localization
+from opensfm import matching
+from opensfm import reconstruction as recon
+from opensfm import types
+from opensfm.benchmark import synthetic
+from opensfm.commands import create_tracks
+from opensfm.commands import detect_tags
+
+
+def _dataset_with_reconstruction(path):
+    scene = synthetic.SyntheticScene(num_images=4, num_points=300,
+                                     tags_per_image=0)
+    data = synthetic.write_dataset(scene, path)
+    images = data.images()
+    features, colors = create_tracks.load_features(data, images)
+    matches = create_tracks.load_matches(data, images)
+    graph = matching.create_tracks_graph(features, colors, matches,
+                                         {}, {}, {}, {}, {}, data.config)
+    data.save_tracks_graph(graph)
+
+    # ground truth reconstruction, with the points named after their tracks
+    reconstruction = types.Reconstruction()
+    reconstruction.add_camera(scene.camera)
+    for shot in scene.shots.values():
+        reconstruction.add_shot(shot)
+    tracks, _ = matching.tracks_and_images(graph)
+    for track in tracks:
+        image, edge = graph[track].items()[0]
+        point = types.Point()
+        point.id = track
+        point.coordinates = scene.points[scene.feature_points[image][edge['feature_id']]]
+        point.color = [128, 128, 128]
+        reconstruction.add_point(point)
+    data.save_reconstruction([reconstruction])
+    return scene, data, graph, reconstruction
+
+
+def test_point_descriptors(tmpdir):
+    scene, data, graph, reconstruction = _dataset_with_reconstruction(str(tmpdir))
+    tracks, points, descriptors = localization.point_descriptors(
+        data, graph, reconstruction)
+
+    assert len(tracks) == len(reconstruction.points)
+    for track, point, descriptor in zip(tracks[:20], points, descriptors):
+        image, edge = graph[track].items()[0]
+        point_id = scene.feature_points[image][edge['feature_id']]
+        assert np.allclose(point, scene.points[point_id])
+        assert np.allclose(descriptor, scene.point_descriptors[point_id], atol=0.05)
+
+
+def test_localizer_matches_points(tmpdir):
+    scene, data, graph, reconstruction = _dataset_with_reconstruction(str(tmpdir))
+    localizer = localization.Localizer(data)
+    assert data.localization_index_exists()
+
+    image = scene.images()[1]
+    descriptors = scene.descriptors(image)
+    matches = localizer.match(descriptors)
+    assert len(matches) > 100
+    query_points = scene.points[scene.feature_points[image][matches[:, 0]]]
+    assert np.mean(np.all(query_points == localizer.points[matches[:, 1]], axis=1)) > 0.95
+
+    # the index is loaded when the reconstruction did not change
+    assert len(localization.Localizer(data).tracks) == len(localizer.tracks)
+
+
+def test_tag_map():
+    reconstruction = types.Reconstruction()
+    corners = np.random.rand(4, 3)
+    for i, (tag_id, corner) in enumerate([(7, 0), (7, 1), (7, 2), (7, 3),
+                                          (7, 3), (8, 0), (8, 1)]):
+        point = types.Point()
+        point.id = str(i)
+        point.coordinates = corners[corner] + (0.01 if i == 4 else 0)
+        point.on_tag = True
+        point.tag_id = tag_id
+        point.tag_corner = corner
+        reconstruction.add_point(point)
+
+    tag_map = localization.tag_map(reconstruction)
+    assert sorted(tag_map) == ['7']
+    assert np.allclose(tag_map['7'][:3], corners[:3])
+    assert np.allclose(tag_map['7'][3], corners[3] + 0.005)
+
+
+def test_tag_localizer(tmpdir):
+    scene = synthetic.SyntheticScene(num_images=3, num_points=50,
+                                     tags_per_image=1, noise=0.0)
+    data = synthetic.write_dataset(scene, str(tmpdir))
+    reconstruction = types.Reconstruction()
+    reconstruction.add_camera(scene.camera)
+    for tag_id, corners in scene.tags.items():
+        for corner in range(4):
+            point = types.Point()
+            point.id = '{}-{}'.format(tag_id, corner)
+            point.coordinates = corners[corner]
+            point.color = [0, 0, 0]
+            point.on_tag = True
+            point.tag_id = tag_id
+            point.tag_corner = corner
+            reconstruction.add_point(point)
+    other = types.Reconstruction()
+    other.add_camera(scene.camera)
+    data.save_reconstruction([reconstruction, other])
+
+    assert localization.TagLocalizer(data, 1).tag_map == {}
+    localizer = localization.TagLocalizer(data)
+    assert data.tag_map_exists()
+    assert data.load_tag_map()[0] == 0
+    assert sorted(localizer.tag_map) == sorted(str(t) for t in scene.tags)
+
+    image = scene.images()[1]
+    detections = scene.tag_detection(image)[:1]
+    result = localizer.localize_tags(detections, scene.camera)
+    assert result['num_tags'] == 1
+    assert result['num_inliers'] == 4
+    pose = recon.pose_from_resection(result['T'])
+    assert np.allclose(pose.get_origin(), scene.shots[image].pose.get_origin(), atol=1e-3)
+
+    detections[0].id = 'unknown'
+    assert localizer.localize_tags(detections, scene.camera)['T'] is None
+
+
+def test_apriltag_detector_paths_are_not_parsed_by_a_shell(monkeypatch):
+    calls = []
+
+    class Process(object):
+        def __init__(self, command, **kwargs):
+            calls.append((command, kwargs))
+
+        def wait(self):
+            return 0
+
+    monkeypatch.setattr(detect_tags.subprocess, 'Popen', Process)
+    imagepath = '/tmp/query image; touch pwned.jpg'
+    detect_tags.run_apriltag_detector(imagepath, '/tmp/detections.json')
+
+    command, kwargs = calls[0]
+    assert command[command.index('-i') + 1] == imagepath
+    assert not kwargs.get('shell', False)
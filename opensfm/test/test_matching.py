@@ -21,5 +21,47 @@ def test_robust_match():
     assert num_points <= len(rmatches) <= len(matches)
 
 
+def test_extend_tracks_graph():
+    config = opensfm.config.default_config()
+    features = {im: np.random.rand(10, 2) for im in ['a', 'b', 'c']}
+    colors = {im: np.zeros((10, 3)) for im in ['a', 'b', 'c']}
+    matches = {('a', 'b'): np.array([[0, 0], [1, 1], [2, 2]])}
+    graph = opensfm.matching.create_tracks_graph(
+        features, colors, matches, {}, {}, {}, {}, {}, config)
+    track_of = {graph['a'][t]['feature_id']: t for t in graph['a']}
+
+    new_matches = {
+        ('c', 'a'): np.array([[0, 0], [1, 1], [5, 5]]),
+        ('c', 'b'): np.array([[0, 0], [1, 2]]),
+    }
+    extended, created = opensfm.matching.extend_tracks_graph(
+        graph, features, colors, new_matches, {}, {}, {}, {}, {}, config)
+
+    # feature 0 extends a track, feature 1 joins two tracks and is dropped
+    # and feature 5 makes a new track with a feature of a
+    assert (extended, created) == (1, 1)
+    assert graph['c'][track_of[0]]['feature_id'] == 0
+    assert track_of[1] not in graph['c']
+    new_track = [t for t in graph['c'] if t not in track_of.values()][0]
+    assert sorted(graph[new_track]) == ['a', 'c']
+    assert graph['a'][new_track]['feature_id'] == 5
+    assert len(graph['a'][track_of[2]]) > 0
+
+
+def test_match_candidates_of_new_images():
+    from opensfm.commands import match_features
+
+    images = ['a', 'b', 'c', 'd']
+    pairs = match_features.match_candidates_all(images, ['d', 'b'])
+    assert pairs == set([('a', 'b'), ('b', 'c'), ('b', 'd'),
+                         ('a', 'd'), ('c', 'd')])
+
+    by_image = match_features.pairs_by_image(pairs, images, ['d', 'b'])
+    assert sorted(by_image) == ['b', 'd']
+    assert sorted(by_image['b']) in (['a', 'c'], ['a', 'c', 'd'])
+    assert sorted(by_image['d']) in (['a', 'c'], ['a', 'b', 'c'])
+    assert len(by_image['b']) + len(by_image['d']) == 5
+
+
 if __name__ == "__main__":
     test_robust_match()
@@ -0,0 +1,118 @@
+import os
+
+from opensfm import config
+from opensfm import pipeline
+
+
+class PipelineTestDataSet:
+    def __init__(self, path):
+        self.data_path = path
+        self.config = {'feature_type': 'SIFT', 'min_track_length': 2,
+                       'use_apriltags': False, 'use_altitude_tag': False}
+        self.images_content = {'a.jpg': 'a', 'b.jpg': 'b'}
+        self.cleaned = []
+
+    def images(self):
+        return sorted(self.images_content)
+
+    def image_stat(self, image):
+        return len(self.images_content[image]), hash(self.images_content[image])
+
+    def image_digest(self, image):
+        return self.images_content[image]
+
+    def pipeline_state_file(self):
+        return os.path.join(self.data_path, 'pipeline_state.json')
+
+
+class FinishedProcess:
+    def poll(self):
+        return 0
+
+
+def _stages(data):
+    return [
+        pipeline.Stage('detect_tags', config_keys=pipeline.TAG_KEYS, reads_images=True,
+                       clean_image=lambda d, im: data.cleaned.append(('detect_tags', im))),
+        pipeline.Stage('detect_features', config_keys=['feature_'],
+                       tag_dependencies=['detect_tags'], reads_images=True,
+                       clean_image=lambda d, im: data.cleaned.append(('detect_features', im))),
+        pipeline.Stage('create_tracks', ['detect_features'], ['min_track_length']),
+    ]
+
+
+def _runner(data, launched, jobs=2):
+    def launcher(stage, data):
+        launched.append(stage.name)
+        return FinishedProcess()
+    return pipeline.PipelineRunner(
+        data, ['detect_tags', 'detect_features', 'create_tracks'], jobs,
+        _stages(data), launcher, poll_interval=0)
+
+
+def test_pipeline_skips_up_to_date_stages(tmpdir):
+    data = PipelineTestDataSet(str(tmpdir))
+
+    launched = []
+    assert sorted(_runner(data, launched).run()) == [
+        'create_tracks', 'detect_features', 'detect_tags']
+    assert launched[-1] == 'create_tracks'
+
+    launched = []
+    assert _runner(data, launched).run() == []
+    assert launched == []
+
+    launched = []
+    data.config['min_track_length'] = 3
+    assert _runner(data, launched).run() == ['create_tracks']
+
+    launched = []
+    data.config['feature_type'] = 'HAHOG'
+    assert _runner(data, launched).run() == ['detect_features', 'create_tracks']
+
+    launched = []
+    assert _runner(data, launched).run(force=['detect_tags']) == ['detect_tags']
+
+
+def test_pipeline_reruns_changed_images(tmpdir):
+    data = PipelineTestDataSet(str(tmpdir))
+    _runner(data, []).run()
+    assert sorted(data.cleaned) == [
+        ('detect_features', 'a.jpg'), ('detect_features', 'b.jpg'),
+        ('detect_tags', 'a.jpg'), ('detect_tags', 'b.jpg')]
+
+    data.cleaned = []
+    data.images_content['b.jpg'] = 'new b'
+    launched = []
+    _runner(data, launched).run()
+    assert sorted(launched) == ['create_tracks', 'detect_features', 'detect_tags']
+    assert sorted(data.cleaned) == [
+        ('detect_features', 'b.jpg'), ('detect_tags', 'b.jpg')]
+
+
+def test_pipeline_tag_dependencies(tmpdir):
+    data = PipelineTestDataSet(str(tmpdir))
+    data.config['use_apriltags'] = True
+
+    launched = []
+    _runner(data, launched, jobs=1).run()
+    assert launched == ['detect_tags', 'detect_features', 'create_tracks']
+
+
+def test_pipeline_ignores_unrelated_use_keys(tmpdir):
+    data = PipelineTestDataSet(str(tmpdir))
+    _runner(data, []).run()
+
+    data.cleaned = []
+    data.config['use_altitude_tag'] = True
+    launched = []
+    assert _runner(data, launched).run() == []
+    assert data.cleaned == []
+
+    stages = {s.name: s for s in pipeline.STAGES}
+    default = config.default_config()
+    for name in ['detect_tags', 'detect_features']:
+        values = stages[name].config_values(default)
+        assert 'use_apriltags' in values
+        assert 'use_altitude_tag' not in values
+        assert 'use_exif_size' not in values
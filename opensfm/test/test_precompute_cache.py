@@ -0,0 +1,79 @@
+import os
+
+import networkx as nx
+import numpy as np
+
+from opensfm import config
+from opensfm import dataset
+from opensfm import matching
+from opensfm import precompute_cache
+
+
+class CacheTestDataSet:
+    def __init__(self, path):
+        self.config = config.default_config()
+        self.path = path
+
+    def tracks_graph_digest(self):
+        return dataset.file_digest(os.path.join(self.path, 'tracks.csv'))
+
+    def tags_graph_digest(self):
+        return dataset.file_digest(os.path.join(self.path, 'tags_graph.csv'))
+
+    def precompute_cache_path(self):
+        return os.path.join(self.path, 'cache')
+
+
+def _tracks_graph(path):
+    np.random.seed(42)
+    graph = nx.Graph()
+    for image in ['im0', 'im1', 'im2']:
+        graph.add_node(image, bipartite=0)
+        for i in range(60):
+            track = str(i)
+            graph.add_node(track, bipartite=1)
+            x, y = np.random.rand(2)
+            graph.add_edge(image, track, feature=(x, y), feature_id=i,
+                           feature_color=(0.0, 0.0, 0.0), tag_feature=i % 2,
+                           tag_id=str(i % 3), corner_id=i % 4)
+    with open(os.path.join(path, 'tracks.csv'), 'w') as fout:
+        dataset.save_tracks_graph(fout, graph)
+    return graph
+
+
+def test_common_tracks_round_trip(tmpdir, monkeypatch):
+    data = CacheTestDataSet(str(tmpdir))
+    graph = _tracks_graph(str(tmpdir))
+    tracks, images = matching.tracks_and_images(graph)
+
+    expected = precompute_cache.PrecomputeCache(data).common_tracks(graph, tracks)
+
+    def fail(*args):
+        raise AssertionError('common tracks should be loaded from the cache')
+    monkeypatch.setattr(matching, 'all_common_tracks', fail)
+    loaded = precompute_cache.PrecomputeCache(data).common_tracks(graph, tracks)
+
+    assert sorted(loaded) == sorted(expected) == [
+        ('im0', 'im1'), ('im0', 'im2'), ('im1', 'im2')]
+    for pair, value in expected.items():
+        assert loaded[pair][0] == value[0]
+        assert np.allclose(loaded[pair][1], value[1])
+        assert np.allclose(loaded[pair][2], value[2])
+        assert loaded[pair][3:] == value[3:]
+
+
+def test_pair_scores_key_and_eviction(tmpdir):
+    data = CacheTestDataSet(str(tmpdir))
+    _tracks_graph(str(tmpdir))
+
+    cache = precompute_cache.PrecomputeCache(data)
+    cache.save_pair_scores({('im0', 'im1'): 60, ('im0', 'im2'): 0})
+    assert cache.pair_scores() == {('im0', 'im1'): 60, ('im0', 'im2'): 0}
+
+    data.config['homography_threshold'] = 0.01
+    cache = precompute_cache.PrecomputeCache(data)
+    assert cache.pair_scores() == {}
+
+    cache.max_size = 0
+    cache.save_pair_scores({('im1', 'im2'): 60})
+    assert os.listdir(data.precompute_cache_path()) == []
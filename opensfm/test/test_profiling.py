@@ -0,0 +1,93 @@
+import json
+import time
+from multiprocessing import Pool
+
+from opensfm import profiling
+
+
+def _work(i):
+    with profiling.span('work'):
+        profiling.count('work/items')
+    return i
+
+
+def test_disabled_profiling_does_nothing():
+    assert not profiling.enabled()
+    assert profiling.span('a') is profiling.span('b')
+    with profiling.span('a'):
+        profiling.count('a/items')
+        profiling.size('a/size', 1)
+        profiling.record('a/part', 1.0)
+
+
+def test_nested_spans_and_counters(tmpdir):
+    filename = str(tmpdir.join('profile.jsonl'))
+    profiling.enable(filename, 'command')
+    try:
+        with profiling.span('command'):
+            profiling.count('items', 2)
+            for i in range(3):
+                with profiling.span('step'):
+                    profiling.count('items')
+            profiling.record('bundle/run', 0.5)
+            pool = Pool(2)
+            pool.map(_work, range(4))
+            pool.close()
+            pool.join()
+    finally:
+        profiling.disable()
+
+    events = profiling.load_events(filename)
+    assert len(set(e['run'] for e in events)) == 1
+    spans, counters, sizes = profiling.summarize(events)
+    assert spans['command/step']['count'] == 3
+    assert spans['command/bundle/run']['total'] == 0.5
+    assert spans['command/work']['count'] == 4
+    assert spans['command']['count'] == 1
+    assert counters == {'items': 5, 'work/items': 4}
+
+
+def test_last_runs_and_percentiles():
+    events = [
+        {'type': 'span', 'command': 'a', 'run': '1', 'name': 'a', 'duration': 10.0},
+        {'type': 'span', 'command': 'a', 'run': '2', 'name': 'a', 'duration': 1.0},
+        {'type': 'span', 'command': 'a', 'run': '2', 'name': 'a', 'duration': 2.0},
+        {'type': 'span', 'command': 'a', 'run': '2', 'name': 'a', 'duration': 3.0},
+        {'type': 'counter', 'command': 'b', 'run': '3', 'name': 'n', 'value': 4},
+    ]
+    spans, counters, sizes = profiling.summarize(profiling.last_runs(events))
+    assert spans['a']['count'] == 3
+    assert spans['a']['p50'] == 2.0
+    assert spans['a']['max'] == 3.0
+    assert abs(spans['a']['p90'] - 2.8) < 1e-9
+    assert counters == {'n': 4}
+
+
+def test_memory_profiling(tmpdir):
+    filename = str(tmpdir.join('profile.jsonl'))
+    profiling.enable(filename, 'command', memory_interval=0.01)
+    try:
+        assert profiling.memory_enabled()
+        with profiling.span('command'):
+            with profiling.span('allocate'):
+                data = bytearray(50 * 1000 * 1000)
+                time.sleep(0.05)
+                del data
+            profiling.size('graph/nodes', 10)
+            profiling.size('graph/nodes', 4)
+    finally:
+        profiling.disable()
+
+    spans, counters, sizes = profiling.summarize(profiling.load_events(filename))
+    assert spans['command/allocate']['rss_peak'] >= 50 * 1000 * 1000
+    assert spans['command']['rss_peak'] >= spans['command/allocate']['rss_peak']
+    assert sizes == {'graph/nodes': 10}
+
+
+def test_write_snapshot(tmpdir):
+    filename = profiling.write_snapshot(str(tmpdir), limit=5)
+    with open(filename) as fin:
+        snapshot = json.load(fin)
+    assert snapshot['kind'] in ('gc', 'tracemalloc')
+    assert 0 < len(snapshot['entries']) <= 5
+    assert snapshot['rss'] > 0
@@ -1,3 +1,4 @@
+import numpy as np
 import networkx as nx
 
 from opensfm import types
@@ -60,3 +61,58 @@ def test_shot_neighborhood_complete_graph():
         graph, reconstruction, 'im2', 2)
     assert interior == set(['im0', 'im1', 'im2', 'im3'])
     assert boundary == set()
+
+
+def test_tag_pnp_pose():
+    corners = np.array([[-0.1, 0.1, 0.0],
+                        [0.1, 0.1, 0.0],
+                        [0.1, -0.1, 0.0],
+                        [-0.1, -0.1, 0.0]])
+    pose = types.Pose([0.1, -0.2, 0.05], [0.2, 0.1, 2.0])
+
+    bs = np.array([pose.transform(c) for c in corners])
+    bs /= np.linalg.norm(bs, axis=1)[:, np.newaxis]
+
+    T = opensfm.reconstruction.tag_pnp_pose(bs, corners)
+    assert np.allclose(T[:, :3], pose.get_rotation_matrix().T, atol=1e-6)
+    assert np.allclose(T[:, 3], pose.get_origin(), atol=1e-6)
+
+
+def test_lazy_image_pairs_matches_eager_order():
+    np.random.seed(42)
+    track_dict = {}
+    for i, n in enumerate([60, 90, 75]):
+        p1 = np.random.rand(n, 2) - 0.5
+        p2 = np.random.rand(n, 2) - 0.5
+        track_dict['im0', 'im' + str(i + 1)] = (
+            range(n), p1, p2, [0] * n, [0] * n, [0] * n)
+    p1 = np.random.rand(80, 2) - 0.5
+    track_dict['im1', 'im2'] = (
+        range(80), p1, p1 + 0.01, [0] * 80, [0] * 80, [0] * 80)
+
+    config = {'processes': 1, 'lazy_pair_batch_size': 2}
+    images = set(['im0', 'im1', 'im2', 'im3'])
+    scores = {}
+
+    eager = opensfm.reconstruction.compute_image_pairs(track_dict, config)
+    lazy = list(opensfm.reconstruction.lazy_image_pairs(
+        track_dict, config, images, scores=scores))
+    assert lazy == eager == [('im0', 'im2'), ('im0', 'im3'), ('im0', 'im1')]
+    assert scores['im1', 'im2'] == 0
+
+
+def test_compute_image_pairs_reuses_scores():
+    np.random.seed(42)
+    track_dict = {}
+    for i, n in enumerate([60, 90]):
+        p1 = np.random.rand(n, 2) - 0.5
+        p2 = np.random.rand(n, 2) - 0.5
+        track_dict['im0', 'im' + str(i + 1)] = (
+            range(n), p1, p2, [0] * n, [0] * n, [0] * n)
+
+    config = {'processes': 1}
+    scores = {('im0', 'im2'): 0}
+    pairs = opensfm.reconstruction.compute_image_pairs(
+        track_dict, config, scores)
+    assert pairs == [('im0', 'im1')]
+    assert scores == {('im0', 'im1'): 60, ('im0', 'im2'): 0}
@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+
+from opensfm import types
+from opensfm.commands import undistort
+
+
+def test_undistort_perspective_image():
+    camera = types.PerspectiveCamera()
+    camera.id = 'camera'
+    camera.width = 64
+    camera.height = 48
+    camera.focal = 0.9
+    camera.k1 = -0.1
+    camera.k2 = 0.01
+
+    np.random.seed(42)
+    image = (np.random.rand(48, 64, 3) * 255).astype(np.uint8)
+    K = camera.get_K_in_pixel_coordinates(64, 48)
+    expected = cv2.undistort(image, K, np.array([camera.k1, camera.k2, 0, 0]))
+
+    assert np.all(undistort.undistort_perspective_image(image, camera) == expected)
+    assert np.all(undistort.undistort_perspective_image(image, camera) == expected)
+
+
+def test_panorama_view_maps_are_shared():
+    camera = types.SphericalCamera()
+    camera.id = 'spherical'
+    camera.width = 128
+    camera.height = 64
+    image = np.zeros((64, 128, 3), dtype=np.uint8)
+
+    undistort._remap_cache.clear()
+    for origin in [[0.0, 0.0, 0.0], [1.0, 2.0, 3.0]]:
+        shot = types.Shot()
+        shot.id = str(origin)
+        shot.camera = camera
+        shot.pose = types.Pose([0.1, 0.2, 0.3])
+        shot.pose.set_origin(origin)
+        for subshot in undistort.perspective_views_of_a_panorama(shot, 16):
+            view = undistort.render_perspective_view_of_a_panorama(
+                image, shot, subshot)
+            assert view.shape == (16, 16, 3)
+    assert len(undistort._remap_cache) == 6
+
+
+class UndistortTestDataSet:
+    def __init__(self, processes):
+        self.config = {'processes': processes, 'depthmap_resolution': 16,
+                       'undistort_queue_size': 2}
+        self.images = {}
+        self.undistorted = {}
+
+    def image_as_array(self, image):
+        return self.images[image]
+
+    def save_undistorted_image(self, image, array):
+        self.undistorted[image] = array
+
+
+def test_undistort_images_pipeline():
+    camera = types.PerspectiveCamera()
+    camera.id = 'camera'
+    camera.width = 32
+    camera.height = 24
+    camera.focal = 0.9
+    camera.k1 = -0.1
+    camera.k2 = 0.01
+
+    for processes in [1, 2]:
+        data = UndistortTestDataSet(processes)
+        arguments = []
+        for i in range(5):
+            shot = types.Shot()
+            shot.id = 'shot{}'.format(i)
+            shot.camera = camera
+            shot.pose = types.Pose()
+            data.images[shot.id] = np.full((24, 32, 3), i, dtype=np.uint8)
+            arguments.append((shot, [shot]))
+
+        undistort.undistort_images_pipeline(data, arguments)
+
+        assert sorted(data.undistorted) == sorted(data.images)
+        for shot_id, image in data.images.items():
+            expected = undistort.undistort_perspective_image(image, camera)
+            assert np.all(data.undistorted[shot_id] == expected)
@@ -0,0 +1,130 @@
+import os
+import time
+from multiprocessing import Process
+
+from opensfm import work_queue
+
+
+def _queue(tmpdir, **kwargs):
+    return work_queue.WorkQueue(str(tmpdir.join('queue.db')), **kwargs)
+
+
+def test_lease_is_exclusive(tmpdir):
+    queue = _queue(tmpdir)
+    assert queue.add('stage', 'a', {'value': 1})
+    assert not queue.add('stage', 'a', {'value': 2})
+
+    other = _queue(tmpdir)
+    task = queue.lease('w1')
+    assert task.key == 'a'
+    assert task.payload == {'value': 1}
+    assert other.lease('w2') is None
+
+    queue.complete(task, 'w1')
+    assert queue.counts() == {'stage': {'done': 1}}
+
+
+def test_failed_and_expired_tasks_are_retried(tmpdir):
+    queue = _queue(tmpdir, lease_time=0.05, max_attempts=2)
+    queue.add('stage', 'a')
+
+    task = queue.lease('w1')
+    queue.fail(task, 'w1', 'error')
+    assert queue.counts() == {'stage': {'pending': 1}}
+
+    task = queue.lease('w1')
+    assert task.attempts == 2
+    assert queue.heartbeat(task, 'w1')
+    time.sleep(0.1)
+    assert queue.lease('w2') is None
+    assert queue.failed_tasks() == [('stage', 'a', 'lease expired')]
+
+    # the worker that lost the lease can not complete the task anymore
+    queue.complete(task, 'w1')
+    assert queue.counts() == {'stage': {'failed': 1}}
+
+
+def test_stage_dependencies(tmpdir):
+    queue = _queue(tmpdir)
+    queue.add_stage_dependencies('second', ['first'])
+    queue.add('second', 'b')
+    queue.add('first', 'a')
+
+    first = queue.lease('w1')
+    assert first.stage == 'first'
+    assert queue.lease('w2') is None
+    queue.complete(first, 'w1')
+    assert queue.lease('w2').stage == 'second'
+
+
+def _plan(queue, task):
+    queue.add_many('work', [(str(i), None) for i in range(task.payload['count'])])
+
+
+def _work(queue, task):
+    folder = os.path.dirname(queue.filename)
+    if task.key == '3' and task.attempts == 1:
+        raise RuntimeError('first attempt fails')
+    with open(os.path.join(folder, 'work_{}'.format(task.key)), 'a') as fout:
+        fout.write('{}\n'.format(os.getpid()))
+
+
+def _worker(filename):
+    queue = work_queue.WorkQueue(filename)
+    work_queue.run_worker(queue, {'plan': _plan, 'work': _work},
+                          poll_interval=0.01)
+
+
+def test_multiple_worker_processes(tmpdir):
+    queue = _queue(tmpdir)
+    queue.add_stage_dependencies('work', ['plan'])
+    queue.add('plan', 'all', {'count': 20})
+
+    workers = [Process(target=_worker, args=(queue.filename,))
+               for i in range(3)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    assert queue.counts() == {'plan': {'done': 1}, 'work': {'done': 20}}
+    for i in range(20):
+        with open(str(tmpdir.join('work_{}'.format(i)))) as fin:
+            assert len(fin.readlines()) == 1
+
+
+def _slow_plan(queue, task):
+    time.sleep(0.2)
+    _plan(queue, task)
+
+
+def _check_work(queue, task):
+    folder = os.path.dirname(queue.filename)
+    for i in range(task.payload['count']):
+        if not os.path.isfile(os.path.join(folder, 'work_{}'.format(i))):
+            raise RuntimeError('work {} is missing'.format(i))
+
+
+def _chained_worker(filename):
+    queue = work_queue.WorkQueue(filename, max_attempts=1)
+    work_queue.run_worker(queue, {'plan': _slow_plan, 'work': _work,
+                                  'check': _check_work},
+                          poll_interval=0.01)
+
+
+def test_planning_stage_waits_for_planning_stage(tmpdir):
+    queue = _queue(tmpdir, max_attempts=1)
+    queue.add_stage_dependencies('work', ['plan'])
+    queue.add_stage_dependencies('check', ['plan', 'work'])
+    queue.add('plan', 'all', {'count': 3})
+    queue.add('check', 'all', {'count': 3})
+
+    workers = [Process(target=_chained_worker, args=(queue.filename,))
+               for i in range(3)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    assert queue.counts() == {'plan': {'done': 1}, 'work': {'done': 3},
+                              'check': {'done': 1}}
@@ -0,0 +1,313 @@
+"""Persistent work queue shared by worker processes.
+
+Tasks are rows of a SQLite database living in the dataset, so that any
+number of workers, on this machine or on others sharing the dataset
+folder, can pull work from it.  A worker leases a task for a limited
+time and renews the lease with heartbeats while running it.  Tasks whose
+lease expires, because their worker died, and tasks that failed are put
+back in the queue until they reach the maximum number of attempts.
+
+Tasks are grouped by stage.  A stage can depend on other stages, in
+which case its tasks are only leased once all the tasks of those stages
+are finished.  This lets the tasks of a stage add the tasks of the next
+stages once they know them.
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    error TEXT,
+    UNIQUE (stage, key)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, stage);
+CREATE TABLE IF NOT EXISTS stage_dependencies (
+    stage TEXT NOT NULL,
+    dependency TEXT NOT NULL,
+    UNIQUE (stage, dependency)
+);
+'''
+
+
+class Task(object):
+    """A leased task."""
+
+    def __init__(self, id, stage, key, payload, attempts):
+        self.id = id
+        self.stage = stage
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+
+    def __repr__(self):
+        return 'Task({}, {})'.format(self.stage, self.key)
+
+
+class WorkQueue(object):
+    """A work queue stored in a SQLite database."""
+
+    def __init__(self, filename, lease_time=60, max_attempts=3, timeout=60):
+        self.filename = filename
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.connection = self._connect()
+        self.connection.executescript(SCHEMA)
+
+    def _connect(self):
+        # Transactions are handled explicitly, see _transaction
+        return sqlite3.connect(self.filename, timeout=self.timeout,
+                               isolation_level=None)
+
+    def _transaction(self, function, *args):
+        """Run function(cursor, *args) in a write transaction."""
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            result = function(cursor, *args)
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return result
+
+    def add_stage_dependencies(self, stage, dependencies):
+        """Only lease the tasks of stage once the dependencies are finished."""
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO stage_dependencies VALUES (?, ?)',
+            [(stage, d) for d in dependencies])
+
+    def add(self, stage, key, payload=None):
+        """Add a task unless a task with the same stage and key exists.
+
+        Returns:
+            whether the task was added.
+        """
+        return self.add_many(stage, [(key, payload)]) == 1
+
+    def add_many(self, stage, tasks):
+        """Add (key, payload) tasks to a stage, skipping existing ones.
+
+        Returns:
+            the number of tasks added.
+        """
+        def add(cursor):
+            added = 0
+            for key, payload in tasks:
+                cursor.execute(
+                    'INSERT OR IGNORE INTO tasks (stage, key, payload, state) '
+                    'VALUES (?, ?, ?, ?)',
+                    (stage, key, json.dumps(payload), PENDING))
+                added += cursor.rowcount
+            return added
+        return self._transaction(add)
+
+    def lease(self, worker):
+        """Lease a pending task to a worker.
+
+        Tasks with expired leases are given back to the queue first.
+
+        Returns:
+            the leased Task or None if no task can run now.
+        """
+        return self._transaction(self._lease, worker)
+
+    def _lease(self, cursor, worker):
+        now = time.time()
+        cursor.execute(
+            'UPDATE tasks SET state = ?, worker = NULL, error = ? '
+            'WHERE state = ? AND lease_expires < ? AND attempts >= ?',
+            (FAILED, 'lease expired', RUNNING, now, self.max_attempts))
+        cursor.execute(
+            'UPDATE tasks SET state = ?, worker = NULL, error = ? '
+            'WHERE state = ? AND lease_expires < ?',
+            (PENDING, 'lease expired', RUNNING, now))
+
+        cursor.execute(
+            'SELECT id, stage, key, payload, attempts FROM tasks AS t '
+            'WHERE state = ? AND NOT EXISTS ('
+            '  SELECT 1 FROM stage_dependencies AS d JOIN tasks AS o '
+            '  ON o.stage = d.dependency '
+            '  WHERE d.stage = t.stage AND o.state IN (?, ?)) '
+            'ORDER BY id LIMIT 1',
+            (PENDING, PENDING, RUNNING))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        id, stage, key, payload, attempts = row
+        cursor.execute(
+            'UPDATE tasks SET state = ?, worker = ?, attempts = ?, '
+            'lease_expires = ? WHERE id = ?',
+            (RUNNING, worker, attempts + 1, now + self.lease_time, id))
+        return Task(id, stage, key, json.loads(payload), attempts + 1)
+
+    def heartbeat(self, task, worker, connection=None):
+        """Extend the lease of a running task.
+
+        Returns:
+            False if the task is no longer leased to the worker.
+        """
+        connection = connection or self.connection
+        cursor = connection.execute(
+            'UPDATE tasks SET lease_expires = ? '
+            'WHERE id = ? AND worker = ? AND state = ?',
+            (time.time() + self.lease_time, task.id, worker, RUNNING))
+        return cursor.rowcount == 1
+
+    def complete(self, task, worker):
+        """Mark a task leased to worker as done."""
+        self.connection.execute(
+            'UPDATE tasks SET state = ?, lease_expires = NULL, error = NULL '
+            'WHERE id = ? AND worker = ? AND state = ?',
+            (DONE, task.id, worker, RUNNING))
+
+    def fail(self, task, worker, error):
+        """Put back a failed task, or mark it failed after max attempts."""
+        def fail(cursor):
+            cursor.execute(
+                'SELECT attempts FROM tasks WHERE id = ? AND worker = ? '
+                'AND state = ?', (task.id, worker, RUNNING))
+            row = cursor.fetchone()
+            if row is None:
+                return
+            state = FAILED if row[0] >= self.max_attempts else PENDING
+            cursor.execute(
+                'UPDATE tasks SET state = ?, worker = NULL, '
+                'lease_expires = NULL, error = ? WHERE id = ?',
+                (state, error, task.id))
+        self._transaction(fail)
+
+    def has_running_tasks(self):
+        """Whether some task is leased with an unexpired lease."""
+        cursor = self.connection.execute(
+            'SELECT 1 FROM tasks WHERE state = ? AND lease_expires >= ? '
+            'LIMIT 1', (RUNNING, time.time()))
+        return cursor.fetchone() is not None
+
+    def counts(self):
+        """Number of tasks per stage and state.
+
+        Returns:
+            a dict from stages to dicts from states to counts.
+        """
+        counts = {}
+        for stage, state, count in self.connection.execute(
+                'SELECT stage, state, COUNT(*) FROM tasks '
+                'GROUP BY stage, state'):
+            counts.setdefault(stage, {})[state] = count
+        return counts
+
+    def failed_tasks(self):
+        """(stage, key, error) tuples of the failed tasks."""
+        return list(self.connection.execute(
+            'SELECT stage, key, error FROM tasks WHERE state = ? '
+            'ORDER BY id', (FAILED,)))
+
+    def reset(self, stages=None):
+        """Remove the tasks of the given stages, or all tasks."""
+        if stages is None:
+            self.connection.execute('DELETE FROM tasks')
+        else:
+            self.connection.executemany(
+                'DELETE FROM tasks WHERE stage = ?', [(s,) for s in stages])
+
+    def close(self):
+        self.connection.close()
+
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def run_worker(queue, handlers, worker_id=None, poll_interval=1.0):
+    """Run the tasks of a queue until no more tasks are left.
+
+    A heartbeat thread renews the lease of the running task.  When no
+    task can be leased, the worker waits for the running tasks of the
+    other workers, which may add new tasks, and stops once none is left.
+
+    Args:
+        queue: the WorkQueue.
+        handlers: dict from stages to functions(queue, task) running a
+            task.  Exceptions raised by handlers fail the task.
+        worker_id: name of the worker in the queue.
+        poll_interval: seconds to wait when no task is ready.
+
+    Returns:
+        the number of tasks run by this worker.
+    """
+    worker_id = worker_id or default_worker_id()
+    heartbeat_interval = max(queue.lease_time / 3.0, 0.01)
+    current = {'task': None}
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def heartbeat():
+        # sqlite connections can not be shared between threads
+        connection = queue._connect()
+        while not stopped.wait(heartbeat_interval):
+            with lock:
+                task = current['task']
+                if task is not None:
+                    try:
+                        queue.heartbeat(task, worker_id, connection)
+                    except sqlite3.Error as e:
+                        logger.warning('Heartbeat of {} failed: {}'.format(task, e))
+        connection.close()
+
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+
+    count = 0
+    try:
+        while True:
+            task = queue.lease(worker_id)
+            if task is None:
+                if not queue.has_running_tasks():
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            logger.info('{} running {} {} (attempt {})'.format(
+                worker_id, task.stage, task.key, task.attempts))
+            with lock:
+                current['task'] = task
+            try:
+                handlers[task.stage](queue, task)
+            except Exception as e:
+                logger.exception(e)
+                with lock:
+                    current['task'] = None
+                queue.fail(task, worker_id, '{}: {}'.format(type(e).__name__, e))
+            else:
+                with lock:
+                    current['task'] = None
+                queue.complete(task, worker_id)
+            count += 1
+    finally:
+        stopped.set()
+        thread.join()
+    return count
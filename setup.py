@@ -31,7 +31,7 @@ setup(
     url='https://github.com/CogChameleon/MarkerSfM.git',
     author='Joseph DeGol',
     license='BSD 2-Clause',
-    packages=['opensfm', 'opensfm.commands'],
+    packages=['opensfm', 'opensfm.commands', 'opensfm.benchmark'],
     scripts=['bin/opensfm_run_all', 'bin/opensfm'],
     package_data={
         'opensfm': ['csfm.so', 'data/sensor_data.json']